@@ -0,0 +1,189 @@
+"""
+Adaptive baud rate: which rate to start a port at, and what to fall back to.
+
+Every write is recorded per port and per USB adapter (VID:PID) with its baud
+rate, outcome and throughput. A port starts at the fastest rate that has not
+been failing on it (or, for a port seen for the first time, on the same kind
+of adapter) and steps down the ladder after a link error.
+
+The port helpers here (USB adapter and hub of a port) are shared with the
+job queue, metrics and history.
+"""
+import os
+import json
+import time
+import threading
+
+# Rates tried from fastest to slowest
+BAUD_LADDER = [921600, 460800, 230400, 115200]
+
+# A rate that failed this many times in a row is not started at ...
+FAILURE_STREAK = 2
+# ... until this long after its last failure, when it gets probed again
+RETRY_AFTER = 24 * 60 * 60
+# A rate that succeeds less often than this (over enough attempts) is not started at
+MIN_SUCCESS_RATIO = 0.5
+MIN_ATTEMPTS = 4
+
+# esptool output that means the serial link (not the images or the chip) failed
+LINK_ERRORS = [
+    "Timed out waiting for packet",
+    "Serial data stream stopped",
+    "Invalid head of packet",
+    "Packet content transfer stopped",
+    "Possible serial noise or corruption",
+    "A serial exception error occurred",
+    "MD5 of file does not match data in flash",
+    "No serial data received",
+    "device reports readiness to read but returned no data",
+]
+
+# The connect always runs at the ROM's 115200 baud, so a slower write rate cannot fix these
+CONNECT_ERRORS = [
+    "Failed to connect",
+]
+
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+def is_link_error(line):
+    """True if an esptool output line shows a serial link problem worth retrying slower"""
+    return any(error in line for error in LINK_ERRORS)
+
+
+def is_connect_error(line):
+    """True if an esptool output line shows the board could not be reached at all"""
+    return any(error in line for error in CONNECT_ERRORS)
+
+
+def adapter_for_port(port):
+    """Return the USB adapter of a port as "VID:PID", or None if unknown"""
+    with _adapters_lock:
+        if port in _adapters:
+            return _adapters[port]
+    adapter = None
+    try:
+        import serial.tools.list_ports
+        for info in serial.tools.list_ports.comports():
+            if info.device == port and info.vid is not None:
+                adapter = f"{info.vid:04X}:{info.pid:04X}"
+    except Exception:
+        return None
+    with _adapters_lock:
+        _adapters[port] = adapter
+    return adapter
+
+
+def hub_of(location):
+    """Return the USB hub part of a pyserial port location, or None
+    
+    "1-1.4:1.0" -> "1-1" (Linux/macOS), "Port_#0004.Hub_#0003" -> "Hub_#0003" (Windows)
+    """
+    if not location:
+        return None
+    for part in location.split("."):
+        if part.startswith("Hub_#"):
+            return part
+    path = location.split(":")[0]
+    if "." in path:
+        return path.rsplit(".", 1)[0]
+    return path.split("-")[0]
+
+
+def hub_for_port(port):
+    """Return the USB hub a port is attached through, or None if unknown"""
+    try:
+        import serial.tools.list_ports
+        for info in serial.tools.list_ports.comports():
+            if info.device == port:
+                return hub_of(info.location)
+    except Exception:
+        pass
+    return None
+
+
+class BaudPolicy:
+    """baud_stats.json: success and throughput per baud rate, per port and per adapter"""
+    
+    def __init__(self, path, ladder=BAUD_LADDER):
+        self.path = path
+        self.ladder = sorted(ladder, reverse=True)
+        self.ports = {}
+        self.adapters = {}
+        self._lock = threading.Lock()
+        self.load()
+    
+    def load(self):
+        """Load the statistics; a missing or damaged file starts empty"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.ports = data.get("ports", {})
+            self.adapters = data.get("adapters", {})
+        except Exception as e:
+            print(f"Warning: Could not load baud statistics: {e}")
+            self.ports = {}
+            self.adapters = {}
+    
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"ports": self.ports, "adapters": self.adapters}, f, indent=4)
+        os.replace(tmp_path, self.path)
+    
+    def _usable(self, stats, now):
+        if stats.get("streak", 0) >= FAILURE_STREAK and now - stats.get("last_failure", 0) < RETRY_AFTER:
+            return False
+        attempts = stats.get("ok", 0) + stats.get("failed", 0)
+        if attempts >= MIN_ATTEMPTS and stats.get("ok", 0) < attempts * MIN_SUCCESS_RATIO:
+            return now - stats.get("last_failure", 0) >= RETRY_AFTER
+        return True
+    
+    def rates(self, port, adapter=None):
+        """Baud rates to try on port in order: the best start rate, then every slower one"""
+        now = time.time()
+        with self._lock:
+            port_stats = self.ports.get(port, {})
+            adapter_stats = self.adapters.get(adapter, {}) if adapter else {}
+            start = len(self.ladder) - 1
+            for index, baud in enumerate(self.ladder):
+                # What this port did at the rate, else what its kind of adapter did
+                stats = port_stats.get(str(baud)) or adapter_stats.get(str(baud))
+                if not stats or self._usable(stats, now):
+                    start = index
+                    break
+        return self.ladder[start:]
+    
+    def throughput(self, port, baud):
+        """Average effective kbit/s of successful writes on port at baud, or None"""
+        with self._lock:
+            stats = self.ports.get(port, {}).get(str(baud), {})
+            if not stats.get("seconds"):
+                return None
+            return stats["bytes"] * 8 / 1000.0 / stats["seconds"]
+    
+    def record(self, port, adapter, baud, success, nbytes=0, seconds=0.0):
+        """Remember the outcome of one write attempt"""
+        now = time.time()
+        with self._lock:
+            tables = [self.ports.setdefault(port, {})]
+            if adapter:
+                tables.append(self.adapters.setdefault(adapter, {}))
+            for table in tables:
+                stats = table.setdefault(str(baud), {"ok": 0, "failed": 0, "streak": 0, "bytes": 0, "seconds": 0.0})
+                if success:
+                    stats["ok"] += 1
+                    stats["streak"] = 0
+                    stats["bytes"] += nbytes
+                    stats["seconds"] = round(stats["seconds"] + seconds, 3)
+                else:
+                    stats["failed"] += 1
+                    stats["streak"] += 1
+                    stats["last_failure"] = now
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Warning: Could not save baud statistics: {e}")
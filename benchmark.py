@@ -0,0 +1,452 @@
+"""
+Benchmark of the flasher's own overhead with simulated boards (Linux/macOS).
+
+Every simulated board is a pty pair; fake_esptool.py stands in for esptool and
+writes the compressed images to the pty at the chosen baud rate while the
+benchmark drains the other end. The flash path runs headless (GangFlasher, as
+the command line uses it), through ESP32Flasher under a virtual display
+(Xvfb), or through localhost flash agents driven by the coordinator, for each
+requested number of boards.
+
+    python benchmark.py --boards 1 4 8
+    python benchmark.py --boards 4 --mode gui --speed 0.2 --output bench.jsonl
+    python benchmark.py --boards 8 --mode stations --stations 2
+    python benchmark.py record --esptool esptool.py --port /dev/ttyUSB0 -o recording.jsonl
+
+Reported per run: wall time, CPU time of the flasher process and of the
+esptool processes, peak memory, esptool lines handled per second and the
+per-board end-to-end latency. --output appends JSON lines tagged with the git
+commit so runs can be compared between commits.
+"""
+import os
+import sys
+import json
+import time
+import stat
+import struct
+import shutil
+import random
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+from flash_history import percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_ESPTOOL = os.path.join(HERE, "fake_esptool.py")
+
+# Segments (load address, size) of a typical WiFi LoRa 32 (V2) sketch: bootloader in IRAM/DRAM,
+# application with flash-mapped DROM/IROM; the images pass image_check like real build output
+BOOTLOADER_SEGMENTS = [(0x3FFF0030, 0x1A00), (0x40078000, 0x2800), (0x40080400, 0x0A00)]
+APP_SEGMENTS = [(0x3F400020, 0x2A000), (0x3FFBDB60, 0x3400), (0x40080000, 0x14000), (0x400D0020, 0x9C000)]
+# Arduino default partition table (8MB): nvs, otadata, app0, app1, spiffs
+PARTITIONS = [(1, 0x02, 0x9000, 0x5000, "nvs"), (1, 0x00, 0xe000, 0x2000, "otadata"),
+              (0, 0x10, 0x10000, 0x330000, "app0"), (0, 0x11, 0x340000, 0x330000, "app1"),
+              (1, 0x82, 0x670000, 0x190000, "spiffs")]
+FLASH_SIZE_8MB = 3
+
+
+def code_like(rng, size):
+    """Bytes that compress about like compiled code: repeated instruction words mixed with noise"""
+    words = [rng.getrandbits(32).to_bytes(4, "little") for _ in range(256)]
+    data = bytearray()
+    while len(data) < size:
+        data.extend(rng.choice(words) if rng.random() < 0.7 else rng.getrandbits(32).to_bytes(4, "little"))
+    return bytes(data[:size])
+
+
+def esp_image(rng, segments):
+    """An ESP32 image: header, segments, checksum and appended SHA-256"""
+    from image_check import xor_bytes
+    out = bytearray([0xE9, len(segments), 2, FLASH_SIZE_8MB << 4])
+    out += struct.pack("<I", segments[0][0])
+    out += bytes([0xEE, 0, 0, 0]) + struct.pack("<H", 0) + bytes(9) + bytes([1])
+    checksum = 0xEF
+    for address, size in segments:
+        data = code_like(rng, size)
+        out += struct.pack("<II", address, size) + data
+        checksum ^= xor_bytes(data)
+    out += bytes(15 - len(out) % 16)
+    out.append(checksum)
+    return bytes(out + hashlib.sha256(out).digest())
+
+
+def partition_table():
+    table = b"".join(b"\xaa\x50" + struct.pack("<BBII", type_, subtype, offset, size) + label.encode().ljust(16, b"\0")
+                     + bytes(4) for type_, subtype, offset, size, label in PARTITIONS)
+    table += b"\xeb\xeb" + b"\xff" * 14 + hashlib.md5(table).digest()
+    return table.ljust(0xC00, b"\xff")
+
+
+def make_images(directory, seed=1):
+    """Write firmware-like images and return a config dict with their paths"""
+    rng = random.Random(seed)
+    contents = [
+        ("bootloader_path", "bootloader.bin", esp_image(rng, BOOTLOADER_SEGMENTS)),
+        ("partitions_path", "partitions.bin", partition_table()),
+        ("boot_app0_path", "boot_app0.bin", b"\xff" * 0x2000),
+        ("app_bin_path", "app.bin", esp_image(rng, APP_SEGMENTS)),
+    ]
+    config = {}
+    for key, name, data in contents:
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        config[key] = path
+    return config
+
+
+def make_esptool_wrapper(directory):
+    """An executable that runs fake_esptool.py with this interpreter"""
+    path = os.path.join(directory, "esptool")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_ESPTOOL}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+class VirtualBoards:
+    """pty pairs standing in for USB-UART ports, drained in the background"""
+    
+    def __init__(self, count):
+        import pty
+        self.masters = []
+        self.ports = []
+        self.received = 0
+        self._slaves = []
+        self._stop = threading.Event()
+        for _ in range(count):
+            master, slave = pty.openpty()
+            self.masters.append(master)
+            self._slaves.append(slave)
+            self.ports.append(os.ttyname(slave))
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+    
+    def _drain(self):
+        import select
+        while not self._stop.is_set():
+            ready, _, _ = select.select(self.masters, [], [], 0.2)
+            for fd in ready:
+                try:
+                    self.received += len(os.read(fd, 65536))
+                except OSError:
+                    pass
+    
+    def comports(self):
+        """ListPortInfo entries for the virtual ports, looking like CP210x boards on one hub"""
+        from serial.tools.list_ports_common import ListPortInfo
+        infos = []
+        for index, port in enumerate(self.ports):
+            info = ListPortInfo(port, skip_link_detection=True)
+            info.vid, info.pid = 0x10C4, 0xEA60
+            info.serial_number = "BENCH%04d" % index
+            info.location = "1-1.%d:1.0" % (index + 1)
+            info.description = "CP2102 USB to UART Bridge Controller (virtual)"
+            infos.append(info)
+        return infos
+    
+    def close(self):
+        self._stop.set()
+        self._thread.join(1.0)
+        for fd in self.masters + self._slaves:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class LineCounter:
+    """Counts esptool lines passing through flash_core.run_esptool"""
+    
+    def __init__(self):
+        self.lines = 0
+        self._lock = threading.Lock()
+    
+    def install(self):
+        import flash_core
+        original = flash_core.run_esptool
+        
+        def counting(cmd, on_line=None):
+            def count(line):
+                with self._lock:
+                    self.lines += 1
+                if on_line:
+                    on_line(line)
+            return original(cmd, count)
+        
+        flash_core.run_esptool = counting
+
+
+class Measurement:
+    """Wall time, CPU time (own and children) and peak memory around a run"""
+    
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self
+    
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.children_cpu = (children.ru_utime - self.children.ru_utime) + (children.ru_stime - self.children.ru_stime)
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.peak_rss_mb = rss / 1024.0 / (1024.0 if sys.platform == "darwin" else 1.0)
+        return False
+
+
+def run_headless(workdir, config, boards):
+    """Flash every virtual board with GangFlasher, as "main.py flash" does"""
+    from flash_core import GangFlasher, make_engine, images_from_config, DEFAULT_BAUD
+    from bundle_cache import BundleCache
+    from baud_policy import BaudPolicy
+    from flash_metrics import MetricsRecorder
+    
+    flasher = GangFlasher(config["esptool_path"], images_from_config(config), len(boards.ports), DEFAULT_BAUD,
+                          bundle_cache=BundleCache(os.path.join(workdir, "bundle_cache")),
+                          engine=make_engine(config["esptool_path"], "subprocess"),
+                          baud_policy=BaudPolicy(os.path.join(workdir, "baud_stats.json")),
+                          metrics=MetricsRecorder(os.path.join(workdir, "metrics")))
+    with Measurement() as measured:
+        summary = flasher.run(boards.ports)
+    return measured, [result.duration for result in summary.results], summary.failed
+
+
+def start_virtual_display():
+    """Make sure Tk has a display: use $DISPLAY, else start Xvfb; returns the Xvfb process or None"""
+    if os.environ.get("DISPLAY"):
+        return None
+    xvfb = shutil.which("Xvfb")
+    if not xvfb:
+        raise RuntimeError("no display and Xvfb is not installed")
+    display = ":%d" % (90 + os.getpid() % 500)
+    process = subprocess.Popen([xvfb, display, "-screen", "0", "1280x1024x24", "-nolisten", "tcp"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(0.5)
+    os.environ["DISPLAY"] = display
+    return process
+
+
+def run_gui(workdir, config, boards):
+    """Flash through ESP32Flasher: the Flash button for one board, the gang window for several"""
+    import tkinter as tk
+    import main as app_module
+    
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(dict(config, port=boards.ports[0], engine="subprocess"), f)
+    # Result dialogs would block the run
+    for name in ("showinfo", "showerror", "showwarning"):
+        setattr(app_module.messagebox, name, lambda *args, **kwargs: None)
+    
+    root = tk.Tk()
+    app = app_module.ESP32Flasher(root, app_dir=workdir)
+    latencies = []
+    done = threading.Event()
+    failed = []
+    
+    finish_flash = app.finish_flash
+    
+    def on_finish(result):
+        latencies.append(time.perf_counter() - started)
+        failed.extend([result] if not result.success else [])
+        finish_flash(result)
+        done.set()
+    
+    show_gang_summary = app.show_gang_summary
+    
+    def on_summary(summary):
+        latencies.extend(result.duration for result in summary.results)
+        failed.extend(result for result in summary.results if not result.success)
+        show_gang_summary(summary)
+        done.set()
+    
+    app.finish_flash = on_finish
+    app.show_gang_summary = on_summary
+    root.update()
+    
+    with Measurement() as measured:
+        started = time.perf_counter()
+        if len(boards.ports) == 1:
+            app.port_var.set(boards.ports[0])
+            app.flash_esp32()
+        else:
+            app.open_gang_window()
+            app.gang_port_list.select_set(0, tk.END)
+            app.gang_workers_var.set(str(len(boards.ports)))
+            app.start_gang_flash()
+        while not done.is_set():
+            root.update()
+            time.sleep(0.005)
+        root.update()
+    app.job_queue.stop()
+    app.port_watcher.stop()
+    root.destroy()
+    return measured, latencies, len(failed)
+
+
+def run_stations(workdir, config, boards, stations):
+    """Spread the boards over localhost flash agents and flash them with the coordinator's run_batch"""
+    from flash_core import GangFlasher, make_engine, images_from_config, DEFAULT_BAUD
+    from flash_agent import FlashAgent, AgentClient, serve, run_batch
+    
+    infos = boards.comports()
+    agents = []
+    servers = []
+    for index in range(stations):
+        mine = infos[index::stations]
+        directory = os.path.join(workdir, f"station{index}")
+        agent = FlashAgent(directory, lambda on_event: GangFlasher(
+                               config["esptool_path"], [], len(mine) or 1, DEFAULT_BAUD, on_event,
+                               engine=make_engine(config["esptool_path"], "subprocess")),
+                           list_ports=lambda mine=mine: mine, name=f"station{index}")
+        agent.start()
+        agents.append(agent)
+        servers.append(serve(agent, "127.0.0.1", 0))
+    clients = [AgentClient("http://127.0.0.1:%d" % server.server_address[1]) for server in servers]
+    try:
+        with Measurement() as measured:
+            finished = run_batch(clients, images_from_config(config), "benchmark", poll=0.05)
+    finally:
+        for server, agent in zip(servers, agents):
+            server.shutdown()
+            agent.stop()
+    jobs = [job for station in finished.values() for job in station]
+    latencies = [job["finished"] - job["created"] for job in jobs]
+    return measured, latencies, sum(1 for job in jobs if job["state"] != "done")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              universal_newlines=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmark(mode, board_count, speed, recording=None, stations=2):
+    """One benchmark run on fresh virtual boards and a scratch directory; returns the report dict"""
+    import serial.tools.list_ports
+    os.environ["FAKE_ESPTOOL_SPEED"] = str(speed)
+    if recording:
+        os.environ["FAKE_ESPTOOL_RECORDING"] = os.path.abspath(recording)
+    workdir = tempfile.mkdtemp(prefix="esp32flasher-bench-")
+    boards = VirtualBoards(board_count)
+    # Port enumeration sees the virtual boards instead of real hardware
+    serial.tools.list_ports.comports = boards.comports
+    counter = LineCounter()
+    counter.install()
+    try:
+        config = make_images(workdir)
+        config["esptool_path"] = make_esptool_wrapper(workdir)
+        if mode == "stations":
+            measured, latencies, failed = run_stations(workdir, config, boards, stations)
+        else:
+            runner = run_gui if mode == "gui" else run_headless
+            measured, latencies, failed = runner(workdir, config, boards)
+    finally:
+        boards.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "mode": mode,
+        "boards": board_count,
+        "speed": speed,
+        "failed": failed,
+        "wall_s": round(measured.wall, 3),
+        "cpu_s": round(measured.cpu, 3),
+        "esptool_cpu_s": round(measured.children_cpu, 3),
+        "peak_rss_mb": round(measured.peak_rss_mb, 1),
+        "lines": counter.lines,
+        "lines_per_s": round(counter.lines / measured.wall, 1) if measured.wall else None,
+        "serial_bytes": boards.received,
+        "latency_p50_s": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "latency_p95_s": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "latency_max_s": round(max(latencies), 3) if latencies else None,
+    }
+
+
+def print_report(report):
+    print(f"{report['mode']:8} {report['boards']:3} board(s): wall {report['wall_s']:.2f} s, "
+          f"cpu {report['cpu_s']:.2f} s (+{report['esptool_cpu_s']:.2f} s esptool), "
+          f"peak {report['peak_rss_mb']:.0f} MB, {report['lines_per_s']} lines/s, "
+          f"latency p50 {report['latency_p50_s']} s / p95 {report['latency_p95_s']} s"
+          + (f", {report['failed']} FAILED" if report["failed"] else ""), flush=True)
+
+
+def record(args):
+    """Run a real esptool write_flash and save its output lines with timestamps"""
+    from flash_core import build_flash_command, images_from_config, DEFAULT_BAUD
+    with open(args.profile, "r", encoding="utf-8") as f:
+        profile = json.load(f)
+    cmd = build_flash_command(args.esptool, args.port, images_from_config(profile), args.baud or DEFAULT_BAUD)
+    started = time.monotonic()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+    with open(args.output, "w", encoding="utf-8") as out:
+        for line in process.stdout:
+            out.write(json.dumps({"t": round(time.monotonic() - started, 4), "line": line.rstrip()}) + "\n")
+        process.wait()
+        out.write(json.dumps({"t": round(time.monotonic() - started, 4), "line": "", "exit": process.returncode}) + "\n")
+    print(f"Recorded {args.output} (exit code {process.returncode})")
+    return process.returncode
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["record"]:
+        parser = argparse.ArgumentParser(prog="benchmark.py record", description="record real esptool output")
+        parser.add_argument("--esptool", required=True)
+        parser.add_argument("--port", required=True)
+        parser.add_argument("--profile", default=os.path.join(HERE, "config.json"))
+        parser.add_argument("--baud", type=int, default=None)
+        parser.add_argument("-o", "--output", required=True)
+        return record(parser.parse_args(argv[1:]))
+    
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="ESP32 Flasher overhead benchmark")
+    parser.add_argument("--boards", type=int, nargs="+", default=[1, 4], help="simulated board counts to run")
+    parser.add_argument("--mode", choices=["headless", "gui", "both", "stations"], default="headless")
+    parser.add_argument("--stations", type=int, default=2, help="localhost flash agents for --mode stations")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="fake esptool time scale: 1.0 real pace, 0 as fast as possible")
+    parser.add_argument("--recording", default=None, help="replay this recording instead of synthetic output")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default=None, help="append results as JSON lines to this file")
+    args = parser.parse_args(argv)
+    
+    if not hasattr(os, "openpty"):
+        print("Error: the benchmark needs pty support (Linux or macOS)", file=sys.stderr)
+        return 2
+    sys.path.insert(0, HERE)
+    modes = ["headless", "gui"] if args.mode == "both" else [args.mode]
+    xvfb = None
+    if "gui" in modes:
+        try:
+            xvfb = start_virtual_display()
+        except RuntimeError as e:
+            print(f"Skipping GUI runs: {e}", file=sys.stderr)
+            modes.remove("gui")
+    
+    failed = 0
+    try:
+        for mode in modes:
+            for count in args.boards:
+                for _ in range(args.repeat):
+                    report = run_benchmark(mode, count, args.speed, args.recording, args.stations)
+                    print_report(report)
+                    failed += report["failed"]
+                    if args.output:
+                        with open(args.output, "a", encoding="utf-8") as f:
+                            f.write(json.dumps(report) + "\n")
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Boot smoke test after a flash: does the new firmware actually come up?
+
+The board is reset once more with the port open at the application's console
+baud, and the boot log is read until every expected banner has been seen, a
+panic signature shows up, or the timeout runs out. More than one ROM reset
+line ("rst:0x...") means the firmware is crash-looping. Without expected
+banners the board passes if it stays quiet for the settle time.
+
+Settings come from the "boot_check" object in config.json:
+
+    "boot_check": {"enabled": true, "baud": 115200, "timeout": 10,
+                   "expect": ["LoRa init OK"], "panic": ["E (", "SX1262 not found"]}
+"""
+import re
+import time
+
+DEFAULT_BAUD = 115200
+DEFAULT_TIMEOUT = 10.0
+# Seconds without trouble that count as a good boot when no banner is expected
+DEFAULT_SETTLE = 3.0
+# Lines of boot log kept with the result
+KEEP_LINES = 40
+# Boot checks run at once, next to the flashes
+DEFAULT_WORKERS = 4
+
+# Boot log text that means the firmware crashed
+PANIC_SIGNATURES = [
+    "Guru Meditation Error",
+    "abort() was called",
+    "Backtrace:",
+    "Brownout detector was triggered",
+    "Task watchdog got triggered",
+    "Stack canary watchpoint triggered",
+    "CORRUPT HEAP",
+    "assert failed",
+    "invalid header: 0x",
+    "flash read err",
+]
+
+RESET_RE = re.compile(r"^rst:0x[0-9a-fA-F]+ \((\w+)\)")
+# ROM resets seen in one boot log before it counts as a reset loop
+MAX_RESETS = 1
+
+
+class BootCheckResult:
+    """Outcome of one boot check"""
+    
+    def __init__(self, port, passed, reason, lines, duration):
+        self.port = port
+        self.passed = passed
+        self.reason = reason
+        self.lines = lines
+        self.duration = duration
+
+
+class BootCheck:
+    """Reads a board's boot log and decides whether the firmware came up"""
+    
+    def __init__(self, baud=DEFAULT_BAUD, timeout=DEFAULT_TIMEOUT, expect=None, panic=None,
+                 settle=DEFAULT_SETTLE, reset=True):
+        self.baud = int(baud)
+        self.timeout = float(timeout)
+        self.expect = list(expect or [])
+        self.panic = PANIC_SIGNATURES + list(panic or [])
+        self.settle = float(settle)
+        self.reset = reset
+    
+    @classmethod
+    def from_config(cls, config):
+        """Return a BootCheck for a config.json style dict, or None if it is disabled"""
+        settings = config.get("boot_check") or {}
+        if not settings.get("enabled", False):
+            return None
+        return cls(baud=settings.get("baud", DEFAULT_BAUD), timeout=settings.get("timeout", DEFAULT_TIMEOUT),
+                   expect=settings.get("expect"), panic=settings.get("panic"),
+                   settle=settings.get("settle", DEFAULT_SETTLE), reset=settings.get("reset", True))
+    
+    def run(self, port, on_line=None):
+        """Check the board on port and return a BootCheckResult; never raises"""
+        import serial
+        started = time.monotonic()
+        lines = []
+        try:
+            connection = serial.Serial()
+            connection.port = port
+            connection.baudrate = self.baud
+            connection.timeout = 0.1
+            # Keep EN and IO0 released while opening so the board is not held in reset
+            connection.dtr = False
+            connection.rts = False
+            connection.open()
+        except Exception as e:
+            return BootCheckResult(port, False, f"could not open port: {e}", lines, time.monotonic() - started)
+        try:
+            if self.reset:
+                # Pulse EN so the whole boot log, from the ROM banner on, is captured
+                connection.reset_input_buffer()
+                connection.rts = True
+                time.sleep(0.1)
+                connection.rts = False
+            passed, reason = self._watch(connection, lines, on_line)
+        except Exception as e:
+            passed, reason = False, f"serial error: {e}"
+        finally:
+            connection.close()
+        return BootCheckResult(port, passed, reason, lines[-KEEP_LINES:], time.monotonic() - started)
+    
+    def check_result(self, result, on_line=None):
+        """Boot-check the board of a successful FlashResult and record the outcome on it"""
+        result.boot = self.run(result.port, on_line)
+        if not result.boot.passed:
+            result.error = f"Boot check failed: {result.boot.reason}"
+        return result
+    
+    def _watch(self, connection, lines, on_line):
+        deadline = time.monotonic() + self.timeout
+        settled = time.monotonic() + self.settle
+        waiting = list(self.expect)
+        resets = 0
+        pending = b""
+        while True:
+            now = time.monotonic()
+            if not waiting and (self.expect or now >= min(settled, deadline)):
+                return True, "all expected banners seen" if self.expect else f"no crash in {self.settle:g} s"
+            if now >= deadline:
+                return False, "timed out waiting for " + ", ".join(f"'{text}'" for text in waiting)
+            pending += connection.read(connection.in_waiting or 1)
+            *complete, pending = pending.split(b"\n")
+            for raw in complete:
+                line = raw.decode("utf-8", "replace").rstrip("\r")
+                lines.append(line)
+                if on_line:
+                    on_line(line)
+                for signature in self.panic:
+                    if signature in line:
+                        return False, f"panic: {line.strip()}"
+                if RESET_RE.match(line):
+                    resets += 1
+                    if resets > MAX_RESETS:
+                        return False, f"reset loop ({RESET_RE.match(line).group(1)})"
+                waiting = [text for text in waiting if text not in line]
@@ -0,0 +1,229 @@
+"""
+Watch a build output folder and stage each new firmware as soon as it is complete.
+
+Arduino writes <sketch>.ino.bootloader.bin, <sketch>.ino.partitions.bin and
+<sketch>.ino.bin into the build (or export) folder; boot_app0.bin is taken
+from the same folder when it is there, otherwise the profile's file is kept.
+BuildWatcher waits for file-change notifications (with the watchdog package
+when installed, polling otherwise) and only takes a set once none of its
+files has changed for a debounce period, so half-written files are never
+used. The set is then copied into a staging folder named after its content
+hash, and that snapshot (not the build folder, which the next build rewrites
+in place) is checked with image_check, gets its flash bundle built in the
+background and is what every later flash uses. The next board flashes the
+new build without any preparation in the flash path.
+"""
+import os
+import glob
+import time
+import shutil
+import threading
+
+from image_check import check_bundle
+from bundle_cache import BundleError, bundle_key
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+POLL_INTERVAL = 1.0
+# Seconds the files must stay unchanged before a build is taken
+DEBOUNCE = 2.0
+
+SKETCH_SUFFIXES = {
+    "bootloader_path": ".ino.bootloader.bin",
+    "partitions_path": ".ino.partitions.bin",
+    "app_bin_path": ".ino.bin",
+}
+BOOT_APP0_NAME = "boot_app0.bin"
+# Staged snapshots kept besides the newest (older ones may still be flashing)
+KEEP_SNAPSHOTS = 4
+
+
+def find_build_artifacts(directory, boot_app0_path=None):
+    """Return {config key: path} for the newest complete build in directory, or None
+    
+    boot_app0_path is used when the folder has no boot_app0.bin of its own.
+    """
+    apps = [path for path in glob.glob(os.path.join(directory, "*" + SKETCH_SUFFIXES["app_bin_path"]))
+            if not path.endswith((".bootloader.bin", ".partitions.bin", ".merged.bin"))]
+    apps.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+    for app in apps:
+        sketch = app[:-len(SKETCH_SUFFIXES["app_bin_path"])]
+        artifacts = dict((key, sketch + suffix) for key, suffix in SKETCH_SUFFIXES.items())
+        if not all(os.path.isfile(path) for path in artifacts.values()):
+            continue
+        boot_app0 = os.path.join(directory, BOOT_APP0_NAME)
+        artifacts["boot_app0_path"] = boot_app0 if os.path.isfile(boot_app0) else boot_app0_path
+        if artifacts["boot_app0_path"] and os.path.isfile(artifacts["boot_app0_path"]):
+            return artifacts
+    return None
+
+
+def signature(artifacts):
+    """(path, size, mtime) of every file; changes whenever any file is rewritten"""
+    result = []
+    for key in sorted(artifacts):
+        stat = os.stat(artifacts[key])
+        result.append((artifacts[key], stat.st_size, stat.st_mtime_ns))
+    return tuple(result)
+
+
+def snapshot_build(artifacts, staging_dir):
+    """Copy a build into staging_dir/<bundle key>/ and return {config key: copied path}"""
+    from flash_core import images_from_config
+    os.makedirs(staging_dir, exist_ok=True)
+    tmp_dir = os.path.join(staging_dir, f"tmp{os.getpid()}-{threading.get_ident()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        copied = {}
+        for key, path in artifacts.items():
+            copied[key] = os.path.join(tmp_dir, os.path.basename(path))
+            shutil.copy2(path, copied[key])
+        directory = os.path.join(staging_dir, bundle_key(images_from_config(copied)))
+        if not os.path.isdir(directory):
+            try:
+                os.replace(tmp_dir, directory)
+            except OSError:
+                # Staged by someone else in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        os.utime(directory)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return dict((key, os.path.join(directory, os.path.basename(path))) for key, path in copied.items())
+
+
+def prune_snapshots(staging_dir, keep=KEEP_SNAPSHOTS):
+    """Remove all but the newest keep + 1 snapshots in staging_dir"""
+    try:
+        names = [name for name in os.listdir(staging_dir)
+                 if not name.startswith("tmp") and os.path.isdir(os.path.join(staging_dir, name))]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(staging_dir, name)), reverse=True)
+    except OSError:
+        return
+    for name in names[keep + 1:]:
+        shutil.rmtree(os.path.join(staging_dir, name), ignore_errors=True)
+
+
+def stage_build(artifacts, bundle_cache=None):
+    """Check a build and prepare its flash bundle; returns (errors, warnings)"""
+    from flash_core import images_from_config
+    images = images_from_config(artifacts)
+    errors, warnings = check_bundle(images)
+    if not errors and bundle_cache is not None:
+        try:
+            bundle_cache.get(images)
+        except (BundleError, OSError) as e:
+            errors.append(f"Could not prepare the flash bundle: {e}")
+    return errors, warnings
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, changed):
+        self.changed = changed
+    
+    def on_any_event(self, event):
+        self.changed.set()
+
+
+class BuildWatcher:
+    """Background thread that stages every new complete build in a folder
+    
+    on_event(kind, value) is called from the watcher thread with kind one of
+    "staged" (value is the {config key: path} dict of the snapshot in
+    staging_dir, ready to flash),
+    "invalid" (value is the list of errors) or "warning" (value is the
+    message). The build already in the folder when the watcher starts is
+    staged too.
+    """
+    
+    def __init__(self, directory, on_event, staging_dir, bundle_cache=None, boot_app0_path=None,
+                 debounce=DEBOUNCE, interval=POLL_INTERVAL, use_watchdog=True):
+        self.directory = directory
+        self.on_event = on_event
+        self.staging_dir = staging_dir
+        self.bundle_cache = bundle_cache
+        self.boot_app0_path = boot_app0_path
+        self.debounce = debounce
+        self.interval = interval
+        self.use_watchdog = use_watchdog and Observer is not None
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._candidate = None      # (signature, first seen) of a set that may still be written
+        self._taken = None          # signature of the last set staged or rejected
+        self._observer = None
+        self._thread = None
+    
+    @property
+    def mode(self):
+        return "notifications" if self.use_watchdog else "polling"
+    
+    def start(self):
+        if self.use_watchdog:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_ChangeHandler(self._changed), self.directory, recursive=False)
+                self._observer.start()
+            except Exception as e:
+                print(f"Warning: File notifications unavailable, polling the build folder instead: {e}")
+                self._observer = None
+                self.use_watchdog = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._changed.set()
+        if self._observer is not None:
+            self._observer.stop()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._check(time.monotonic())
+            except OSError:
+                # A file vanished between listing and stat (the build is rewriting it)
+                self._candidate = None
+            if self._candidate is not None:
+                # Come back when the debounce period is over
+                self._stop.wait(self.debounce / 4.0)
+            elif self.use_watchdog:
+                # A slow fallback poll still catches anything that was not reported
+                self._changed.wait(self.interval * 10)
+                self._changed.clear()
+            else:
+                self._stop.wait(self.interval)
+    
+    def _check(self, now):
+        artifacts = find_build_artifacts(self.directory, self.boot_app0_path)
+        if artifacts is None:
+            self._candidate = None
+            return
+        current = signature(artifacts)
+        if current == self._taken:
+            self._candidate = None
+            return
+        if self._candidate is None or self._candidate[0] != current:
+            self._candidate = (current, now)
+            return
+        if now - self._candidate[1] < self.debounce:
+            return
+        self._candidate = None
+        snapshot = snapshot_build(artifacts, self.staging_dir)
+        # Files rewritten while copying: wait for the next quiet period
+        if signature(artifacts) != current:
+            return
+        self._taken = current
+        errors, warnings = stage_build(snapshot, self.bundle_cache)
+        for warning in warnings:
+            self.on_event("warning", warning)
+        if errors:
+            self.on_event("invalid", errors)
+        else:
+            self.on_event("staged", snapshot)
+        prune_snapshots(self.staging_dir)
@@ -0,0 +1,344 @@
+"""
+Content-addressed cache of prepared flash bundles.
+
+A bundle is built once per distinct set of input images: the files are
+checked, regions that touch the same flash sector are merged into a single
+segment, and each segment is stored both raw and zlib-compressed (the same
+deflate stream esptool sends with -z). Sectors of a segment that are all
+0xFF only need erasing, so the compressed data is kept per write range, the
+runs of non-blank sectors between them (see sparse_ranges). Bundles live in
+<cache dir>/<sha256 of inputs>/ and the least recently used ones are
+evicted when the cache grows past its limits. A bundle that a flash in this
+process holds, or that any process used in the last few minutes, is never
+evicted; the cache shrinks on a later pass instead.
+"""
+import os
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import threading
+
+from flash_manifest import cached_file_sha256
+
+SECTOR_SIZE = 0x1000
+DEFAULT_MAX_ENTRIES = 16
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+META_FILE = "bundle.json"
+# Bumped when the bundle layout changes; older bundles are rebuilt
+META_VERSION = 2
+BLANK_SECTOR = b"\xff" * SECTOR_SIZE
+# Rough SPI flash page program rate (0.7 ms per 256-byte page) for estimating skipped writes
+PROGRAM_BYTES_PER_SECOND = 360 * 1024
+# Bundles used this recently may still be flashing in another process (get() touches them)
+IN_USE_GRACE = 10 * 60
+
+
+class BundleError(Exception):
+    """The selected images cannot be combined into a flash bundle"""
+
+
+def bundle_key(images):
+    """Return the cache key for [(offset, path)]: a hash over offsets and file contents"""
+    digest = hashlib.sha256()
+    for offset, path in sorted(images):
+        digest.update(f"{offset:08x}:{cached_file_sha256(path)}\n".encode("ascii"))
+    return digest.hexdigest()
+
+
+def check_images(images):
+    """Raise BundleError unless the images exist, are non-empty and do not overlap"""
+    previous_end = 0
+    previous_name = None
+    for offset, path in sorted(images):
+        name = os.path.basename(path)
+        if not path or not os.path.isfile(path):
+            raise BundleError(f"Image for 0x{offset:x} not found: {path}")
+        size = os.path.getsize(path)
+        if size == 0:
+            raise BundleError(f"{name} is empty")
+        if offset % 4:
+            raise BundleError(f"Offset 0x{offset:x} of {name} is not 4-byte aligned")
+        if offset < previous_end:
+            raise BundleError(f"{name} at 0x{offset:x} overlaps {previous_name} (ends at 0x{previous_end:x})")
+        previous_end = offset + size
+        previous_name = name
+
+
+def plan_segments(images):
+    """Group [(offset, path)] into [(offset, [(offset, path), ...])] segments
+    
+    Regions are only merged when the next one starts inside the last flash
+    sector the previous one touches. That sector is erased by the write anyway,
+    so padding it with 0xFF never clobbers data that lives between regions
+    (such as the NVS partition between the partition table and boot_app0).
+    """
+    segments = []
+    end = None
+    for offset, path in sorted(images):
+        size = os.path.getsize(path)
+        sector_end = (end + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE if end is not None else None
+        if segments and offset <= sector_end:
+            segments[-1][1].append((offset, path))
+        else:
+            segments.append((offset, [(offset, path)]))
+        end = offset + size
+    return segments
+
+
+def sparse_ranges(data, start):
+    """Split data written at flash address start into ([(offset, size)] to write, [(offset, size)] blank)
+    
+    Data is looked at in whole flash sectors: a sector that is all 0xFF only
+    has to be erased, so it is left out of the write ranges. A blank sector
+    at the end may be partial; erasing it is what writing it would do. The
+    partial sector before the first sector boundary is always written.
+    """
+    ranges = ([], [])
+    pos = 0
+    while pos < len(data):
+        end = min(len(data), (start + pos) // SECTOR_SIZE * SECTOR_SIZE + SECTOR_SIZE - start)
+        blank = (start + pos) % SECTOR_SIZE == 0 and data[pos:end] == BLANK_SECTOR[:end - pos]
+        kind = ranges[1] if blank else ranges[0]
+        if kind and kind[-1][0] + kind[-1][1] == start + pos:
+            kind[-1] = (kind[-1][0], kind[-1][1] + end - pos)
+        else:
+            kind.append((start + pos, end - pos))
+        pos = end
+    return ranges
+
+
+def estimate_seconds_saved(blank_bytes, compressed_saved, baud):
+    """Rough time a sparse write saves: compressed bytes not sent plus pages not programmed"""
+    return compressed_saved * 10.0 / baud + blank_bytes / float(PROGRAM_BYTES_PER_SECOND)
+
+
+class FlashBundle:
+    """A prepared bundle: a few segments, each with a raw file and compressed write ranges"""
+    
+    def __init__(self, key, directory, meta):
+        self.key = key
+        self.directory = directory
+        self.meta = meta
+    
+    @property
+    def segments(self):
+        """[(offset, raw path)] ready to hand to write_flash"""
+        return [(segment["offset"], os.path.join(self.directory, segment["file"]))
+                for segment in self.meta["segments"]]
+    
+    @property
+    def compressed_segments(self):
+        """[(offset, size, md5 of raw data, [(offset, size, compressed path)] to write, [(offset, size)] blank)]"""
+        result = []
+        for segment in self.meta["segments"]:
+            if "ranges" in segment:
+                ranges = [(item["offset"], item["size"], os.path.join(self.directory, item["compressed_file"]))
+                          for item in segment["ranges"]]
+            else:
+                ranges = [(segment["offset"], segment["size"],
+                           os.path.join(self.directory, segment["compressed_file"]))]
+            result.append((segment["offset"], segment["size"], segment["md5"], ranges,
+                           [tuple(blank) for blank in segment.get("blank", [])]))
+        return result
+    
+    def subset(self, offsets):
+        """The same bundle restricted to the segments starting at offsets"""
+        meta = dict(self.meta)
+        meta["segments"] = [segment for segment in self.meta["segments"] if segment["offset"] in offsets]
+        return FlashBundle(self.key, self.directory, meta)
+    
+    def with_images(self, images):
+        """The same bundle plus per-board [(offset, path)] regions, kept out of the cache
+        
+        Each region's compressed data is read from path + ".z" when that file
+        exists, otherwise it is written there first.
+        """
+        meta = dict(self.meta)
+        meta["segments"] = list(self.meta["segments"])
+        for offset, path in images:
+            with open(path, "rb") as f:
+                data = f.read()
+            compressed_path = path + ".z"
+            if os.path.exists(compressed_path):
+                compressed_size = os.path.getsize(compressed_path)
+            else:
+                compressed = zlib.compress(data, 9)
+                with open(compressed_path, "wb") as f:
+                    f.write(compressed)
+                compressed_size = len(compressed)
+            meta["segments"].append({
+                "offset": offset,
+                "file": os.path.abspath(path),
+                "compressed_file": os.path.abspath(compressed_path),
+                "size": len(data),
+                "compressed_size": compressed_size,
+                "md5": hashlib.md5(data).hexdigest(),
+                "regions": [hex(offset)],
+            })
+        meta["segments"].sort(key=lambda segment: segment["offset"])
+        return FlashBundle(self.key, self.directory, meta)
+    
+    @property
+    def total_size(self):
+        return sum(segment["size"] for segment in self.meta["segments"])
+    
+    @property
+    def compressed_size(self):
+        return sum(segment["compressed_size"] for segment in self.meta["segments"])
+    
+    @property
+    def blank_size(self):
+        """Bytes in all-0xFF sectors that are erased but not sent"""
+        return sum(size for segment in self.meta["segments"] for _, size in segment.get("blank", []))
+    
+    @property
+    def compressed_saved(self):
+        """Compressed bytes the blank sectors would have added to the transfer"""
+        return sum(segment.get("compressed_saved", 0) for segment in self.meta["segments"])
+
+
+class BundleCache:
+    """On-disk bundle cache keyed by the hash of the input images, with LRU eviction"""
+    
+    def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._loaded = {}  # key -> FlashBundle already read this session
+        self._holds = {}  # key -> flashes in this process still reading the bundle
+        self._evict_pending = False
+    
+    def get(self, images, hold=False):
+        """Return the FlashBundle for images, building and caching it if needed
+        
+        With hold, the bundle is not evicted until release(bundle) is called.
+        """
+        images = [(offset, path) for offset, path in images]
+        check_images(images)
+        key = bundle_key(images)
+        with self._lock:
+            bundle = self._loaded.get(key)
+            if bundle is None or not os.path.isdir(bundle.directory):
+                bundle = self._load(key) or self._build(key, images)
+                self._loaded[key] = bundle
+            self._touch(bundle)
+            if hold:
+                self._holds[key] = self._holds.get(key, 0) + 1
+        return bundle
+    
+    def release(self, bundle):
+        """Drop a hold taken with get(hold=True); a deferred eviction runs once nothing is held"""
+        with self._lock:
+            count = self._holds.get(bundle.key, 0) - 1
+            if count > 0:
+                self._holds[bundle.key] = count
+                return
+            self._holds.pop(bundle.key, None)
+            if self._evict_pending and not self._holds:
+                try:
+                    self._evict()
+                except OSError as e:
+                    print(f"Warning: Could not trim the bundle cache: {e}")
+    
+    def _load(self, key):
+        directory = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(directory, META_FILE), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != META_VERSION:
+            return None
+        bundle = FlashBundle(key, directory, meta)
+        for _, raw_path in bundle.segments:
+            if not os.path.exists(raw_path):
+                return None
+        return bundle
+    
+    def _build(self, key, images):
+        os.makedirs(self.directory, exist_ok=True)
+        directory = os.path.join(self.directory, key)
+        tmp_dir = directory + f".tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        
+        meta = {"version": META_VERSION, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "inputs": [], "segments": []}
+        for offset, path in sorted(images):
+            meta["inputs"].append({"offset": offset, "file": os.path.basename(path),
+                                   "sha256": cached_file_sha256(path)})
+        
+        for start, members in plan_segments(images):
+            data = bytearray()
+            for offset, path in members:
+                data.extend(b"\xff" * (offset - start - len(data)))
+                with open(path, "rb") as f:
+                    data.extend(f.read())
+            data = bytes(data)
+            name = f"segment_0x{start:x}.bin"
+            with open(os.path.join(tmp_dir, name), "wb") as f:
+                f.write(data)
+            to_write, blank = sparse_ranges(data, start)
+            ranges = []
+            for offset, size in to_write:
+                compressed = zlib.compress(data[offset - start:offset - start + size], 9)
+                range_name = f"{name}.0x{offset:x}.z"
+                with open(os.path.join(tmp_dir, range_name), "wb") as f:
+                    f.write(compressed)
+                ranges.append({"offset": offset, "size": size, "compressed_file": range_name,
+                               "compressed_size": len(compressed)})
+            compressed_size = sum(item["compressed_size"] for item in ranges)
+            meta["segments"].append({
+                "offset": start,
+                "file": name,
+                "size": len(data),
+                "compressed_size": compressed_size,
+                "compressed_saved": len(zlib.compress(data, 9)) - compressed_size if blank else 0,
+                "md5": hashlib.md5(data).hexdigest(),
+                "regions": [hex(offset) for offset, _ in members],
+                "ranges": ranges,
+                "blank": blank,
+            })
+        
+        with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=4)
+        os.replace(tmp_dir, directory)
+        self._evict(keep=key)
+        return FlashBundle(key, directory, meta)
+    
+    def _touch(self, bundle):
+        try:
+            os.utime(os.path.join(bundle.directory, META_FILE))
+        except OSError:
+            pass
+    
+    def _evict(self, keep=None):
+        """Remove least recently used bundles until the cache is within its limits"""
+        entries = []
+        for name in os.listdir(self.directory):
+            directory = os.path.join(self.directory, name)
+            meta_path = os.path.join(directory, META_FILE)
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+            entries.append((os.path.getmtime(meta_path), name, size))
+        entries.sort()
+        
+        count = len(entries)
+        total = sum(size for _, _, size in entries)
+        recent = time.time() - IN_USE_GRACE
+        self._evict_pending = False
+        for used, name, size in entries:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            if name == keep or self._holds.get(name) or used > recent:
+                # Still (maybe) being flashed from: try again later
+                self._evict_pending = True
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            self._loaded.pop(name, None)
+            count -= 1
+            total -= size
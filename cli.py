@@ -0,0 +1,645 @@
+"""
+Headless command line mode for fixture PCs and CI runners.
+
+    python main.py flash --port COM5 --profile config.json
+    python main.py flash --port COM5 --port COM6 --jobs 2
+    python main.py watch --profile config.json
+    python main.py queue add --port COM5 --port COM6
+    python main.py queue run
+    python main.py agent --listen 0.0.0.0:8765 --token secret
+    python main.py coordinate --agent station1:8765 --agent station2:8765 --token secret
+    python main.py provision --units units.csv
+    python main.py sparse --profile config.json
+    python main.py history --since 8
+    python main.py ports
+
+Profiles use the same format as config.json. Only argparse is imported up
+front; flashing modules and pyserial are imported by the command that needs
+them, and tkinter is never imported.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FLASH_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CONFIG = 3
+EXIT_NO_ESPTOOL = 4
+EXIT_NO_PORT = 5
+
+# Time from interpreter start of main.py to command dispatch
+STARTUP_BUDGET_MS = 150
+
+
+class ConfigError(Exception):
+    """The profile is missing, unreadable or incomplete"""
+
+
+def app_dir():
+    """Directory of the script or frozen executable (where config.json lives)"""
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def load_profile(path):
+    """Load a config.json style profile"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            profile = json.load(f)
+    except OSError as e:
+        raise ConfigError(f"Could not read profile {path}: {e}")
+    except ValueError as e:
+        raise ConfigError(f"Profile {path} is not valid JSON: {e}")
+    if not isinstance(profile, dict):
+        raise ConfigError(f"Profile {path} must be a JSON object")
+    return profile
+
+
+def resolve_esptool(profile, override=None):
+    """Return the esptool to use: --esptool, then the profile, then auto-detection"""
+    if override:
+        return override
+    path = profile.get("esptool_path")
+    if path and (path == "esptool.py" or os.path.exists(path)):
+        return path
+    from esptool_locator import find_esptool
+    return find_esptool(os.path.join(app_dir(), "esptool_cache.json"))
+
+
+def add_flash_options(parser):
+    """Options shared by the commands that flash boards"""
+    parser.add_argument("--profile", default=None,
+                        help="config.json style profile (default: config.json next to main.py)")
+    parser.add_argument("--esptool", default=None, help="esptool path, overrides the profile")
+    parser.add_argument("--baud", type=int, default=None, help="fixed baud rate (default: adaptive, starting at 921600)")
+    parser.add_argument("--jobs", type=int, default=None, help="boards flashed at once (default 4)")
+    parser.add_argument("--incremental", action="store_true", default=None,
+                        help="only write regions changed since the board's last flash")
+    parser.add_argument("--verify-skipped", action="store_true", default=None,
+                        help="confirm skipped regions with an on-device MD5 check")
+    parser.add_argument("--no-bundle-cache", action="store_true", help="flash the files directly")
+    parser.add_argument("--engine", choices=["auto", "subprocess", "inprocess"], default=None,
+                        help="run esptool in-process or as a subprocess (default: profile, then auto)")
+    parser.add_argument("--boot-check", action="store_true", default=None,
+                        help="check each board boots after flashing (settings: \"boot_check\" in the profile)")
+    add_provision_options(parser)
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the result")
+
+
+def add_provision_options(parser):
+    parser.add_argument("--units", default=None,
+                        help="CSV or JSON list of units; each board gets the next unit's NVS partition")
+    parser.add_argument("--namespace", default=None, help="NVS namespace of the unit data (default: device)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="ESP32 Flasher (headless mode)")
+    parser.add_argument("--timing", action="store_true",
+                        help="report startup time against the %d ms budget" % STARTUP_BUDGET_MS)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+    
+    flash = commands.add_parser("flash", help="flash one or more boards")
+    flash.add_argument("--port", action="append", required=True,
+                       help="serial port; repeat to flash several boards in parallel")
+    add_flash_options(flash)
+    flash.set_defaults(handler=cmd_flash)
+    
+    watch = commands.add_parser("watch", help="flash every ESP32 board that is plugged in, until Ctrl+C")
+    watch.add_argument("--present", action="store_true", help="also flash ESP32 boards already attached")
+    watch.add_argument("--build-dir", default=None,
+                       help="switch to every new complete build that appears in this folder")
+    add_flash_options(watch)
+    watch.set_defaults(handler=cmd_watch)
+    
+    queue = commands.add_parser("queue", help="persistent flash job queue with retries")
+    actions = queue.add_subparsers(dest="action", metavar="action")
+    actions.required = True
+    queue_add = actions.add_parser("add", help="queue boards to flash with the profile's images")
+    queue_add.add_argument("--port", action="append", required=True, help="serial port; repeat for several boards")
+    queue_add.add_argument("--profile", default=None,
+                           help="config.json style profile (default: config.json next to main.py)")
+    queue_add.set_defaults(handler=cmd_queue_add)
+    queue_run = actions.add_parser("run", help="flash queued boards until the queue is empty")
+    queue_run.add_argument("--max-per-hub", type=int, default=None, help="boards flashed at once per USB hub (default 4)")
+    add_flash_options(queue_run)
+    queue_run.set_defaults(handler=cmd_queue_run)
+    queue_list = actions.add_parser("list", help="show waiting and finished jobs")
+    queue_list.set_defaults(handler=cmd_queue_list)
+    queue_clear = actions.add_parser("clear", help="drop every waiting job")
+    queue_clear.set_defaults(handler=cmd_queue_clear)
+    
+    agent = commands.add_parser("agent", help="run a flash station that takes jobs over HTTP, until Ctrl+C")
+    agent.add_argument("--listen", default=None, help="host:port to listen on (default 127.0.0.1:8765)")
+    agent.add_argument("--name", default=None, help="station name reported to clients (default: host name)")
+    agent.add_argument("--token", default=None,
+                       help="require this bearer token on every request (needed unless listening on localhost)")
+    agent.add_argument("--firmware-root", default=None,
+                       help="let clients select firmware files under this folder (default: uploads only)")
+    agent.add_argument("--max-per-hub", type=int, default=None, help="boards flashed at once per USB hub (default 4)")
+    add_flash_options(agent)
+    agent.set_defaults(handler=cmd_agent)
+    
+    coordinate = commands.add_parser("coordinate",
+                                     help="flash the profile's images on every ESP32 board of several agents")
+    coordinate.add_argument("--agent", action="append", required=True, help="agent host:port; repeat for each station")
+    coordinate.add_argument("--profile", default=None,
+                            help="config.json style profile with the images (default: config.json next to main.py)")
+    coordinate.add_argument("--token", default=None, help="bearer token of the agents")
+    coordinate.add_argument("-q", "--quiet", action="store_true", help="only print results")
+    coordinate.set_defaults(handler=cmd_coordinate)
+    
+    provision = commands.add_parser("provision", help="generate the NVS images of every unit ahead of flashing")
+    provision.add_argument("--profile", default=None,
+                           help="config.json style profile with the partition table (default: config.json next to main.py)")
+    add_provision_options(provision)
+    provision.set_defaults(handler=cmd_provision)
+    
+    sparse = commands.add_parser("sparse", help="show how much of the profile's images sparse writes skip")
+    sparse.add_argument("--profile", default=None,
+                        help="config.json style profile (default: config.json next to main.py)")
+    sparse.add_argument("--baud", type=int, default=None, help="baud rate used for the time estimate (default 921600)")
+    sparse.set_defaults(handler=cmd_sparse)
+    
+    history = commands.add_parser("history", help="throughput and failure rates from the flash history")
+    history.add_argument("--since", type=float, default=None, help="only the last this many hours")
+    history.add_argument("--bundle", default=None, help="only flashes of the firmware bundle with this hash prefix")
+    history.add_argument("--device", default=None, help="list every flash of the board with this MAC instead")
+    history.set_defaults(handler=cmd_history)
+    
+    ports = commands.add_parser("ports", help="list serial ports")
+    ports.set_defaults(handler=cmd_ports)
+    return parser
+
+
+def cmd_ports(args):
+    import serial.tools.list_ports
+    for port in serial.tools.list_ports.comports():
+        vid_pid = f"{port.vid:04X}:{port.pid:04X}" if port.vid is not None else "-"
+        print(f"{port.device}\t{vid_pid}\t{port.description}")
+    return EXIT_OK
+
+
+def load_flash_profile(args):
+    """Load the profile and return (profile, images); every image must exist"""
+    profile_path = args.profile or os.path.join(app_dir(), "config.json")
+    profile = load_profile(profile_path)
+    
+    from flash_core import FLASH_REGIONS, images_from_config
+    for offset, key, name in FLASH_REGIONS:
+        path = profile.get(key)
+        if not path:
+            raise ConfigError(f"{name} ({key}) is not set in {profile_path}")
+        if not os.path.exists(path):
+            raise ConfigError(f"{name} not found: {path}")
+    images = images_from_config(profile)
+    
+    from image_check import check_bundle
+    errors, warnings = check_bundle(images)
+    for warning in warnings:
+        print(f"Warning: {warning}", file=sys.stderr)
+    if errors:
+        raise ConfigError("The images cannot be flashed:\n  " + "\n  ".join(errors))
+    return profile, images
+
+
+def find_flash_tool(args, profile):
+    """Return the esptool to use, or None after printing an error"""
+    esptool_path = resolve_esptool(profile, args.esptool)
+    if not esptool_path:
+        from esptool_engine import esptool_installed
+        if esptool_installed():
+            esptool_path = "esptool.py"
+    if not esptool_path:
+        print("Error: esptool not found. Install it with: pip install esptool", file=sys.stderr)
+    return esptool_path
+
+
+def make_provisioner(args, profile):
+    """Return a Provisioner with every unit's image generated, or None without a units file"""
+    settings = dict(profile.get("provisioning") or {})
+    if args.units:
+        settings["units"] = args.units
+    if args.namespace:
+        settings["namespace"] = args.namespace
+    if not settings.get("units"):
+        return None
+    from nvs_provision import Provisioner, ProvisionError
+    started = time.monotonic()
+    try:
+        provisioner = Provisioner.from_config(dict(profile, provisioning=settings),
+                                              os.path.join(app_dir(), "provisioning"))
+        generated, cached = provisioner.prepare()
+    except ProvisionError as e:
+        raise ConfigError(str(e))
+    print(f"NVS provisioning: {len(provisioner.units)} unit(s), {provisioner.remaining} not yet flashed; "
+          f"{generated} image(s) generated, {cached} cached in {time.monotonic() - started:.1f} s "
+          f"(partition '{provisioner.label}' at 0x{provisioner.offset:x})", flush=True)
+    return provisioner
+
+
+def make_flasher(args, profile, images, esptool_path, on_event):
+    """Build a GangFlasher from the profile and the command line options"""
+    from flash_core import GangFlasher, make_engine, DEFAULT_BAUD, DEFAULT_GANG_WORKERS
+    incremental = profile.get("incremental", False) if args.incremental is None else args.incremental
+    verify_skipped = profile.get("verify_skipped", False) if args.verify_skipped is None else args.verify_skipped
+    manifest = None
+    if incremental:
+        from flash_manifest import FlashManifest
+        manifest = FlashManifest(os.path.join(app_dir(), "flash_manifest.json"))
+    bundle_cache = None
+    if profile.get("use_bundle_cache", True) and not args.no_bundle_cache:
+        from bundle_cache import BundleCache
+        bundle_cache = BundleCache(os.path.join(app_dir(), "bundle_cache"))
+    
+    baud = args.baud or DEFAULT_BAUD
+    baud_policy = None
+    if not args.baud and profile.get("adaptive_baud", True):
+        from baud_policy import BaudPolicy
+        baud_policy = BaudPolicy(os.path.join(app_dir(), "baud_stats.json"))
+    
+    metrics = None
+    if profile.get("metrics", True):
+        from flash_metrics import MetricsRecorder
+        metrics = MetricsRecorder(os.path.join(app_dir(), "metrics"))
+    history = None
+    if profile.get("history", True):
+        from flash_history import FlashHistory
+        history = FlashHistory(history_path())
+    
+    from boot_check import BootCheck
+    boot_settings = dict(profile.get("boot_check") or {})
+    if args.boot_check:
+        boot_settings["enabled"] = True
+    boot_check = BootCheck.from_config({"boot_check": boot_settings})
+    
+    engine = make_engine(esptool_path, args.engine or profile.get("engine", "auto"))
+    return GangFlasher(esptool_path, images, args.jobs or DEFAULT_GANG_WORKERS, baud, on_event,
+                       manifest=manifest, verify_skipped=verify_skipped, bundle_cache=bundle_cache,
+                       engine=engine, baud_policy=baud_policy, metrics=metrics, boot_check=boot_check,
+                       provisioner=make_provisioner(args, profile), history=history)
+
+
+def event_printer(args, prefix):
+    """Return an on_event callback that prints esptool output and per-board results"""
+    def on_event(port, kind, value):
+        if kind == "line" and not args.quiet:
+            print(f"[{port}] {value}" if prefix else value, flush=True)
+        elif kind == "skipped":
+            print(f"{port}: SKIPPED ({value})", flush=True)
+        elif kind == "boot_check" and not args.quiet:
+            print(f"[{port}] Checking that the board boots..." if prefix else "Checking that the board boots...",
+                  flush=True)
+        elif kind == "done":
+            status = "PASS" if value.success else "FAIL"
+            reason = "" if value.success else f" ({value.error or 'return code %d' % value.returncode})"
+            rate = f" at {value.baud} baud" if value.baud else ""
+            boot = f", boot OK ({value.boot.reason})" if value.boot and value.boot.passed else ""
+            unit = f", unit {value.unit}" if value.unit else ""
+            print(f"{port}: {status}{reason} in {value.duration:.1f} s{rate}{boot}{unit}", flush=True)
+    
+    return on_event
+
+
+def cmd_flash(args):
+    profile, images = load_flash_profile(args)
+    esptool_path = find_flash_tool(args, profile)
+    if not esptool_path:
+        return EXIT_NO_ESPTOOL
+    
+    import serial.tools.list_ports
+    available = set(port.device for port in serial.tools.list_ports.comports())
+    missing = [port for port in args.port if port not in available]
+    if missing:
+        print(f"Error: port(s) not found: {', '.join(missing)}", file=sys.stderr)
+        return EXIT_NO_PORT
+    
+    flasher = make_flasher(args, profile, images, esptool_path, event_printer(args, len(args.port) > 1))
+    summary = flasher.run(args.port)
+    if len(args.port) > 1:
+        print(f"{len(summary.results)} board(s): {summary.passed} passed, {summary.failed} failed "
+              f"in {summary.elapsed:.1f} s ({summary.boards_per_minute:.1f} boards/min)")
+    return EXIT_OK if summary.failed == 0 else EXIT_FLASH_FAILED
+
+
+def cmd_watch(args):
+    profile, images = load_flash_profile(args)
+    esptool_path = find_flash_tool(args, profile)
+    if not esptool_path:
+        return EXIT_NO_ESPTOOL
+    
+    from flash_core import DEFAULT_GANG_WORKERS
+    from port_watcher import PortWatcher, AutoFlasher, esp32_adapter_name
+    results = []
+    printer = event_printer(args, True)
+    
+    def on_event(port, kind, value):
+        if kind == "done":
+            results.append(value)
+        printer(port, kind, value)
+    
+    flasher = make_flasher(args, profile, images, esptool_path, on_event)
+    auto_flasher = AutoFlasher(lambda: flasher, args.jobs or DEFAULT_GANG_WORKERS, on_event)
+    
+    def on_change(added, removed):
+        for info in added:
+            name = esp32_adapter_name(info)
+            print(f"{info.device}: connected" + (f" ({name})" if name else ""), flush=True)
+        auto_flasher.on_ports_changed(added, removed)
+    
+    build_watcher = None
+    if args.build_dir:
+        from flash_core import images_from_config
+        from build_watcher import BuildWatcher
+        
+        def on_build(kind, value):
+            if kind == "staged":
+                # Boards that start from now on get the new build
+                flasher.images = images_from_config(value)
+                print(f"New build staged: {os.path.basename(value['app_bin_path'])}", flush=True)
+            elif kind == "invalid":
+                print("New build rejected:\n  " + "\n  ".join(value), flush=True)
+            else:
+                print(f"Warning: {value}", file=sys.stderr, flush=True)
+        
+        build_watcher = BuildWatcher(args.build_dir, on_build, os.path.join(app_dir(), "staged_builds"),
+                                     bundle_cache=flasher.bundle_cache,
+                                     boot_app0_path=profile.get("boot_app0_path"))
+        build_watcher.start()
+        print(f"Watching build folder {args.build_dir} ({build_watcher.mode})", flush=True)
+    
+    watcher = PortWatcher(on_change)
+    watcher.start()
+    print(f"Watching for ESP32 boards ({watcher.mode}), press Ctrl+C to stop", flush=True)
+    if args.present:
+        auto_flasher.on_ports_changed(list(watcher.ports.values()), [])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    watcher.stop()
+    if build_watcher is not None:
+        build_watcher.stop()
+    auto_flasher.shutdown()
+    passed = sum(1 for result in results if result.success)
+    print(f"{len(results)} board(s): {passed} passed, {len(results) - passed} failed")
+    return EXIT_OK if passed == len(results) else EXIT_FLASH_FAILED
+
+
+def jobs_path():
+    return os.path.join(app_dir(), "flash_jobs.json")
+
+
+def history_path():
+    return os.path.join(app_dir(), "metrics", "flash_history.db")
+
+
+def cmd_queue_add(args):
+    profile, images = load_flash_profile(args)
+    from job_queue import JobQueue
+    queue = JobQueue(jobs_path(), None)
+    for port in args.port:
+        job = queue.add(port, images)
+        print(f"{port}: queued as {job.id}" if job else f"{port}: already queued")
+    return EXIT_OK
+
+
+def cmd_queue_run(args):
+    profile = load_profile(args.profile or os.path.join(app_dir(), "config.json"))
+    esptool_path = find_flash_tool(args, profile)
+    if not esptool_path:
+        return EXIT_NO_ESPTOOL
+    
+    from flash_core import DEFAULT_GANG_WORKERS
+    from job_queue import JobQueue, DEFAULT_MAX_PER_HUB, DONE, FAILED
+    flasher = make_flasher(args, profile, [], esptool_path, event_printer(args, True))
+    
+    def on_event(job, kind, value):
+        if kind == "retry":
+            print(f"{job.port}: retrying in {value} s (attempt {job.attempts + 1} of {queue.max_attempts})", flush=True)
+    
+    queue = JobQueue(jobs_path(),
+                     lambda job: flasher.flash_port(job.port, job.images, attempt=job.attempts, check_later=True),
+                     args.jobs or DEFAULT_GANG_WORKERS,
+                     args.max_per_hub or profile.get("max_per_hub", DEFAULT_MAX_PER_HUB), on_event=on_event,
+                     check=(lambda job, result: flasher.check_boot(result)) if flasher.boot_check else None)
+    pending = queue.pending()
+    if not pending:
+        print("Queue is empty")
+        return EXIT_OK
+    ids = set(job.id for job in pending)
+    print(f"Running {len(pending)} job(s)", flush=True)
+    queue.start()
+    try:
+        queue.wait_idle()
+    except KeyboardInterrupt:
+        print("Stopped; unfinished jobs stay queued", file=sys.stderr)
+        return EXIT_FLASH_FAILED
+    finally:
+        queue.stop()
+    
+    finished = [job for job in queue.jobs if job.id in ids]
+    passed = sum(1 for job in finished if job.state == DONE)
+    failed = sum(1 for job in finished if job.state == FAILED)
+    print(f"{len(finished)} job(s): {passed} passed, {failed} failed")
+    return EXIT_OK if failed == 0 else EXIT_FLASH_FAILED
+
+
+def cmd_queue_list(args):
+    from job_queue import JobQueue
+    for job in JobQueue(jobs_path(), None).jobs:
+        error = f"\t{job.error}" if job.error else ""
+        print(f"{job.id}\t{job.port}\t{job.state}\tattempts={job.attempts}{error}")
+    return EXIT_OK
+
+
+def cmd_queue_clear(args):
+    from job_queue import JobQueue
+    queue = JobQueue(jobs_path(), None)
+    dropped = len(queue.pending())
+    queue.clear()
+    print(f"Dropped {dropped} waiting job(s)")
+    return EXIT_OK
+
+
+def cmd_agent(args):
+    profile = load_profile(args.profile or os.path.join(app_dir(), "config.json"))
+    esptool_path = find_flash_tool(args, profile)
+    if not esptool_path:
+        return EXIT_NO_ESPTOOL
+    
+    from flash_agent import FlashAgent, serve, DEFAULT_HOST, DEFAULT_PORT
+    from job_queue import DEFAULT_MAX_PER_HUB
+    host, _, port = (args.listen or "").rpartition(":")
+    agent = FlashAgent(os.path.join(app_dir(), "agent"),
+                       lambda on_event: make_flasher(args, profile, [], esptool_path, on_event),
+                       name=args.name, max_per_hub=args.max_per_hub or profile.get("max_per_hub", DEFAULT_MAX_PER_HUB),
+                       firmware_root=args.firmware_root)
+    try:
+        server = serve(agent, host or DEFAULT_HOST, int(port or DEFAULT_PORT), args.token)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not listen on {args.listen}: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    agent.start()
+    address, port = server.server_address[:2]
+    print(f"Flash agent '{agent.name}' listening on http://{address}:{port}, press Ctrl+C to stop", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    agent.stop()
+    return EXIT_OK
+
+
+def cmd_coordinate(args):
+    profile, images = load_flash_profile(args)
+    from flash_agent import AgentClient, AgentError, run_batch
+    
+    def on_event(url, event):
+        if event["kind"] == "done":
+            result = event["result"]
+            status = "PASS" if result["success"] else f"FAIL ({result['error']})"
+            print(f"[{event['station']}] {event['port']}: {status} in {result['duration']:.1f} s", flush=True)
+        elif event["kind"] == "retry" and not args.quiet:
+            print(f"[{event['station']}] {event['port']}: retrying in {event['delay']} s ({event['error']})", flush=True)
+    
+    clients = [AgentClient(url, args.token) for url in args.agent]
+    started = time.monotonic()
+    try:
+        finished = run_batch(clients, images, os.path.basename(profile.get("app_bin_path", "")), on_event)
+    except (AgentError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return EXIT_FLASH_FAILED
+    elapsed = time.monotonic() - started
+    
+    from job_queue import DONE
+    total = passed = 0
+    for url, jobs in sorted(finished.items()):
+        done = sum(1 for job in jobs if job["state"] == DONE)
+        print(f"{url}: {done} of {len(jobs)} board(s) passed")
+        total += len(jobs)
+        passed += done
+    rate = total * 60.0 / elapsed if elapsed > 0 else 0.0
+    print(f"{total} board(s) on {len(finished)} station(s): {passed} passed, {total - passed} failed "
+          f"in {elapsed:.1f} s ({rate:.1f} boards/min)")
+    if not total:
+        print("Error: no ESP32 boards found on the agents", file=sys.stderr)
+        return EXIT_NO_PORT
+    return EXIT_OK if passed == total else EXIT_FLASH_FAILED
+
+
+def cmd_provision(args):
+    profile = load_profile(args.profile or os.path.join(app_dir(), "config.json"))
+    if not make_provisioner(args, profile):
+        print("Error: no units file; use --units or \"provisioning\" in the profile", file=sys.stderr)
+        return EXIT_USAGE
+    return EXIT_OK
+
+
+def cmd_sparse(args):
+    profile, images = load_flash_profile(args)
+    from bundle_cache import BundleCache, BundleError, estimate_seconds_saved
+    from flash_core import DEFAULT_BAUD
+    baud = args.baud or DEFAULT_BAUD
+    try:
+        bundle = BundleCache(os.path.join(app_dir(), "bundle_cache")).get(images)
+    except (BundleError, OSError) as e:
+        raise ConfigError(f"Could not prepare the flash bundle: {e}")
+    print(f"{'offset':>10} {'size':>9} {'ranges':>6} {'blank':>9} {'blank %':>7} {'saved (compressed)':>18}")
+    for segment in bundle.meta["segments"]:
+        blank = sum(size for offset, size in segment.get("blank", []))
+        print(f"0x{segment['offset']:08x} {segment['size']:>9} {len(segment.get('ranges', [])):>6} {blank:>9} "
+              f"{blank * 100.0 / segment['size']:>6.1f}% {segment.get('compressed_saved', 0):>18}")
+    saved = estimate_seconds_saved(bundle.blank_size, bundle.compressed_saved, baud)
+    print(f"{bundle.blank_size} of {bundle.total_size} bytes are blank sectors that are only erased; "
+          f"{bundle.compressed_saved} compressed bytes less to send, "
+          f"about {saved:.1f} s saved per board at {baud} baud")
+    print("Sparse writes need the in-process engine (pip install esptool); esptool.exe writes every sector.")
+    return EXIT_OK
+
+
+def cmd_history(args):
+    path = history_path()
+    if not os.path.exists(path):
+        print(f"No flash history yet ({path})")
+        return EXIT_OK
+    from flash_history import summarize, device_history
+    if args.device:
+        flashes = device_history(path, args.device)
+        for flash in flashes:
+            status = "PASS" if flash["success"] else f"FAIL ({flash['error'] or flash['returncode']})"
+            unit = f" unit {flash['unit']}" if flash["unit"] else ""
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(flash['time']))} {flash['port']} "
+                  f"bundle {(flash['bundle'] or '-')[:12]} attempt {flash['attempt']} retries {flash['retries']} "
+                  f"{flash['duration']:.1f} s{unit}: {status}")
+        if not flashes:
+            print(f"No flashes recorded for {args.device}")
+        return EXIT_OK
+    
+    since = time.time() - args.since * 3600 if args.since is not None else None
+    summary = summarize(path, since, args.bundle)
+    if not summary["flashes"]:
+        print("No flashes recorded in this period")
+        return EXIT_OK
+    print(f"{summary['flashes']} flash(es) of {summary['boards']} board(s): {summary['passed']} passed, "
+          f"{summary['failed']} failed ({summary['failed'] * 100.0 / summary['flashes']:.1f} %), "
+          f"{summary['retried']} retried")
+    if summary["boards_per_hour"] is not None:
+        span = summary["last"] - summary["first"]
+        span = f"{span / 3600.0:.1f} h" if span >= 3600 else f"{span / 60.0:.1f} min"
+        print(f"{summary['boards_per_hour']:.1f} boards/hour over the {span} from the first to the last flash")
+    print(f"Flash time p50 {summary['p50'] or 0:.1f} s, p95 {summary['p95'] or 0:.1f} s")
+    print("\nHour               passed  failed")
+    for hour, passed, failed in summary["hours"]:
+        print(f"{hour:<18} {passed:>7} {failed:>7}")
+    for title, rows in (("Port", summary["ports"]), ("USB hub", summary["hubs"])):
+        print(f"\n{title:<18} {'flashes':>7} {'failed':>7} {'rate':>7}")
+        for name, total, failed, rate in rows:
+            print(f"{name:<18} {total:>7} {failed:>7} {rate:>6.1f}%")
+    print(f"\n{'Region':<18} {'p50 s':>7} {'p95 s':>7}")
+    for offset, p50, p95 in summary["regions"]:
+        print(f"0x{offset:<16x} {p50:>7.2f} {p95:>7.2f}")
+    return EXIT_OK
+
+
+def report_startup(started):
+    """Print how long startup took; tkinter being loaded counts as a failure"""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    status = "ok" if elapsed_ms <= STARTUP_BUDGET_MS else "OVER BUDGET"
+    print(f"startup: {elapsed_ms:.1f} ms (budget {STARTUP_BUDGET_MS} ms) {status}", file=sys.stderr)
+    if "tkinter" in sys.modules:
+        print("startup: tkinter was imported in headless mode", file=sys.stderr)
+
+
+def main(argv=None, started=None):
+    """Run a headless command and return the process exit code"""
+    if started is None:
+        started = time.perf_counter()
+    parser = build_parser()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return EXIT_USAGE if e.code else EXIT_OK
+    
+    if args.timing:
+        report_startup(started)
+    
+    try:
+        return args.handler(args)
+    except ConfigError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return EXIT_CONFIG
+    except KeyboardInterrupt:
+        return EXIT_FLASH_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""
+In-process flash engine: esptool is imported once as a library and every job
+talks to the ROM loader / stub directly, instead of starting a new Python
+interpreter (and re-importing esptool) for each board.
+
+Progress is reported through on_progress(offset, written, total) callbacks.
+The text lines passed to on_line match what the esptool command line prints,
+so logs and anything parsing them look the same with either engine.
+
+Written against esptool 4.x internals ("default_reset", flash_defl_* on the
+loader); esptool 5 renamed several of them, so any other major version is
+treated as unavailable and the subprocess engine is used instead.
+"""
+import re
+import sys
+import time
+import zlib
+import hashlib
+import threading
+import importlib.util
+
+from bundle_cache import SECTOR_SIZE, sparse_ranges
+
+ESP_ROM_BAUD = 115200
+DEFAULT_TIMEOUT = 3
+ERASE_WRITE_TIMEOUT_PER_MB = 40
+DEFAULT_FLASH_SIZE = 4 * 1024 * 1024
+# Major esptool version whose internal API this engine uses
+SUPPORTED_MAJOR = 4
+
+# Size byte of the JEDEC flash ID -> flash size in bytes
+FLASH_SIZES = {
+    0x12: 256 * 1024,
+    0x13: 512 * 1024,
+    0x14: 1024 * 1024,
+    0x15: 2 * 1024 * 1024,
+    0x16: 4 * 1024 * 1024,
+    0x17: 8 * 1024 * 1024,
+    0x18: 16 * 1024 * 1024,
+}
+
+_esptool = None
+_import_error = None
+_import_lock = threading.Lock()
+
+
+def load_esptool():
+    """Import esptool once and return the module (raises ImportError if missing)"""
+    global _esptool, _import_error
+    with _import_lock:
+        if _import_error is not None:
+            raise ImportError(_import_error)
+        if _esptool is None:
+            import esptool
+            version = getattr(esptool, "__version__", "")
+            if not version.startswith(f"{SUPPORTED_MAJOR}."):
+                _import_error = (f"esptool {version or '(unknown version)'} is installed, but the in-process "
+                                 f"engine needs esptool {SUPPORTED_MAJOR}.x")
+                print(f"Warning: {_import_error}; using esptool as a subprocess")
+                raise ImportError(_import_error)
+            _esptool = esptool
+            _ThreadOutput.install()
+    return _esptool
+
+
+def esptool_installed():
+    """True if the esptool package is installed (cheap: does not import it)"""
+    return importlib.util.find_spec("esptool") is not None
+
+
+def esptool_available():
+    """True if the esptool package can be used in-process"""
+    try:
+        load_esptool()
+        return True
+    except ImportError:
+        return False
+
+
+class _ThreadOutput:
+    """sys.stdout wrapper that hands text esptool prints on a job thread to that job
+    
+    Other threads (and anything printed outside a job) still reach the real stdout.
+    """
+    
+    _local = threading.local()
+    
+    def __init__(self, fallback):
+        self.fallback = fallback
+    
+    @classmethod
+    def install(cls):
+        if not isinstance(sys.stdout, cls):
+            sys.stdout = cls(sys.stdout)
+    
+    @classmethod
+    def capture(cls, on_line):
+        cls._local.target = on_line
+        cls._local.buffer = ""
+    
+    @classmethod
+    def release(cls):
+        rest = getattr(cls._local, "buffer", "").strip()
+        if rest:
+            cls.send(rest)
+        cls._local.target = None
+    
+    @classmethod
+    def send(cls, line):
+        """Pass one line to the current job's target"""
+        target = getattr(cls._local, "target", None)
+        if target is None:
+            return
+        # The target may print itself (the CLI does); that output goes to the real stdout
+        cls._local.target = None
+        try:
+            target(line)
+        finally:
+            cls._local.target = target
+    
+    def write(self, text):
+        target = getattr(self._local, "target", None)
+        if target is None:
+            return self.fallback.write(text) if self.fallback is not None else len(text)
+        parts = re.split(r"[\r\n]", self._local.buffer + text)
+        self._local.buffer = parts.pop()
+        for part in parts:
+            if part.strip():
+                self.send(part.rstrip())
+        return len(text)
+    
+    def flush(self):
+        if self.fallback is not None:
+            self.fallback.flush()
+    
+    def isatty(self):
+        return False
+    
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+class InProcessEngine:
+    """Flash through esptool loaded as a library in this process"""
+    
+    name = "inprocess"
+    # Blank sectors are erased on the device instead of being sent
+    sparse = True
+    
+    def __init__(self):
+        self.esptool = load_esptool()
+        self.fatal_error = getattr(self.esptool, "FatalError", RuntimeError)
+    
+    def _run(self, on_line, job):
+        """Run job(emit) with esptool's output routed to on_line; returns an exit code"""
+        emit = _ThreadOutput.send
+        _ThreadOutput.capture(on_line or (lambda line: None))
+        try:
+            job(emit)
+            return 0
+        except self.fatal_error as e:
+            emit(f"A fatal error occurred: {e}")
+            return 2
+        except Exception as e:
+            emit(f"A fatal error occurred: {e}")
+            return 1
+        finally:
+            _ThreadOutput.release()
+    
+    def _detect(self, port):
+        """Reset the board into its ROM loader and return a connected loader object"""
+        detect_chip = getattr(self.esptool, "detect_chip", None) or self.esptool.ESPLoader.detect_chip
+        return detect_chip(port, ESP_ROM_BAUD, "default_reset")
+    
+    def _connect(self, port, emit, baud=None):
+        """Connect, start the flasher stub and optionally switch baud rate"""
+        esp = self._detect(port)
+        if esp.CHIP_NAME != "ESP32":
+            self._close(esp)
+            raise self.fatal_error(f"This chip is {esp.CHIP_NAME}, not ESP32")
+        emit(f"Chip is {esp.get_chip_description()}")
+        emit("MAC: " + ":".join("%02x" % b for b in esp.read_mac()))
+        esp = esp.run_stub()
+        if baud and baud != ESP_ROM_BAUD:
+            esp.change_baud(baud)
+        return esp
+    
+    def _close(self, esp, reset=True):
+        try:
+            if reset:
+                esp.hard_reset()
+        finally:
+            esp._port.close()
+    
+    def read_mac(self, port, on_line=None):
+        """Connect to the board and return its MAC address, or None"""
+        found = []
+        
+        def job(emit):
+            esp = self._detect(port)
+            try:
+                found.append(":".join("%02x" % b for b in esp.read_mac()))
+                emit(f"MAC: {found[0]}")
+            finally:
+                self._close(esp)
+        
+        returncode = self._run(on_line, job)
+        return found[0] if returncode == 0 and found else None
+    
+    def verify_regions(self, port, images, on_line=None):
+        """Compare images with the board's flash by MD5 on the device; returns offsets that differ"""
+        mismatched = set(offset for offset, _ in images)
+        
+        def job(emit):
+            esp = self._connect(port, emit)
+            try:
+                for offset, path in images:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    emit(f"Verifying 0x{len(data):x} ({len(data)}) bytes @ 0x{offset:08x} in flash against {path}...")
+                    if esp.flash_md5sum(offset, len(data)) == hashlib.md5(data).hexdigest():
+                        emit("-- verify OK (digest matched)")
+                        mismatched.discard(offset)
+                    else:
+                        emit("-- verify FAILED (digest mismatch)")
+            finally:
+                self._close(esp)
+        
+        self._run(on_line, job)
+        return mismatched
+    
+    def write_flash(self, port, images, baud=None, on_line=None, on_progress=None, bundle=None):
+        """Write images (or a bundle's precompressed segments); returns an esptool-style exit code"""
+        def job(emit):
+            esp = self._connect(port, emit, baud)
+            try:
+                self._set_flash_size(esp, emit)
+                if bundle is not None:
+                    for offset, size, md5, ranges, blank in bundle.compressed_segments:
+                        parts = []
+                        for start, length, compressed_path in ranges:
+                            with open(compressed_path, "rb") as f:
+                                parts.append((start, length, f.read()))
+                        self._write_region(esp, offset, size, md5, parts, blank, emit, on_progress)
+                else:
+                    for offset, path in images:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                        to_write, blank = sparse_ranges(data, offset)
+                        parts = [(start, length, zlib.compress(data[start - offset:start - offset + length], 9))
+                                 for start, length in to_write]
+                        self._write_region(esp, offset, len(data), hashlib.md5(data).hexdigest(), parts, blank,
+                                           emit, on_progress)
+                emit("Leaving...")
+                # Same as esptool: keep the stub in flash mode, then leave it cleanly
+                esp.flash_begin(0, 0)
+                esp.flash_defl_finish(False)
+            except Exception:
+                self._close(esp, reset=False)
+                raise
+            emit("Hard resetting via RTS pin...")
+            self._close(esp)
+        
+        return self._run(on_line, job)
+    
+    def _set_flash_size(self, esp, emit):
+        """Tell the stub the real flash size (what --flash_size keep ends up doing)"""
+        flash_id = esp.flash_id()
+        size = FLASH_SIZES.get((flash_id >> 16) & 0xFF)
+        if size is None:
+            emit("Warning: Could not detect flash size, assuming 4MB")
+            size = DEFAULT_FLASH_SIZE
+        esp.flash_set_parameters(size)
+    
+    def _write_region(self, esp, offset, size, md5, parts, blank, emit, on_progress):
+        """Write one region and check its MD5 on the device
+        
+        parts are the [(offset, size, compressed data)] ranges sent block by
+        block; the blank [(offset, size)] sectors in between are only erased.
+        """
+        compressed_size = sum(len(compressed) for _, _, compressed in parts)
+        emit(f"Compressed {size} bytes to {compressed_size}...")
+        if blank:
+            blank_bytes = sum(length for _, length in blank)
+            emit(f"Erasing {len(blank)} blank range(s) ({blank_bytes} bytes) without sending them")
+        started = time.monotonic()
+        for start, length in blank:
+            esp.erase_region(start, (length + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE)
+        for start, length, compressed in parts:
+            blocks = esp.flash_defl_begin(length, len(compressed), start)
+            block_size = esp.FLASH_WRITE_SIZE
+            ratio = length / float(len(compressed))
+            sent = 0
+            for seq in range(blocks):
+                block = compressed[sent:sent + block_size]
+                # Progress counts the whole region, blank ranges before this one included
+                written = start - offset + min(length, int((sent + len(block)) * ratio))
+                emit(f"Writing at 0x{start + int(sent * ratio):08x}... ({100 * written // size} %)")
+                timeout = max(DEFAULT_TIMEOUT, ERASE_WRITE_TIMEOUT_PER_MB * len(block) * ratio / 1e6)
+                esp.flash_defl_block(block, seq, timeout=timeout)
+                sent += len(block)
+                if on_progress:
+                    on_progress(offset, written, size)
+        if on_progress:
+            on_progress(offset, size, size)
+        # The stub acks blocks before writing them; this read waits for the last write
+        esp.read_reg(esp.CHIP_DETECT_MAGIC_REG_ADDR, timeout=DEFAULT_TIMEOUT)
+        elapsed = time.monotonic() - started
+        emit(f"Wrote {size} bytes ({compressed_size} compressed) at 0x{offset:08x} in {elapsed:.1f} seconds "
+             f"(effective {size / max(elapsed, 1e-3) * 8 / 1000:.1f} kbit/s)...")
+        if esp.flash_md5sum(offset, size) != md5:
+            raise self.fatal_error("MD5 of file does not match data in flash!")
+        emit("Hash of data verified.")
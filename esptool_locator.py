@@ -0,0 +1,192 @@
+"""
+Locate esptool: pip's esptool.py on PATH or esptool.exe from an Arduino install.
+
+A full scan lists every user folder on C:/D:, probes the Arduino vendor and
+Arduino15 package folders and runs the tool to read its version, which is too
+slow to do before the window appears. The result is cached in a small JSON
+file together with the tool's mtime; a cached entry is trusted as long as the
+file is still there with the same mtime, and full rescans run in the background.
+"""
+import os
+import re
+import glob
+import json
+import shutil
+import threading
+import subprocess
+
+VERSION_RE = re.compile(r"v?(\d+\.\d+(?:\.\d+)?(?:[-.\w]*)?)")
+VERSION_TIMEOUT = 5
+
+
+def arduino_hardware_dirs():
+    """Arduino sketchbook hardware folders for the current user and every user on C:/D:"""
+    home = os.path.expanduser("~")
+    dirs = [
+        os.path.join(home, "Documents", "Arduino", "hardware"),
+        os.path.join(home, "Arduino", "hardware"),
+    ]
+    username = os.getenv('USERNAME') or os.getenv('USER')
+    if username:
+        dirs.append(os.path.join("C:", "Users", username, "Documents", "Arduino", "hardware"))
+    
+    # Search in common Arduino installation locations
+    for drive in ["C:", "D:"]:
+        users_dir = os.path.join(drive + os.sep, "Users")
+        if os.path.isdir(users_dir):
+            for user_folder in os.listdir(users_dir):
+                dirs.append(os.path.join(users_dir, user_folder, "Documents", "Arduino", "hardware"))
+    return dirs
+
+
+def arduino15_dirs():
+    """Arduino15 data folders (boards manager installs) on Windows, Linux and macOS"""
+    home = os.path.expanduser("~")
+    dirs = [
+        os.path.join(home, ".arduino15"),
+        os.path.join(home, "Library", "Arduino15"),
+    ]
+    local_app_data = os.getenv('LOCALAPPDATA')
+    if local_app_data:
+        dirs.append(os.path.join(local_app_data, "Arduino15"))
+    return dirs
+
+
+def candidate_paths():
+    """Every place esptool might be installed, most preferred first"""
+    home = os.path.expanduser("~")
+    paths = []
+    
+    # Arduino hardware folders (heltec or espressif core installed by hand)
+    for hardware in arduino_hardware_dirs():
+        for vendor in ["heltec", "espressif"]:
+            tool_dir = os.path.join(hardware, vendor, "esp32", "tools", "esptool")
+            paths.extend([os.path.join(tool_dir, "esptool.exe"), os.path.join(tool_dir, "esptool.py"),
+                          os.path.join(tool_dir, "esptool")])
+    
+    # Boards manager installs: Arduino15/packages/<vendor>/tools/esptool_py/<version>/
+    for data_dir in arduino15_dirs():
+        for vendor in ["Heltec-esp32", "esp32"]:
+            pattern = os.path.join(data_dir, "packages", vendor, "tools", "esptool_py", "*")
+            for version_dir in sorted(glob.glob(pattern), reverse=True):
+                paths.extend([os.path.join(version_dir, "esptool.exe"), os.path.join(version_dir, "esptool.py"),
+                              os.path.join(version_dir, "esptool")])
+    
+    # pip --user and pipx installs that are not on PATH
+    paths.extend([
+        os.path.join(home, ".local", "bin", "esptool.py"),
+        os.path.join(home, ".local", "bin", "esptool"),
+        os.path.join(home, ".local", "pipx", "venvs", "esptool", "bin", "esptool.py"),
+        os.path.join(home, ".local", "share", "pipx", "venvs", "esptool", "bin", "esptool.py"),
+        os.path.join(home, "pipx", "venvs", "esptool", "Scripts", "esptool.py.exe"),
+    ])
+    return paths
+
+
+def resolve_executable(path):
+    """Return the file behind an esptool setting ("esptool.py" is looked up on PATH)"""
+    if path == "esptool.py":
+        return shutil.which("esptool.py")
+    return path if path and os.path.exists(path) else None
+
+
+def esptool_version(path):
+    """Run esptool and return its version string, or None if it does not run"""
+    try:
+        result = subprocess.run([path, "version"], capture_output=True, universal_newlines=True,
+                                timeout=VERSION_TIMEOUT)
+    except Exception:
+        return None
+    for line in (result.stdout or "").splitlines():
+        match = VERSION_RE.search(line)
+        if match and result.returncode == 0:
+            return match.group(1)
+    return None if result.returncode else ""
+
+
+def scan_esptool():
+    """Full search; returns (path, version) or (None, None)"""
+    # Check if esptool is in PATH (installed via pip)
+    if shutil.which("esptool.py"):
+        version = esptool_version("esptool.py")
+        if version is not None:
+            return "esptool.py", version
+    
+    # Check all possible paths
+    for path in candidate_paths():
+        if os.path.isfile(path):
+            return path, esptool_version(path)
+    return None, None
+
+
+class ESPToolCache:
+    """esptool_cache.json: the last discovered esptool, its version and mtime"""
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def load(self):
+        """Return (path, version) if the cached tool is unchanged on disk, else None"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            resolved = resolve_executable(entry["path"])
+            if not resolved or os.path.abspath(resolved) != entry["resolved"]:
+                return None
+            if os.path.getmtime(resolved) != entry["mtime"]:
+                # Tool was updated in place: revalidate it instead of rescanning everything
+                version = esptool_version(entry["path"])
+                if version is None:
+                    return None
+                self.save(entry["path"], version)
+                return entry["path"], version
+            return entry["path"], entry.get("version")
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def save(self, path, version):
+        resolved = resolve_executable(path)
+        if not resolved:
+            return
+        entry = {
+            "path": path,
+            "resolved": os.path.abspath(resolved),
+            "version": version,
+            "mtime": os.path.getmtime(resolved),
+        }
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Warning: Could not save esptool cache: {e}")
+
+
+def find_esptool(cache_path=None, rescan=False):
+    """Try to find esptool automatically; returns "esptool.py", a path, or None
+    
+    With cache_path, a still-valid cached result is returned without scanning.
+    """
+    cache = ESPToolCache(cache_path) if cache_path else None
+    if cache and not rescan:
+        cached = cache.load()
+        if cached:
+            return cached[0]
+    path, version = scan_esptool()
+    if cache and path:
+        cache.save(path, version)
+    return path
+
+
+def discover_in_background(cache_path, callback):
+    """Run a full scan on a daemon thread and call callback(path, version) when done"""
+    def run():
+        path, version = scan_esptool()
+        if path:
+            ESPToolCache(cache_path).save(path, version)
+        callback(path, version)
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
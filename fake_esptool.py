@@ -0,0 +1,187 @@
+"""
+Stand-in for esptool used by benchmark.py; never touches real hardware.
+
+Accepts the esptool command lines the flasher builds (write_flash, read_mac,
+verify_flash, version) and prints what esptool v4 prints, at the pace a real
+board would: connection and stub upload delays, then the compressed images
+trickle out at the requested baud rate. The compressed data is written to the
+--port device (a pty from the benchmark) so serial I/O costs are real too.
+
+    FAKE_ESPTOOL_SPEED      time scale: 1.0 real pace (default), 0 no waiting
+    FAKE_ESPTOOL_RECORDING  replay a recording made with "benchmark.py record"
+                            instead of synthesising the output
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+
+VERSION = "4.7.0"
+FLASH_WRITE_SIZE = 0x4000
+# Seconds a real ESP32 takes for each step before the data transfer
+CONNECT_DELAY = 0.25
+CHIP_DETECT_DELAY = 0.05
+STUB_DELAY = 0.15
+BAUD_CHANGE_DELAY = 0.05
+ERASE_SECONDS_PER_MB = 1.5
+RESET_DELAY = 0.1
+
+
+def option(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+class FakeBoard:
+    """Prints esptool output and writes the payload to the port"""
+    
+    def __init__(self, port, baud, speed):
+        self.port = port
+        self.baud = baud
+        self.speed = speed
+        self.fd = None
+        # Every fake board has its own MAC, derived from the port name
+        digest = hashlib.md5(port.encode("utf-8")).digest()
+        self.mac = "24:0a:c4:" + ":".join("%02x" % b for b in digest[:3])
+    
+    def wait(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds * self.speed)
+    
+    def say(self, line, delay=0.0):
+        self.wait(delay)
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+    
+    def send(self, data):
+        if self.fd is None:
+            return
+        try:
+            os.write(self.fd, data)
+        except OSError:
+            pass
+    
+    def connect(self, stub=True):
+        self.say(f"esptool.py v{VERSION}")
+        self.say(f"Serial port {self.port}")
+        try:
+            self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as e:
+            self.say(f"A fatal error occurred: Could not open {self.port}, the port doesn't exist ({e})")
+            sys.exit(2)
+        self.say("Connecting....")
+        self.say("Chip is ESP32-D0WDQ6 (revision v1.0)", CONNECT_DELAY)
+        self.say("Features: WiFi, BT, Dual Core, 240MHz, VRef calibration in efuse, Coding Scheme None")
+        self.say("Crystal is 40MHz", CHIP_DETECT_DELAY)
+        self.say(f"MAC: {self.mac}")
+        if stub:
+            self.say("Uploading stub...")
+            self.say("Running stub...", STUB_DELAY)
+            self.say("Stub running...")
+            if self.baud != 115200:
+                self.say(f"Changing baud rate to {self.baud}")
+                self.say("Changed.", BAUD_CHANGE_DELAY)
+    
+    def hard_reset(self):
+        self.say("Hard resetting via RTS pin...", RESET_DELAY)
+        if self.fd is not None:
+            os.close(self.fd)
+    
+    def write_flash(self, images):
+        self.say("Configuring flash size...")
+        for offset, path in images:
+            size = os.path.getsize(path)
+            end = offset + ((size + 0xfff) & ~0xfff) - 1
+            self.say(f"Flash will be erased from 0x{offset:08x} to 0x{end:08x}...")
+        for offset, path in images:
+            with open(path, "rb") as f:
+                data = f.read()
+            compressed = zlib.compress(data, 9)
+            self.say(f"Compressed {len(data)} bytes to {len(compressed)}...", ERASE_SECONDS_PER_MB * len(data) / 1e6)
+            blocks = max(1, (len(compressed) + FLASH_WRITE_SIZE - 1) // FLASH_WRITE_SIZE)
+            started = time.monotonic()
+            for seq in range(blocks):
+                block = compressed[seq * FLASH_WRITE_SIZE:(seq + 1) * FLASH_WRITE_SIZE]
+                address = offset + seq * FLASH_WRITE_SIZE * len(data) // max(1, len(compressed))
+                self.say(f"Writing at 0x{address:08x}... ({100 * (seq + 1) // blocks} %)")
+                self.send(block)
+                # 10 bits per byte on the wire
+                self.wait(len(block) * 10.0 / self.baud)
+            elapsed = max(time.monotonic() - started, 0.001)
+            self.say(f"Wrote {len(data)} bytes ({len(compressed)} compressed) at 0x{offset:08x} in {elapsed:.1f} seconds "
+                     f"(effective {len(data) * 8 / elapsed / 1000:.1f} kbit/s)...")
+            self.say("Hash of data verified.", 0.02)
+        self.say("")
+        self.say("Leaving...")
+    
+    def verify_flash(self, images):
+        for offset, path in images:
+            size = os.path.getsize(path)
+            self.say(f"Verifying 0x{size:x} ({size}) bytes @ 0x{offset:08x} in flash against {path}...", 0.05)
+            self.say("-- verify OK (digest matched)")
+
+
+def image_pairs(args, command):
+    """[(offset, path)] after the command and its -/-- options"""
+    rest = args[args.index(command) + 1:]
+    pairs = []
+    i = 0
+    while i < len(rest):
+        if rest[i].startswith("-"):
+            # --flash_mode keep, --diff no, ...; -z takes no value
+            i += 1 if rest[i] == "-z" else 2
+            continue
+        pairs.append((int(rest[i], 0), rest[i + 1]))
+        i += 2
+    return pairs
+
+
+def replay(path, speed):
+    """Print the lines of a recording with their original timing"""
+    started = time.monotonic()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if speed > 0:
+                delay = entry["t"] * speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            sys.stdout.write(entry["line"] + "\n")
+            sys.stdout.flush()
+            if entry.get("exit") is not None:
+                return entry["exit"]
+    return 0
+
+
+def main(args):
+    speed = float(os.environ.get("FAKE_ESPTOOL_SPEED", "1.0"))
+    if "version" in args or "--version" in args:
+        print(f"esptool.py v{VERSION}")
+        print(VERSION)
+        return 0
+    recording = os.environ.get("FAKE_ESPTOOL_RECORDING")
+    if recording and "write_flash" in args:
+        return replay(recording, speed)
+    
+    board = FakeBoard(option(args, "--port", ""), int(option(args, "--baud", "115200")), speed)
+    if "read_mac" in args:
+        board.connect(stub=False)
+        board.say(f"MAC: {board.mac}")
+    elif "verify_flash" in args:
+        board.connect()
+        board.verify_flash(image_pairs(args, "verify_flash"))
+    elif "write_flash" in args:
+        board.connect()
+        board.write_flash(image_pairs(args, "write_flash"))
+    else:
+        board.say("A fatal error occurred: unsupported command")
+        return 2
+    board.hard_reset()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,561 @@
+"""
+Headless flash station agent with a small JSON-over-HTTP API, and a client for it.
+
+One agent runs per station (python main.py agent). Clients, such as the
+coordinator (python main.py coordinate), can list the station's ports, upload
+or select a firmware bundle, queue flash jobs and follow their progress:
+
+    GET  /status             station name, job counts and boards per hour
+    GET  /ports              serial ports, ESP32 boards flagged
+    GET  /bundles            firmware bundles known to this station
+    POST /bundles            {"name": ..., "images": {config key: base64}} to upload,
+                             {"name": ..., "paths": {config key: path}} to use files under
+                             the station's firmware root (only when one is configured)
+    POST /jobs               {"ports": [...], "bundle": id} -> the queued jobs
+    GET  /jobs               every job; GET /jobs/<id> for one
+    GET  /events?since=N     events after N as JSON lines; streamed until the client
+                             disconnects, or returned at once with follow=0
+
+Jobs go through the persistent JobQueue (retries, per-hub limits) of the
+agent's directory. The agent listens on localhost unless told otherwise;
+with a token, every request needs "Authorization: Bearer <token>". A token
+is required to listen on any other address.
+"""
+import os
+import json
+import time
+import base64
+import hmac
+import ipaddress
+import shutil
+import socket
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from flash_core import FLASH_REGIONS, images_from_config
+from image_check import check_bundle
+from bundle_cache import bundle_key
+from job_queue import JobQueue, DEFAULT_MAX_PER_HUB, DONE, FAILED
+from baud_policy import hub_of
+from port_watcher import esp32_adapter_name
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_UPLOAD = 64 * 1024 * 1024
+# Events kept for clients that catch up with ?since=
+KEEP_EVENTS = 20000
+# Seconds between keep-alive newlines on an idle event stream
+HEARTBEAT = 15.0
+BUNDLES_FILE = "bundles.json"
+
+
+class AgentError(Exception):
+    """A request the agent cannot serve; status is the HTTP status code"""
+    
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def result_to_dict(result):
+    """JSON-ready summary of a FlashResult"""
+    return {
+        "port": result.port,
+        "success": result.success,
+        "returncode": result.returncode,
+        "error": result.error or None,
+        "duration": round(result.duration, 3),
+        "mac": result.mac,
+        "baud": result.baud,
+        "written": [hex(offset) for offset in result.written],
+        "skipped": [hex(offset) for offset in result.skipped],
+        "unit": result.unit,
+        "boot": {"passed": result.boot.passed, "reason": result.boot.reason} if result.boot else None,
+    }
+
+
+class EventLog:
+    """Numbered events that clients read from a sequence number on"""
+    
+    def __init__(self, keep=KEEP_EVENTS):
+        self.keep = keep
+        self.events = []
+        self.seq = 0
+        self._cond = threading.Condition()
+    
+    def add(self, **event):
+        with self._cond:
+            self.seq += 1
+            event["seq"] = self.seq
+            event["time"] = round(time.time(), 3)
+            self.events.append(event)
+            if len(self.events) > self.keep:
+                del self.events[:len(self.events) - self.keep]
+            self._cond.notify_all()
+    
+    def since(self, seq, timeout=0):
+        """Events after seq, waiting up to timeout seconds for one to arrive"""
+        with self._cond:
+            if timeout and self.seq <= seq:
+                self._cond.wait(timeout)
+            return [event for event in self.events if event["seq"] > seq]
+
+
+class FlashAgent:
+    """One flash station: its bundles, job queue and event log
+    
+    make_flasher(on_event) returns the GangFlasher used for every job (set up
+    with the station's profile); list_ports() defaults to pyserial's comports().
+    Bundles of files already on the station are only accepted from inside
+    firmware_root; without one, images must be uploaded.
+    """
+    
+    def __init__(self, directory, make_flasher, list_ports=None, name=None, workers=None,
+                 max_per_hub=DEFAULT_MAX_PER_HUB, firmware_root=None):
+        self.directory = directory
+        self.firmware_root = os.path.realpath(firmware_root) if firmware_root else None
+        self.name = name or socket.gethostname()
+        self.list_ports = list_ports
+        self.events = EventLog()
+        self.flasher = make_flasher(self._on_flash_event)
+        self.bundles_dir = os.path.join(directory, "bundles")
+        self.bundles_path = os.path.join(directory, BUNDLES_FILE)
+        self.bundles = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+        os.makedirs(self.bundles_dir, exist_ok=True)
+        self.load_bundles()
+        self.queue = JobQueue(os.path.join(directory, "flash_jobs.json"),
+                              lambda job: self.flasher.flash_port(job.port, job.images, attempt=job.attempts,
+                                                                  check_later=True),
+                              workers or self.flasher.max_workers, max_per_hub, on_event=self._on_job_event,
+                              check=self._check_boot if self.flasher.boot_check else None)
+    
+    def _check_boot(self, job, result):
+        self.flasher.check_boot(result)
+    
+    def start(self):
+        self.queue.start()
+    
+    def stop(self):
+        self.queue.stop()
+    
+    def load_bundles(self):
+        try:
+            with open(self.bundles_path, 'r', encoding='utf-8') as f:
+                self.bundles = json.load(f)
+        except FileNotFoundError:
+            self.bundles = {}
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not load bundle list: {e}")
+            self.bundles = {}
+    
+    def save_bundles(self):
+        """Write the bundle list atomically (call with the lock held)"""
+        try:
+            tmp_path = self.bundles_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.bundles, f, indent=4)
+            os.replace(tmp_path, self.bundles_path)
+        except OSError as e:
+            print(f"Warning: Could not save bundle list: {e}")
+    
+    def _on_flash_event(self, port, kind, value):
+        if kind == "done":
+            self.events.add(station=self.name, port=port, kind="done", result=result_to_dict(value))
+        elif kind == "progress":
+            self.events.add(station=self.name, port=port, kind="progress", percent=value)
+        elif kind == "line":
+            self.events.add(station=self.name, port=port, kind="line", line=value)
+        else:
+            self.events.add(station=self.name, port=port, kind=kind)
+    
+    def _on_job_event(self, job, kind, value):
+        if kind == "retry":
+            self.events.add(station=self.name, port=job.port, kind="retry", job=job.id, delay=value,
+                            error=job.error)
+        elif kind == "done":
+            self.events.add(station=self.name, port=job.port, kind="job_done", job=job.id, state=job.state,
+                            error=job.error or None)
+    
+    def ports(self):
+        if self.list_ports is not None:
+            infos = self.list_ports()
+        else:
+            import serial.tools.list_ports
+            infos = serial.tools.list_ports.comports()
+        return [{
+            "device": info.device,
+            "description": info.description,
+            "usb": f"{info.vid:04X}:{info.pid:04X}" if info.vid is not None else None,
+            "hub": hub_of(info.location),
+            "esp32": esp32_adapter_name(info),
+        } for info in infos]
+    
+    def add_bundle(self, name, images):
+        """Check [(offset, path)] and register them as a bundle; returns its id"""
+        errors, warnings = check_bundle(images)
+        if errors:
+            raise AgentError(422, "The images cannot be flashed: " + "; ".join(errors))
+        bundle_id = bundle_key(images)
+        with self._lock:
+            self.bundles[bundle_id] = {
+                "name": name or bundle_id[:12],
+                "images": [[offset, path] for offset, path in images],
+                "warnings": warnings,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self.save_bundles()
+        # Prepare the flash bundle now rather than in the first job
+        if self.flasher.bundle_cache is not None:
+            threading.Thread(target=self._stage, args=(images,), daemon=True).start()
+        self.events.add(station=self.name, kind="bundle", bundle=bundle_id, name=self.bundles[bundle_id]["name"])
+        return bundle_id
+    
+    def add_local_bundle(self, name, paths):
+        """Register files already on the station ({config key: path}); they must be under firmware_root"""
+        if not self.firmware_root:
+            raise AgentError(403, "This station only accepts uploaded images (no firmware root is set)")
+        config = {}
+        for key, path in paths.items():
+            if not isinstance(path, str):
+                raise AgentError(400, f"Invalid path for {key}")
+            real = os.path.realpath(os.path.join(self.firmware_root, path))
+            if os.path.commonpath([real, self.firmware_root]) != self.firmware_root:
+                raise AgentError(403, f"{path} is outside the station's firmware root")
+            config[key] = real
+        return self.add_bundle(name, images_from_config(config))
+    
+    def _stage(self, images):
+        try:
+            self.flasher.bundle_cache.get(images)
+        except Exception as e:
+            print(f"Warning: Could not prepare flash bundle: {e}")
+    
+    def upload_bundle(self, name, files):
+        """Store uploaded images ({config key: bytes}) and register them"""
+        upload_dir = os.path.join(self.bundles_dir, f"upload{os.getpid()}-{threading.get_ident()}")
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        os.makedirs(upload_dir)
+        config = {}
+        try:
+            for _, key, _ in FLASH_REGIONS:
+                if key not in files:
+                    raise AgentError(400, f"Missing image: {key}")
+                config[key] = os.path.join(upload_dir, key.replace("_path", ".bin"))
+                with open(config[key], "wb") as f:
+                    f.write(files[key])
+            # Uploads live in a directory named after their content, so the same bundle is stored once
+            directory = os.path.join(self.bundles_dir, bundle_key(images_from_config(config)))
+            if not os.path.isdir(directory):
+                try:
+                    os.replace(upload_dir, directory)
+                except OSError:
+                    # The same bundle was uploaded at the same time and stored first
+                    if not os.path.isdir(directory):
+                        raise
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        for key in config:
+            config[key] = os.path.join(directory, os.path.basename(config[key]))
+        try:
+            return self.add_bundle(name, images_from_config(config))
+        except AgentError:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+    
+    def submit(self, ports, bundle_id):
+        """Queue a job per port with a bundle's images; returns the job dicts"""
+        with self._lock:
+            bundle = self.bundles.get(bundle_id)
+        if bundle is None:
+            raise AgentError(404, f"Unknown bundle: {bundle_id}")
+        known = dict((port["device"], port) for port in self.ports())
+        missing = [port for port in ports if port not in known]
+        if missing:
+            raise AgentError(404, "Port(s) not found: " + ", ".join(missing))
+        jobs = []
+        for port in ports:
+            job = self.queue.add(port, bundle["images"], known[port]["hub"])
+            if job is None:
+                jobs.append({"port": port, "error": "a job for this port is already queued"})
+            else:
+                self.events.add(station=self.name, port=port, kind="queued", job=job.id, bundle=bundle_id)
+                jobs.append(dict(job.to_dict(), bundle=bundle_id))
+        return jobs
+    
+    def jobs(self):
+        return [job.to_dict() for job in self.queue.snapshot()]
+    
+    def status(self):
+        jobs = self.jobs()
+        counts = {}
+        for job in jobs:
+            counts[job["state"]] = counts.get(job["state"], 0) + 1
+        hour_ago = time.time() - 3600
+        recent = [job for job in jobs if job["state"] == DONE and (job["finished"] or 0) >= hour_ago]
+        window = min(3600.0, max(time.time() - self.started, 1.0))
+        return {
+            "station": self.name,
+            "jobs": counts,
+            "boards_per_hour": round(len(recent) * 3600.0 / window, 1),
+            "bundles": len(self.bundles),
+            "events": self.events.seq,
+            "uptime": round(time.time() - self.started, 1),
+        }
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    """HTTP front end of a FlashAgent (the server's .agent)"""
+    
+    server_version = "ESP32FlashAgent/1.0"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _authorized(self):
+        token = self.server.token
+        # Without a token only this machine may talk to the agent: a web page it
+        # opens can still reach localhost, but not with a loopback Host (DNS rebinding)
+        if not token and not is_loopback(urlparse("//" + self.headers.get("Host", "")).hostname):
+            self._send(403, {"error": "Host must be localhost when the agent has no token"})
+            return False
+        authorization = self.headers.get("Authorization", "").encode("utf-8", "replace")
+        if token and not hmac.compare_digest(authorization, f"Bearer {token}".encode("utf-8")):
+            self._send(401, {"error": "missing or wrong token"})
+            return False
+        return True
+    
+    def _body(self):
+        # A browser sends text/plain cross-origin without asking; application/json it does not
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            raise AgentError(415, "Content-Type must be application/json")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise AgentError(400, "Invalid Content-Length")
+        if length > MAX_UPLOAD:
+            raise AgentError(413, f"Request larger than {MAX_UPLOAD} bytes")
+        try:
+            return json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+        except ValueError as e:
+            raise AgentError(400, f"Invalid JSON: {e}")
+    
+    def do_GET(self):
+        self._dispatch(self._get)
+    
+    def do_POST(self):
+        self._dispatch(self._post)
+    
+    def _dispatch(self, handler):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        try:
+            handler(url.path.rstrip("/") or "/", parse_qs(url.query))
+        except AgentError as e:
+            self._send(e.status, {"error": str(e)})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+    
+    def _get(self, path, query):
+        agent = self.server.agent
+        if path == "/status":
+            self._send(200, agent.status())
+        elif path == "/ports":
+            self._send(200, {"ports": agent.ports()})
+        elif path == "/bundles":
+            self._send(200, {"bundles": agent.bundles})
+        elif path == "/jobs":
+            self._send(200, {"jobs": agent.jobs()})
+        elif path.startswith("/jobs/"):
+            job_id = path[len("/jobs/"):]
+            for job in agent.jobs():
+                if job["id"] == job_id:
+                    self._send(200, job)
+                    return
+            raise AgentError(404, f"Unknown job: {job_id}")
+        elif path == "/events":
+            self._stream_events(int(query.get("since", ["0"])[0]), query.get("follow", ["1"])[0] != "0")
+        else:
+            raise AgentError(404, f"Unknown path: {path}")
+    
+    def _post(self, path, query):
+        agent = self.server.agent
+        body = self._body()
+        if path == "/bundles":
+            if "images" in body:
+                try:
+                    files = dict((key, base64.b64decode(data)) for key, data in body["images"].items())
+                except (TypeError, ValueError) as e:
+                    raise AgentError(400, f"Invalid image data: {e}")
+                bundle_id = agent.upload_bundle(body.get("name"), files)
+            elif isinstance(body.get("paths"), dict):
+                bundle_id = agent.add_local_bundle(body.get("name"), body["paths"])
+            else:
+                raise AgentError(400, "Expected \"images\" or \"paths\"")
+            self._send(201, {"bundle": bundle_id})
+        elif path == "/jobs":
+            ports = body.get("ports") or []
+            if not ports or not body.get("bundle"):
+                raise AgentError(400, "Expected \"ports\" and \"bundle\"")
+            self._send(201, {"jobs": agent.submit(ports, body["bundle"])})
+        else:
+            raise AgentError(404, f"Unknown path: {path}")
+    
+    def _stream_events(self, since, follow):
+        events = self.server.agent.events
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        if not follow:
+            body = "".join(json.dumps(event) + "\n" for event in events.since(since)).encode("utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.end_headers()
+        while True:
+            batch = events.since(since, timeout=HEARTBEAT)
+            # An empty line keeps idle connections (and proxies) alive
+            self.wfile.write("".join(json.dumps(event) + "\n" for event in batch).encode("utf-8") or b"\n")
+            self.wfile.flush()
+            if batch:
+                since = batch[-1]["seq"]
+
+
+def is_loopback(host):
+    """True if host only accepts connections from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serve(agent, host=DEFAULT_HOST, port=DEFAULT_PORT, token=None):
+    """Start the HTTP server for agent on a background thread and return it
+    
+    Raises ValueError for a non-loopback host without a token.
+    """
+    if not token and not is_loopback(host):
+        raise ValueError(f"a --token is required to listen on {host}, which other machines can reach")
+    server = ThreadingHTTPServer((host, port), AgentHandler)
+    server.daemon_threads = True
+    server.agent = agent
+    server.token = token
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class AgentClient:
+    """Client for one agent's HTTP API"""
+    
+    def __init__(self, url, token=None, timeout=30):
+        self.url = url.rstrip("/")
+        if "://" not in self.url:
+            self.url = "http://" + self.url
+        self.token = token
+        self.timeout = timeout
+    
+    def request(self, method, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        request.add_header("Content-Type", "application/json")
+        if self.token:
+            request.add_header("Authorization", f"Bearer {self.token}")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read().decode("utf-8")).get("error")
+            except ValueError:
+                message = e.reason
+            raise AgentError(e.code, f"{self.url}: {message}")
+    
+    def status(self):
+        return self.request("GET", "/status")
+    
+    def ports(self):
+        return self.request("GET", "/ports")["ports"]
+    
+    def jobs(self):
+        return self.request("GET", "/jobs")["jobs"]
+    
+    def upload_bundle(self, images, name=None):
+        """Upload [(offset, path)] images; returns the bundle id"""
+        keys = dict((offset, key) for offset, key, _ in FLASH_REGIONS)
+        config = dict((keys[offset], path) for offset, path in images)
+        encoded = {}
+        for key, path in config.items():
+            with open(path, "rb") as f:
+                encoded[key] = base64.b64encode(f.read()).decode("ascii")
+        return self.request("POST", "/bundles", {"name": name, "images": encoded})["bundle"]
+    
+    def submit(self, ports, bundle_id):
+        return self.request("POST", "/jobs", {"ports": ports, "bundle": bundle_id})["jobs"]
+    
+    def events(self, since=0):
+        """Yield events after since, following the stream until the caller stops"""
+        request = urllib.request.Request(f"{self.url}/events?since={since}")
+        if self.token:
+            request.add_header("Authorization", f"Bearer {self.token}")
+        with urllib.request.urlopen(request, timeout=HEARTBEAT * 2) as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode("utf-8"))
+
+
+def run_batch(clients, images, name=None, on_event=None, poll=1.0):
+    """Flash images on every ESP32 port of every agent; returns {station url: [finished job dicts]}
+    
+    on_event(url, event) receives each station's events while the batch runs.
+    """
+    plan = {}
+    for client in clients:
+        ports = [port["device"] for port in client.ports() if port["esp32"]]
+        if ports:
+            seq = client.status()["events"]
+            bundle_id = client.upload_bundle(images, name)
+            jobs = [job for job in client.submit(ports, bundle_id) if "id" in job]
+            plan[client.url] = (client, set(job["id"] for job in jobs), seq)
+    
+    if on_event:
+        for url, (client, _, seq) in plan.items():
+            threading.Thread(target=_follow, args=(client, seq, on_event), daemon=True).start()
+    
+    finished = {}
+    while plan:
+        for url, (client, ids, _) in list(plan.items()):
+            jobs = [job for job in client.jobs() if job["id"] in ids]
+            if all(job["state"] in (DONE, FAILED) for job in jobs):
+                finished[url] = jobs
+                del plan[url]
+        if plan:
+            time.sleep(poll)
+    return finished
+
+
+def _follow(client, since, on_event):
+    try:
+        for event in client.events(since):
+            on_event(client.url, event)
+    except Exception:
+        pass
@@ -0,0 +1,512 @@
+"""
+Flash helpers shared by the GUI, the command line and the gang (multi-port) flasher.
+Nothing in here touches Tk, so it is safe to call from worker threads.
+"""
+import os
+import re
+import subprocess
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from bundle_cache import bundle_key, estimate_seconds_saved
+from baud_policy import adapter_for_port, is_connect_error, is_link_error
+
+# Flash layout for WiFi LoRa 32 (V2): (offset, config key, display name)
+FLASH_REGIONS = [
+    (0x1000, "bootloader_path", "Bootloader"),
+    (0x8000, "partitions_path", "Partitions"),
+    (0xe000, "boot_app0_path", "Boot App0"),
+    (0x10000, "app_bin_path", "Application"),
+]
+
+DEFAULT_BAUD = 921600
+DEFAULT_GANG_WORKERS = 4
+
+# "auto", "subprocess" or "inprocess" (see make_engine)
+DEFAULT_ENGINE = "auto"
+
+# esptool prints one of these per block: "Writing at 0x00010000... (3 %)"
+WRITING_RE = re.compile(r"Writing at 0x([0-9a-fA-F]+)\.*\s*\((\d+)\s*%\)")
+MAC_RE = re.compile(r"MAC:\s*((?:[0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2})")
+# verify_flash: "Verifying 0x4650 (18000) bytes @ 0x00001000 in flash against ..."
+VERIFY_RE = re.compile(r"bytes @ 0x([0-9a-fA-F]+) in flash")
+# One per region once it is written: "Wrote 18000 bytes (12000 compressed) at 0x00001000 in ..."
+WROTE_RE = re.compile(r"Wrote \d+ bytes.* at 0x([0-9a-fA-F]+)")
+
+
+def images_from_config(config):
+    """Return [(offset, path)] for the four images in a config.json style dict"""
+    return [(offset, config.get(key, "")) for offset, key, _ in FLASH_REGIONS]
+
+
+def build_esptool_command(esptool_path, port, args, baud=DEFAULT_BAUD):
+    """Build an esptool command line for one port; the board is reset afterwards"""
+    return [
+        esptool_path,
+        "--chip", "esp32",
+        "--port", port,
+        "--baud", str(baud),
+        "--before", "default_reset",
+        "--after", "hard_reset",
+    ] + list(args)
+
+
+def build_flash_command(esptool_path, port, images, baud=DEFAULT_BAUD):
+    """Build the esptool write_flash command line for one port"""
+    args = [
+        "write_flash",
+        "-z",
+        "--flash_mode", "keep",
+        "--flash_freq", "keep",
+        "--flash_size", "keep",
+    ]
+    for offset, path in images:
+        args.extend([hex(offset), path])
+    return build_esptool_command(esptool_path, port, args, baud)
+
+
+def run_esptool(cmd, on_line=None):
+    """Run esptool, passing every output line to on_line; returns the exit code"""
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1
+    )
+    for line in process.stdout:
+        if on_line:
+            on_line(line.rstrip())
+    process.wait()
+    return process.returncode
+
+
+class SubprocessEngine:
+    """Runs esptool as a separate process (esptool.exe from Arduino or esptool.py)"""
+    
+    name = "subprocess"
+    # esptool's write_flash has to be given every sector it erases
+    sparse = False
+    
+    def __init__(self, esptool_path):
+        self.esptool_path = esptool_path
+    
+    def read_mac(self, port, on_line=None):
+        """Connect to the board and return its MAC address, or None"""
+        found = []
+        
+        def collect(line):
+            match = MAC_RE.search(line)
+            if match and not found:
+                found.append(match.group(1).lower())
+            if on_line:
+                on_line(line)
+        
+        returncode = run_esptool(build_esptool_command(self.esptool_path, port, ["read_mac"]), collect)
+        return found[0] if returncode == 0 and found else None
+    
+    def verify_regions(self, port, images, on_line=None):
+        """Compare images with the board's flash by MD5 on the device; returns offsets that differ"""
+        verified = set()
+        current = []
+        
+        def collect(line):
+            match = VERIFY_RE.search(line)
+            if match:
+                current[:] = [int(match.group(1), 16)]
+            elif "verify OK" in line and current:
+                verified.add(current[0])
+            if on_line:
+                on_line(line)
+        
+        args = ["verify_flash", "--diff", "no"]
+        for offset, path in images:
+            args.extend([hex(offset), path])
+        run_esptool(build_esptool_command(self.esptool_path, port, args), collect)
+        # Anything not explicitly confirmed is treated as different
+        return set(offset for offset, _ in images) - verified
+    
+    def write_flash(self, port, images, baud=DEFAULT_BAUD, on_line=None, on_progress=None, bundle=None):
+        """Write images (or a prepared bundle's segments); returns the esptool exit code
+        
+        on_progress(offset, written, total) is derived from the "Writing at" lines.
+        """
+        if bundle is not None:
+            images = bundle.segments
+        sizes = dict((offset, os.path.getsize(path)) for offset, path in images)
+        
+        def collect(line):
+            if on_line:
+                on_line(line)
+            match = WRITING_RE.search(line) if on_progress else None
+            if match:
+                offset = region_containing(sizes, int(match.group(1), 16))
+                if offset is not None:
+                    on_progress(offset, sizes[offset] * min(100, int(match.group(2))) // 100, sizes[offset])
+        
+        return run_esptool(build_flash_command(self.esptool_path, port, images, baud), collect)
+
+
+def region_containing(regions, address):
+    """Return the start of the region (by offset) that address falls in, or None"""
+    found = None
+    for offset in sorted(regions):
+        if offset <= address:
+            found = offset
+    return found
+
+
+def make_engine(esptool_path, preference=DEFAULT_ENGINE):
+    """Pick the flash engine: esptool in-process when possible, else a subprocess
+    
+    "auto" uses the in-process engine for esptool.py from pip (when the esptool
+    package can be imported) and the subprocess engine for esptool.exe.
+    """
+    if preference != "subprocess" and (preference == "inprocess" or esptool_path == "esptool.py"):
+        from esptool_engine import InProcessEngine, esptool_available
+        if esptool_available():
+            return InProcessEngine()
+    return SubprocessEngine(esptool_path)
+
+
+def flash_port(esptool_path, port, images, baud=DEFAULT_BAUD, on_line=None, on_progress=None,
+               manifest=None, verify_skipped=False, bundle_cache=None, engine=None, baud_policy=None,
+               metrics=None, provisioner=None, history=None, attempt=1):
+    """Flash one port and return a FlashResult; never raises
+    
+    With a FlashManifest, the chip MAC is read first and only regions that differ
+    from what this board last received are written. verify_skipped additionally
+    confirms the skipped regions with an on-device MD5 check before trusting them.
+    With a BundleCache, the regions to write come from a prepared bundle.
+    With a BaudPolicy, baud is ignored: the port starts at its best known rate and
+    a link error retries the regions not yet written at the next slower rate.
+    With a MetricsRecorder, per-phase timings parsed from the output are recorded.
+    With a FlashHistory, the attempt (attempt is its number within the job) is
+    queued for the history database together with its region timings.
+    With a Provisioner, the board's own NVS image is written in the same session,
+    next to (not inside) the shared bundle.
+    engine defaults to running esptool_path as a subprocess.
+    """
+    started = time.monotonic()
+    engine = engine or SubprocessEngine(esptool_path)
+    images = list(images)
+    to_write = images
+    skipped = []
+    unit_images = []
+    unit = None
+    found_mac = []
+    used_baud = []
+    link_errors = []
+    connect_errors = []
+    timeline = metrics.start(port) if metrics is not None else None
+    if timeline is None and history is not None:
+        from flash_metrics import FlashTimeline
+        timeline = FlashTimeline(port)
+    firmware = None
+    held = None
+    
+    def emit(line):
+        if timeline is not None:
+            timeline.feed(line)
+        if is_link_error(line):
+            link_errors.append(line)
+        elif is_connect_error(line):
+            connect_errors.append(line)
+        if on_line:
+            on_line(line)
+    
+    def collect(line):
+        match = MAC_RE.search(line)
+        if match and not found_mac:
+            found_mac.append(match.group(1).lower())
+        emit(line)
+    
+    try:
+        if history is not None:
+            firmware = bundle_key(images)
+        if manifest is not None:
+            mac = engine.read_mac(port, emit)
+            if mac is None:
+                emit("Could not read chip MAC, writing all regions")
+            else:
+                found_mac.append(mac)
+        if provisioner is not None:
+            unit = provisioner.claim(port, found_mac[0] if found_mac else None)
+            unit_images = [(provisioner.offset, unit.path)]
+            images = sorted(images + unit_images)
+            to_write = images
+            emit(f"Provisioning unit {unit.id} (NVS at 0x{provisioner.offset:x})")
+        if manifest is not None and found_mac:
+            to_write, skipped = manifest.plan(mac, images)
+            if skipped and verify_skipped:
+                emit(f"Verifying {len(skipped)} unchanged region(s) on the device...")
+                mismatched = engine.verify_regions(port, skipped, emit)
+                if mismatched:
+                    emit("Flash contents differ at " + ", ".join(hex(offset) for offset in sorted(mismatched)))
+                    to_write = sorted(to_write + [image for image in skipped if image[0] in mismatched])
+                    skipped = [image for image in skipped if image[0] not in mismatched]
+            if skipped:
+                emit("Skipping unchanged region(s): " + ", ".join(hex(offset) for offset, _ in skipped))
+        
+        if to_write:
+            bundle = None
+            if bundle_cache is not None:
+                held = bundle = bundle_cache.get([image for image in to_write if image not in unit_images], hold=True)
+                bundle = bundle.with_images([image for image in to_write if image in unit_images])
+                emit(f"Using flash bundle {bundle.key[:12]} ({len(bundle.segments)} segment(s))")
+                if engine.sparse and bundle.blank_size:
+                    saved = estimate_seconds_saved(bundle.blank_size, bundle.compressed_saved, baud)
+                    emit(f"Sparse write: {bundle.blank_size} bytes of blank sectors are only erased, "
+                         f"{bundle.compressed_saved} compressed bytes less to send (about {saved:.1f} s saved)")
+            progress = FlashProgress(bundle.segments if bundle else to_write)
+            
+            def report(offset, written, total):
+                percent = progress.update(offset, written)
+                if on_progress:
+                    on_progress(percent)
+            
+            returncode = write_with_fallback(engine, port, to_write, bundle, baud, collect, report, progress,
+                                             baud_policy, used_baud)
+        else:
+            emit("All regions are up to date, nothing to write")
+            returncode = 0
+        
+        mac = found_mac[0] if found_mac else None
+        if manifest is not None and mac:
+            if returncode == 0:
+                manifest.record(mac, images)
+            else:
+                manifest.invalidate(mac, [offset for offset, _ in to_write])
+        result = FlashResult(port, returncode, time.monotonic() - started)
+    except Exception as e:
+        result = FlashResult(port, -1, time.monotonic() - started, str(e))
+    if held is not None:
+        bundle_cache.release(held)
+    
+    result.mac = found_mac[0] if found_mac else None
+    result.baud = used_baud[-1] if used_baud else None
+    result.link_error = bool(link_errors)
+    result.connect_error = bool(connect_errors)
+    result.retries = max(0, len(used_baud) - 1)
+    result.written = [offset for offset, _ in to_write]
+    result.skipped = [offset for offset, _ in skipped]
+    if unit is not None:
+        result.unit = unit.id
+        provisioner.finish(unit, result)
+    record = None
+    if metrics is not None:
+        record = metrics.finish(timeline, result, engine=engine.name)
+    elif timeline is not None:
+        record = timeline.to_record(result, engine=engine.name)
+    if history is not None:
+        history.add(result, record, bundle=firmware, attempt=attempt, engine=engine.name)
+    return result
+
+
+def write_with_fallback(engine, port, images, bundle, baud, on_line, on_progress, progress,
+                        baud_policy=None, used_baud=None):
+    """Write images (or the bundle), stepping down the baud ladder after link errors
+    
+    Regions whose write was confirmed ("Wrote ..." then "Hash of data verified.")
+    are not sent again on a retry. Returns the exit code of the last attempt.
+    """
+    rates = [baud]
+    adapter = None
+    if baud_policy is not None:
+        adapter = adapter_for_port(port)
+        rates = baud_policy.rates(port, adapter)
+        known = baud_policy.throughput(port, rates[0])
+        on_line(f"Starting at {rates[0]} baud" + (f" (last {known:.0f} kbit/s effective on this port)" if known else ""))
+    regions = [offset for offset, _ in (bundle.segments if bundle else images)]
+    done = set()
+    returncode = -1
+    for attempt, rate in enumerate(rates):
+        remaining = [offset for offset in regions if offset not in done]
+        if attempt:
+            on_line(f"Link error, retrying {len(remaining)} region(s) at {rate} baud...")
+        state = {"wrote": None, "link_error": False}
+        
+        def collect(line):
+            match = WROTE_RE.search(line)
+            if match:
+                state["wrote"] = int(match.group(1), 16)
+            elif "Hash of data verified" in line and state["wrote"] is not None:
+                done.add(state["wrote"])
+            if is_link_error(line):
+                state["link_error"] = True
+            on_line(line)
+        
+        if used_baud is not None:
+            used_baud.append(rate)
+        started = time.monotonic()
+        returncode = engine.write_flash(port, [image for image in images if image[0] in remaining], rate,
+                                        collect, on_progress, bundle.subset(remaining) if bundle else None)
+        # Failures that are not the link's (missing file, unplugged board, abort) say nothing about the rate
+        if baud_policy is not None and (returncode == 0 or state["link_error"]):
+            nbytes = sum(progress.sizes.get(offset, 0) for offset in remaining)
+            baud_policy.record(port, adapter, rate, returncode == 0, nbytes, time.monotonic() - started)
+        if returncode == 0 or not state["link_error"]:
+            break
+    return returncode
+
+
+class FlashProgress:
+    """Combine per-region progress into an overall percentage"""
+    
+    def __init__(self, images):
+        self.sizes = {}
+        self.written = {}
+        for offset, path in images:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            self.sizes[offset] = max(size, 1)
+            self.written[offset] = 0
+        self.total = sum(self.sizes.values())
+    
+    def update(self, offset, written):
+        """Record bytes written in the region at offset; returns the overall percentage"""
+        offset = region_containing(self.sizes, offset)
+        if offset is not None:
+            self.written[offset] = min(written, self.sizes[offset])
+        return self.percent
+    
+    @property
+    def percent(self):
+        if not self.total:
+            return 0
+        return min(100, sum(self.written.values()) * 100 // self.total)
+
+
+class FlashResult:
+    """Outcome of flashing one port"""
+    
+    def __init__(self, port, returncode, duration, error=""):
+        self.port = port
+        self.returncode = returncode
+        self.duration = duration
+        self.error = error
+        self.mac = None
+        self.baud = None
+        self.boot = None  # BootCheckResult when a boot check ran
+        self.unit = None  # id of the provisioned unit written to this board
+        self.retries = 0  # writes repeated at a lower baud after link errors
+        self.link_error = False
+        self.connect_error = False  # the board did not answer the ROM loader
+        self.written = []
+        self.skipped = []
+    
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.error
+
+
+class GangSummary:
+    """Totals for one gang run (a tray of boards)"""
+    
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+        self.passed = sum(1 for result in results if result.success)
+        self.failed = len(results) - self.passed
+    
+    @property
+    def boards_per_minute(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.results) * 60.0 / self.elapsed
+
+
+class GangFlasher:
+    """Flash the same images to several ports at once with a bounded worker pool
+    
+    on_event(port, kind, value) is called from worker threads with kind one of
+    "start", "line", "progress", "boot_check" or "done" (value is then the FlashResult).
+    
+    With a BootCheck, every successful flash is followed by a boot smoke test
+    on a separate pool, so the flash worker moves on to the next board while
+    the previous one boots; "done" comes after the check.
+    
+    With a Provisioner, every board also gets the next unit's NVS image.
+    With a FlashHistory, every attempt is recorded in the history database.
+    """
+    
+    def __init__(self, esptool_path, images, max_workers=DEFAULT_GANG_WORKERS,
+                 baud=DEFAULT_BAUD, on_event=None, manifest=None, verify_skipped=False,
+                 bundle_cache=None, engine=None, baud_policy=None, metrics=None, boot_check=None,
+                 provisioner=None, history=None):
+        self.esptool_path = esptool_path
+        self.images = list(images)
+        self.max_workers = max(1, int(max_workers))
+        self.baud = baud
+        self.on_event = on_event
+        self.manifest = manifest
+        self.verify_skipped = verify_skipped
+        self.bundle_cache = bundle_cache
+        self.engine = engine
+        self.baud_policy = baud_policy
+        self.metrics = metrics
+        self.boot_check = boot_check
+        self.provisioner = provisioner
+        self.history = history
+        self._boot_pool = None
+        self._boot_checks = []
+        self._boot_lock = threading.Lock()
+    
+    def _emit(self, port, kind, value=None):
+        if self.on_event:
+            self.on_event(port, kind, value)
+    
+    def flash_port(self, port, images=None, attempt=1, check_later=False):
+        """Flash a single port (with these images instead of the gang's, if given); never raises
+        
+        The boot check, if any, finishes in the background on the gang's boot pool.
+        With check_later it is not started at all: the caller runs check_boot(result)
+        (which sends "done") on a pool of its own.
+        attempt is the number of this try within a queued job.
+        """
+        self._emit(port, "start")
+        result = flash_port(self.esptool_path, port, images or self.images, self.baud,
+                            on_line=lambda line: self._emit(port, "line", line),
+                            on_progress=lambda percent: self._emit(port, "progress", percent),
+                            manifest=self.manifest, verify_skipped=self.verify_skipped,
+                            bundle_cache=self.bundle_cache, engine=self.engine,
+                            baud_policy=self.baud_policy, metrics=self.metrics, provisioner=self.provisioner,
+                            history=self.history, attempt=attempt)
+        if self.boot_check is not None and result.success:
+            if check_later:
+                return result
+            with self._boot_lock:
+                if self._boot_pool is None:
+                    from boot_check import DEFAULT_WORKERS
+                    self._boot_pool = ThreadPoolExecutor(max_workers=max(DEFAULT_WORKERS, self.max_workers))
+                self._boot_checks = [check for check in self._boot_checks if not check.done()]
+                check = self._boot_pool.submit(self.check_boot, result)
+                self._boot_checks.append(check)
+        else:
+            self._emit(port, "done", result)
+        return result
+    
+    def check_boot(self, result):
+        """Boot-check the board of a successful flash, then send "done"; blocks until the check is over"""
+        if self.boot_check is not None and result.success:
+            self._emit(result.port, "boot_check")
+            self.boot_check.check_result(result, lambda line: self._emit(result.port, "line", line))
+        self._emit(result.port, "done", result)
+    
+    def wait_boot_checks(self):
+        """Block until every boot check started so far has finished"""
+        with self._boot_lock:
+            checks, self._boot_checks = self._boot_checks, []
+        wait(checks)
+    
+    def run(self, ports):
+        """Flash every port and return a GangSummary once all have finished"""
+        started = time.monotonic()
+        workers = min(self.max_workers, max(1, len(ports)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(self.flash_port, ports))
+        self.wait_boot_checks()
+        return GangSummary(results, time.monotonic() - started)
@@ -0,0 +1,276 @@
+"""
+SQLite history of every flash attempt, for traceability and throughput analytics.
+
+Each attempt becomes one row in "flashes" (chip MAC, port, USB hub, firmware
+bundle hash, result, job attempt and baud retries, duration) with its per-region
+write and verify timings in "regions". Indexes cover lookups by device, by
+bundle and by time.
+
+FlashHistory.add() only puts the record on a queue and returns; a background
+thread writes queued records in one transaction per batch, so a slow disk or
+a locked database never holds up a flash. Pending records are written when
+the process exits.
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+
+from baud_policy import hub_for_port
+from flash_manifest import normalize_mac
+
+HISTORY_FILE = "flash_history.db"
+SCHEMA_VERSION = 1
+# Records written per transaction at most
+BATCH_SIZE = 100
+# Seconds a record may wait for more to share its transaction
+FLUSH_INTERVAL = 1.0
+# Seconds to wait for a database locked by another process
+BUSY_TIMEOUT = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flashes (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    mac TEXT,
+    port TEXT NOT NULL,
+    hub TEXT,
+    bundle TEXT,
+    unit TEXT,
+    success INTEGER NOT NULL,
+    returncode INTEGER,
+    error TEXT,
+    attempt INTEGER NOT NULL DEFAULT 1,
+    retries INTEGER NOT NULL DEFAULT 0,
+    baud INTEGER,
+    engine TEXT,
+    duration REAL,
+    bytes_written INTEGER,
+    written TEXT,
+    skipped TEXT,
+    phases TEXT
+);
+CREATE TABLE IF NOT EXISTS regions (
+    flash_id INTEGER NOT NULL REFERENCES flashes(id),
+    offset INTEGER NOT NULL,
+    size INTEGER,
+    compressed INTEGER,
+    write_seconds REAL,
+    verify_seconds REAL,
+    kbps REAL
+);
+CREATE INDEX IF NOT EXISTS flashes_by_device ON flashes(mac, time);
+CREATE INDEX IF NOT EXISTS flashes_by_bundle ON flashes(bundle, time);
+CREATE INDEX IF NOT EXISTS flashes_by_time ON flashes(time);
+CREATE INDEX IF NOT EXISTS regions_by_flash ON regions(flash_id);
+"""
+
+FLASH_COLUMNS = ["time", "mac", "port", "hub", "bundle", "unit", "success", "returncode", "error", "attempt",
+                 "retries", "baud", "engine", "duration", "bytes_written", "written", "skipped", "phases"]
+REGION_COLUMNS = ["offset", "size", "compressed", "write_seconds", "verify_seconds", "kbps"]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values (0 < fraction <= 1), or None if there are none
+    
+    Also used by benchmark.py, so its p50/p95 compare with the history's.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, int(-(-fraction * len(values) // 1)))
+    return values[min(rank, len(values)) - 1]
+
+
+def connect(path):
+    """Open the history database, creating the tables and indexes if needed"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    # Readers (the history command, a dashboard) never wait for the writer
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return connection
+
+
+class FlashHistory:
+    """Records flash attempts in SQLite from a background writer thread"""
+    
+    def __init__(self, path, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = max(1, int(batch_size))
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def add(self, result, record=None, bundle=None, attempt=1, engine=None):
+        """Queue one finished FlashResult; never blocks or raises
+        
+        record is the FlashTimeline record of the flash (phases and regions), if any.
+        """
+        record = record or {}
+        row = {
+            "time": time.time(),
+            "mac": normalize_mac(result.mac) if result.mac else None,
+            "port": result.port,
+            "hub": record.get("hub"),
+            "bundle": bundle,
+            "unit": getattr(result, "unit", None),
+            "success": 1 if result.success else 0,
+            "returncode": result.returncode,
+            "error": result.error or None,
+            "attempt": max(1, int(attempt or 1)),
+            "retries": getattr(result, "retries", 0),
+            "baud": result.baud,
+            "engine": engine or record.get("engine"),
+            "duration": round(result.duration, 3),
+            "bytes_written": record.get("bytes_written"),
+            "written": ",".join("0x%x" % offset for offset in getattr(result, "written", [])),
+            "skipped": ",".join("0x%x" % offset for offset in getattr(result, "skipped", [])),
+            "phases": json.dumps(record["phases"]) if record.get("phases") else None,
+            "regions": record.get("regions", []),
+        }
+        # The hub is looked up by the writer when metrics did not already find it
+        row["lookup_hub"] = "hub" not in record
+        self._queue.put(row)
+        self._start()
+    
+    def flush(self, timeout=None):
+        """Wait until every record queued so far is written; returns False on timeout"""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+    
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush, 10.0)
+    
+    def _run(self):
+        connection = None
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            rows = [item for item in batch if isinstance(item, dict)]
+            if rows:
+                try:
+                    if connection is None:
+                        connection = connect(self.path)
+                    self._write(connection, rows)
+                except (sqlite3.Error, OSError) as e:
+                    print(f"Warning: Could not write {len(rows)} flash history record(s): {e}")
+                    if connection is not None:
+                        connection.close()
+                    connection = None
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+    
+    def _write(self, connection, rows):
+        for row in rows:
+            if row["lookup_hub"]:
+                row["hub"] = hub_for_port(row["port"])
+        with connection:
+            for row in rows:
+                cursor = connection.execute(
+                    f"INSERT INTO flashes ({', '.join(FLASH_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in FLASH_COLUMNS)})",
+                    [row[column] for column in FLASH_COLUMNS])
+                connection.executemany(
+                    f"INSERT INTO regions (flash_id, {', '.join(REGION_COLUMNS)}) "
+                    f"VALUES (?, {', '.join('?' for _ in REGION_COLUMNS)})",
+                    [[cursor.lastrowid, int(region["offset"], 16), region["size"], region["compressed"],
+                      region["write_seconds"], region["verify_seconds"], region["kbps"]]
+                     for region in row["regions"]])
+
+
+def summarize(path, since=None, bundle=None):
+    """Throughput and failure statistics of the flashes recorded at path
+    
+    since limits the summary to flashes after that Unix time; bundle to
+    bundle hashes starting with that prefix.
+    """
+    connection = connect(path)
+    try:
+        where, params = ["1"], []
+        if since is not None:
+            where.append("time >= ?")
+            params.append(since)
+        if bundle:
+            where.append("bundle LIKE ?")
+            params.append(bundle + "%")
+        where = " AND ".join(where)
+        rows = connection.execute(
+            f"SELECT time, mac, port, hub, success, attempt, retries, duration FROM flashes "
+            f"WHERE {where} ORDER BY time", params).fetchall()
+        hours = connection.execute(
+            f"SELECT strftime('%Y-%m-%d %H:00', time, 'unixepoch', 'localtime') AS hour, SUM(success), "
+            f"SUM(1 - success) FROM flashes WHERE {where} GROUP BY hour ORDER BY hour", params).fetchall()
+        regions = connection.execute(
+            f"SELECT regions.offset, regions.write_seconds FROM regions JOIN flashes ON flashes.id = regions.flash_id "
+            f"WHERE {where} AND flashes.success = 1", params).fetchall()
+    finally:
+        connection.close()
+    
+    def failure_rates(key):
+        totals = {}
+        for row in rows:
+            name = key(row) or "-"
+            total, failed = totals.get(name, (0, 0))
+            totals[name] = (total + 1, failed + (0 if row[4] else 1))
+        return [(name, total, failed, failed * 100.0 / total) for name, (total, failed) in sorted(totals.items())]
+    
+    durations = [row[7] for row in rows if row[4] and row[7] is not None]
+    region_times = {}
+    for offset, seconds in regions:
+        region_times.setdefault(offset, []).append(seconds)
+    passed = sum(1 for row in rows if row[4])
+    # Distinct boards, so a reflashed board counts once, over the whole span (idle hours included)
+    boards = len(set(row[1] for row in rows if row[4] and row[1]))
+    span = rows[-1][0] - rows[0][0] if rows else 0.0
+    return {
+        "flashes": len(rows),
+        "passed": passed,
+        "failed": len(rows) - passed,
+        "boards": boards,
+        "retried": sum(1 for row in rows if row[5] > 1 or row[6]),
+        "first": rows[0][0] if rows else None,
+        "last": rows[-1][0] if rows else None,
+        "hours": hours,
+        "boards_per_hour": boards / (span / 3600.0) if span > 0 else None,
+        "ports": failure_rates(lambda row: row[2]),
+        "hubs": failure_rates(lambda row: row[3]),
+        "p50": percentile(durations, 0.50),
+        "p95": percentile(durations, 0.95),
+        "regions": [(offset, percentile(times, 0.50), percentile(times, 0.95))
+                    for offset, times in sorted(region_times.items())],
+    }
+
+
+def device_history(path, mac):
+    """Every recorded flash of the board with this MAC, oldest first, as dicts"""
+    connection = connect(path)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute("SELECT * FROM flashes WHERE mac = ? ORDER BY time", (normalize_mac(mac),)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        connection.close()
@@ -0,0 +1,115 @@
+"""
+Record of what was last written to each board, keyed by chip MAC.
+Lets a reflash write only the regions whose content actually changed.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+HASH_CHUNK = 1024 * 1024
+
+# (path, size, mtime) -> sha256, so unchanged files are only hashed once per process
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+
+def file_sha256(path):
+    """Return the hex SHA-256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_sha256(path):
+    """Return the SHA-256 of a file, reusing the result while the file is unchanged"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        cached = _hash_memo.get(key)
+    if cached is None:
+        cached = file_sha256(path)
+        with _hash_lock:
+            _hash_memo[key] = cached
+    return cached
+
+
+def normalize_mac(mac):
+    return mac.strip().lower().replace("-", ":")
+
+
+class FlashManifest:
+    """JSON file mapping chip MAC -> {offset: sha256} of the regions on that board"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.devices = {}
+        self._lock = threading.Lock()
+        self.load()
+    
+    def load(self):
+        """Load the manifest; a missing or damaged file starts empty"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.devices = json.load(f).get("devices", {})
+        except Exception as e:
+            print(f"Warning: Could not load flash manifest: {e}")
+            self.devices = {}
+    
+    def save(self):
+        """Write the manifest atomically so a crash never leaves half a file"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"devices": self.devices}, f, indent=4)
+        os.replace(tmp_path, self.path)
+    
+    def image_hash(self, path):
+        """Return the SHA-256 of an image"""
+        return cached_file_sha256(path)
+    
+    def plan(self, mac, images):
+        """Split images into (to_write, unchanged) against what the board last received"""
+        with self._lock:
+            regions = dict(self.devices.get(normalize_mac(mac), {}).get("regions", {}))
+        to_write = []
+        unchanged = []
+        for offset, path in images:
+            if regions.get(hex(offset), {}).get("sha256") == self.image_hash(path):
+                unchanged.append((offset, path))
+            else:
+                to_write.append((offset, path))
+        return to_write, unchanged
+    
+    def record(self, mac, images):
+        """Remember that images are now on the board with this MAC"""
+        regions = {}
+        for offset, path in images:
+            regions[hex(offset)] = {
+                "sha256": self.image_hash(path),
+                "size": os.path.getsize(path),
+                "file": os.path.basename(path),
+            }
+        with self._lock:
+            device = self.devices.setdefault(normalize_mac(mac), {"regions": {}})
+            device["regions"].update(regions)
+            device["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Warning: Could not save flash manifest: {e}")
+    
+    def invalidate(self, mac, offsets):
+        """Forget regions whose write was interrupted, so they are never skipped"""
+        with self._lock:
+            regions = self.devices.get(normalize_mac(mac), {}).get("regions", {})
+            for offset in offsets:
+                regions.pop(hex(offset), None)
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Warning: Could not save flash manifest: {e}")
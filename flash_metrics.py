@@ -0,0 +1,235 @@
+"""
+Per-phase timing of each flash, parsed from the esptool output.
+
+FlashTimeline follows the lines of one flash and splits the wall time into
+phases: startup (until esptool says "Connecting"), connect (sync with the ROM
+loader), chip_detect, stub, baud_change, flash_setup, compress (reading and
+deflating the next region), write, verify and hard_reset. Each region also
+gets its own record with the sizes, the write time esptool reports and the
+effective kbit/s.
+
+MetricsRecorder appends one JSON line per flash to flash_metrics.jsonl and
+rewrites a Prometheus text file (for node_exporter's textfile collector)
+with totals per port and USB hub. The totals are rebuilt from the JSON lines
+before the first flash of a process, so counters never go back to zero.
+"""
+import os
+import re
+import json
+import time
+import threading
+from collections import defaultdict
+
+from baud_policy import hub_for_port
+
+JSONL_FILE = "flash_metrics.jsonl"
+PROM_FILE = "esp32_flasher.prom"
+
+PHASES = ["startup", "connect", "chip_detect", "stub", "baud_change", "flash_setup", "compress", "write",
+          "verify", "hard_reset"]
+
+COMPRESSED_RE = re.compile(r"Compressed (\d+) bytes to (\d+)")
+WROTE_RE = re.compile(r"Wrote (\d+) bytes(?: \((\d+) compressed\))? at 0x([0-9a-fA-F]+) in ([\d.]+) seconds"
+                      r"(?: \(effective ([\d.]+) kbit/s\))?")
+
+# Line prefix -> phase it starts
+PHASE_STARTS = [
+    ("Connecting", "connect"),
+    ("Detecting chip type", "chip_detect"),
+    ("Chip is", "chip_detect"),
+    ("Uploading stub", "stub"),
+    ("Changing baud rate", "baud_change"),
+    ("Configuring flash size", "flash_setup"),
+    ("Flash will be erased", "compress"),
+    ("Leaving", "hard_reset"),
+]
+
+
+class FlashTimeline:
+    """Phase and region timings of one flash, fed line by line"""
+    
+    def __init__(self, port, started=None):
+        self.port = port
+        self.started = time.monotonic() if started is None else started
+        self.phases = defaultdict(float)
+        self.regions = []
+        self.phase = "startup"
+        self.phase_started = self.started
+        self.pending_sizes = None
+    
+    def _begin(self, phase, now):
+        if phase == self.phase:
+            return
+        self.phases[self.phase] += now - self.phase_started
+        self.phase = phase
+        self.phase_started = now
+    
+    def feed(self, line, now=None):
+        now = time.monotonic() if now is None else now
+        match = COMPRESSED_RE.search(line)
+        if match:
+            self.pending_sizes = (int(match.group(1)), int(match.group(2)))
+            self._begin("write", now)
+            return
+        match = WROTE_RE.search(line)
+        if match:
+            size = int(match.group(1))
+            compressed = int(match.group(2)) if match.group(2) else None
+            if compressed is None and self.pending_sizes:
+                compressed = self.pending_sizes[1]
+            seconds = float(match.group(4))
+            kbps = float(match.group(5)) if match.group(5) else (size * 8 / 1000.0 / seconds if seconds else None)
+            self.regions.append({
+                "offset": "0x%x" % int(match.group(3), 16),
+                "size": size,
+                "compressed": compressed,
+                "ratio": round(compressed / float(size), 3) if compressed and size else None,
+                "write_seconds": seconds,
+                "kbps": kbps,
+                "verify_seconds": None,
+            })
+            self.pending_sizes = None
+            self._begin("verify", now)
+            return
+        if "Hash of data verified" in line and self.regions and self.phase == "verify":
+            self.regions[-1]["verify_seconds"] = round(now - self.phase_started, 3)
+            self._begin("compress", now)
+            return
+        for prefix, phase in PHASE_STARTS:
+            if line.startswith(prefix):
+                self._begin(phase, now)
+                return
+    
+    def to_record(self, result, now=None, **labels):
+        """Close the last phase and return the JSON-ready record for this flash"""
+        now = time.monotonic() if now is None else now
+        self._begin(None, now)
+        written = sum(region["size"] for region in self.regions)
+        write_seconds = sum(region["write_seconds"] for region in self.regions)
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "port": self.port,
+            "success": result.success,
+            "returncode": result.returncode,
+            "error": result.error or None,
+            "mac": result.mac,
+            "baud": result.baud,
+            "duration": round(now - self.started, 3),
+            "phases": dict((phase, round(self.phases[phase], 3)) for phase in PHASES if phase in self.phases),
+            "regions": self.regions,
+            "bytes_written": written,
+            "throughput_kbps": round(written * 8 / 1000.0 / write_seconds, 1) if write_seconds else None,
+        }
+        record.update(labels)
+        return record
+
+
+def _labels(**labels):
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + "}"
+
+
+class MetricsRecorder:
+    """Writes flash records as JSON lines and keeps a Prometheus text file up to date"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.jsonl_path = os.path.join(directory, JSONL_FILE)
+        self.prom_path = os.path.join(directory, PROM_FILE)
+        self._lock = threading.Lock()
+        self._flashes = defaultdict(int)            # (port, hub, result) -> count
+        self._duration = defaultdict(float)         # (port, hub) -> seconds
+        self._phases = defaultdict(float)           # (port, hub, phase) -> seconds
+        self._phase_counts = defaultdict(int)
+        self._bytes = defaultdict(int)              # (port, hub) -> bytes written
+        self._write_seconds = defaultdict(float)
+        self._last_kbps = {}                        # (port, hub, offset) -> kbit/s
+        self._last_baud = {}                        # (port, hub) -> baud
+        self._loaded = False
+    
+    def start(self, port):
+        """Begin timing a flash on port"""
+        return FlashTimeline(port)
+    
+    def finish(self, timeline, result, **labels):
+        """Record a finished flash; returns the record"""
+        hub = hub_for_port(timeline.port)
+        record = timeline.to_record(result, hub=hub, **labels)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._add(record)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + "\n")
+                self._write_prom()
+            except OSError as e:
+                print(f"Warning: Could not write flash metrics: {e}")
+        return record
+    
+    def _load(self):
+        """Rebuild the totals from the records written by earlier runs"""
+        self._loaded = True
+        try:
+            with open(self.jsonl_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._add(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        continue  # a line cut short by a crash
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Could not read earlier flash metrics: {e}")
+    
+    def _add(self, record):
+        key = (record["port"], record.get("hub") or "")
+        self._flashes[key + ("pass" if record["success"] else "fail",)] += 1
+        self._duration[key] += record["duration"]
+        for phase, seconds in record["phases"].items():
+            self._phases[key + (phase,)] += seconds
+            self._phase_counts[key + (phase,)] += 1
+        for region in record["regions"]:
+            self._bytes[key] += region["size"]
+            self._write_seconds[key] += region["write_seconds"]
+            if region["kbps"]:
+                self._last_kbps[key + (region["offset"],)] = region["kbps"]
+        if record.get("baud"):
+            self._last_baud[key] = record["baud"]
+    
+    def _write_prom(self):
+        lines = []
+        
+        def metric(name, kind, help_text, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values:
+                lines.append(f"{name}{_labels(**labels)} {value}")
+        
+        metric("esp32_flash_total", "counter", "Flashes by port, USB hub and result",
+               [({"port": port, "hub": hub, "result": outcome}, count)
+                for (port, hub, outcome), count in sorted(self._flashes.items())])
+        metric("esp32_flash_duration_seconds_total", "counter", "Wall time spent flashing",
+               [({"port": port, "hub": hub}, round(seconds, 3)) for (port, hub), seconds in sorted(self._duration.items())])
+        metric("esp32_flash_phase_seconds_total", "counter", "Wall time per flash phase",
+               [({"port": port, "hub": hub, "phase": phase}, round(seconds, 3))
+                for (port, hub, phase), seconds in sorted(self._phases.items())])
+        metric("esp32_flash_phase_count_total", "counter", "Flashes that went through each phase",
+               [({"port": port, "hub": hub, "phase": phase}, count)
+                for (port, hub, phase), count in sorted(self._phase_counts.items())])
+        metric("esp32_flash_bytes_written_total", "counter", "Uncompressed bytes written",
+               [({"port": port, "hub": hub}, count) for (port, hub), count in sorted(self._bytes.items())])
+        metric("esp32_flash_write_seconds_total", "counter", "Region write time reported by esptool",
+               [({"port": port, "hub": hub}, round(seconds, 3))
+                for (port, hub), seconds in sorted(self._write_seconds.items())])
+        metric("esp32_flash_region_kbps", "gauge", "Effective kbit/s of the last write of each region",
+               [({"port": port, "hub": hub, "offset": offset}, kbps)
+                for (port, hub, offset), kbps in sorted(self._last_kbps.items())])
+        metric("esp32_flash_baud", "gauge", "Baud rate of the last flash",
+               [({"port": port, "hub": hub}, baud) for (port, hub), baud in sorted(self._last_baud.items())])
+        
+        tmp_path = self.prom_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
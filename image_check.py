@@ -0,0 +1,345 @@
+"""
+Local sanity checks of the four images before anything is sent to a board.
+
+Each file is checked against the slot it is flashed to: the bootloader and
+the application must be ESP32 images (magic byte, segment table, checksum and
+the appended SHA-256 when the header says there is one), the file at 0x8000
+must be a binary partition table (entries, MD5 entry), boot_app0 must fit the
+otadata partition, and the application must fit the app partition that
+starts at its offset. Swapped files and images built for another chip are
+caught here in milliseconds instead of after a serial connect and a partial
+write. Flash sizes that differ between the headers and the partition table
+are only warned about: esptool writes with --flash_size keep, and mixed header
+sizes are common in Arduino builds.
+
+Parsed files are cached by content hash and whole-bundle results by bundle
+key, so checking the same files again costs a stat() per file.
+"""
+import os
+import struct
+import hashlib
+import threading
+
+from flash_manifest import cached_file_sha256
+from bundle_cache import BundleError, bundle_key, check_images
+
+BOOTLOADER_OFFSET = 0x1000
+PARTITION_TABLE_OFFSET = 0x8000
+PARTITION_TABLE_SIZE = 0xC00
+OTADATA_OFFSET = 0xe000
+
+IMAGE_MAGIC = 0xE9
+CHECKSUM_SEED = 0xEF
+HEADER_SIZE = 24          # common header (8) + extended header (16)
+SEGMENT_HEADER_SIZE = 8
+MAX_SEGMENTS = 16
+
+PARTITION_MAGIC = b"\xaa\x50"
+PARTITION_MD5_MAGIC = b"\xeb\xeb"
+PARTITION_ENTRY_SIZE = 32
+APP_PARTITION_ALIGN = 0x10000
+
+PARTITION_TYPE_APP = 0x00
+PARTITION_TYPE_DATA = 0x01
+PARTITION_SUBTYPE_OTA = 0x00
+PARTITION_SUBTYPE_NVS = 0x02
+
+CHIP_IDS = {0: "ESP32", 2: "ESP32-S2", 5: "ESP32-C3", 9: "ESP32-S3", 12: "ESP32-C2", 13: "ESP32-C6", 16: "ESP32-H2"}
+ESP32_CHIP_ID = 0
+
+# Header nibble -> flash size in bytes
+FLASH_SIZES = dict((code, (1 << code) * 1024 * 1024) for code in range(8))
+# Largest flash an ESP32 module has; a partition table past this fits no board
+MAX_FLASH_SIZE = 16 * 1024 * 1024
+
+# Address ranges the ESP32 maps from flash (DROM, IROM); only applications load segments there
+FLASH_MAPPED_RANGES = [(0x3F400000, 0x3F800000), (0x400C2000, 0x40C00000)]
+
+# sha256 -> parsed file (or the ImageCheckError it raised); bundle key -> (errors, warnings)
+_parsed = {}
+_results = {}
+_lock = threading.Lock()
+
+
+class ImageCheckError(Exception):
+    """A file is not what its flash slot needs"""
+
+
+class ImageInfo:
+    """Header fields of an ESP32 image"""
+    
+    def __init__(self, size, segments, entry, flash_size, chip_id, hash_appended):
+        self.size = size
+        self.segments = segments      # [(load address, length)]
+        self.entry = entry
+        self.flash_size = flash_size  # bytes, None if the header value is unknown
+        self.chip_id = chip_id
+        self.hash_appended = hash_appended
+    
+    @property
+    def is_app(self):
+        """True if any segment is mapped from flash, which only applications do"""
+        return any(start <= address < end for address, _ in self.segments for start, end in FLASH_MAPPED_RANGES)
+
+
+class Partition:
+    """One entry of the partition table"""
+    
+    def __init__(self, label, type_, subtype, offset, size):
+        self.label = label
+        self.type = type_
+        self.subtype = subtype
+        self.offset = offset
+        self.size = size
+    
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+def format_size(size):
+    if size % (1024 * 1024) == 0:
+        return f"{size // (1024 * 1024)}MB"
+    return f"{size} bytes"
+
+
+def describe(data):
+    """Guess what a file that failed its check really is, for the error message"""
+    if data[:1] == bytes([IMAGE_MAGIC]):
+        return "an ESP32 image"
+    if data[:2] == PARTITION_MAGIC:
+        return "a partition table"
+    if data and data.count(b"\xff") == len(data):
+        return "all 0xFF (blank)"
+    return None
+
+
+def xor_bytes(data):
+    """XOR of all bytes, folding the data as one big integer instead of looping per byte"""
+    value = int.from_bytes(data, "little")
+    width = len(data)
+    while width > 1:
+        half = (width + 1) // 2
+        value = (value & ((1 << (8 * half)) - 1)) ^ (value >> (8 * half))
+        width = half
+    return value
+
+
+def parse_image(data):
+    """Return ImageInfo for an ESP32 image; raises ImageCheckError (message follows the file name)"""
+    if len(data) < HEADER_SIZE or data[0] != IMAGE_MAGIC:
+        what = describe(data)
+        raise ImageCheckError("is not an ESP32 image" + (f" (it looks like {what})" if what else ""))
+    segment_count = data[1]
+    if not 0 < segment_count <= MAX_SEGMENTS:
+        raise ImageCheckError(f"has an invalid segment count ({segment_count})")
+    flash_size = FLASH_SIZES.get(data[3] >> 4)
+    entry = struct.unpack_from("<I", data, 4)[0]
+    chip_id = struct.unpack_from("<H", data, 12)[0]
+    hash_appended = data[23] == 1
+    
+    segments = []
+    checksum = CHECKSUM_SEED
+    pos = HEADER_SIZE
+    for index in range(segment_count):
+        if pos + SEGMENT_HEADER_SIZE > len(data):
+            raise ImageCheckError(f"is truncated (segment {index} header missing)")
+        address, length = struct.unpack_from("<II", data, pos)
+        pos += SEGMENT_HEADER_SIZE
+        if pos + length > len(data):
+            raise ImageCheckError(f"is truncated (segment {index} needs {length} bytes at 0x{pos:x})")
+        checksum ^= xor_bytes(data[pos:pos + length])
+        segments.append((address, length))
+        pos += length
+    
+    # The checksum byte ends a 16-byte block
+    pos += 15 - pos % 16
+    if pos >= len(data):
+        raise ImageCheckError("is truncated (checksum missing)")
+    if data[pos] != checksum:
+        raise ImageCheckError(f"fails its checksum (image says 0x{data[pos]:02x}, content gives 0x{checksum:02x}): "
+                              f"the file is corrupt")
+    pos += 1
+    if hash_appended:
+        digest = data[pos:pos + 32]
+        if len(digest) < 32:
+            raise ImageCheckError("is truncated (SHA-256 digest missing)")
+        if hashlib.sha256(data[:pos]).digest() != digest:
+            raise ImageCheckError("fails its SHA-256 digest: the file is corrupt")
+    return ImageInfo(len(data), segments, entry, flash_size, chip_id, hash_appended)
+
+
+def parse_partition_table(data):
+    """Return [Partition] from a binary partition table; raises ImageCheckError (message follows the file name)"""
+    if data[:2] != PARTITION_MAGIC:
+        what = describe(data)
+        raise ImageCheckError("is not a partition table" + (f" (it looks like {what})" if what else ""))
+    if len(data) > PARTITION_TABLE_SIZE:
+        raise ImageCheckError(f"is {len(data)} bytes, a partition table is at most {PARTITION_TABLE_SIZE}")
+    partitions = []
+    for pos in range(0, len(data) - PARTITION_ENTRY_SIZE + 1, PARTITION_ENTRY_SIZE):
+        entry = data[pos:pos + PARTITION_ENTRY_SIZE]
+        if entry[:2] == PARTITION_MAGIC:
+            type_, subtype, offset, size = struct.unpack_from("<BBII", entry, 2)
+            label = entry[12:28].split(b"\x00", 1)[0].decode("ascii", "replace")
+            partitions.append(Partition(label, type_, subtype, offset, size))
+        elif entry[:2] == PARTITION_MD5_MAGIC:
+            if hashlib.md5(data[:pos]).digest() != entry[16:32]:
+                raise ImageCheckError("fails its MD5 check: the partition table is corrupt")
+        elif entry == b"\xff" * PARTITION_ENTRY_SIZE:
+            break
+        else:
+            raise ImageCheckError(f"has an invalid entry at 0x{pos:x}")
+    if not partitions:
+        raise ImageCheckError("has no partitions")
+    
+    previous = None
+    for partition in sorted(partitions, key=lambda p: p.offset):
+        if partition.offset < PARTITION_TABLE_OFFSET + PARTITION_TABLE_SIZE:
+            raise ImageCheckError(f"puts partition '{partition.label}' at 0x{partition.offset:x}, over the bootloader "
+                                  f"or the partition table")
+        if previous is not None and partition.offset < previous.end:
+            raise ImageCheckError(f"has overlapping partitions '{previous.label}' and '{partition.label}'")
+        if partition.type == PARTITION_TYPE_APP and partition.offset % APP_PARTITION_ALIGN:
+            raise ImageCheckError(f"has app partition '{partition.label}' at 0x{partition.offset:x}, which is not "
+                                  f"64KB aligned")
+        previous = partition
+    return partitions
+
+
+def load(path, parse):
+    """Parse a file with parse(data), cached by content hash"""
+    key = (parse.__name__, cached_file_sha256(path))
+    with _lock:
+        cached = _parsed.get(key)
+    if cached is None:
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            cached = parse(data)
+        except ImageCheckError as e:
+            cached = e
+        with _lock:
+            _parsed[key] = cached
+    if isinstance(cached, ImageCheckError):
+        raise ImageCheckError(f"{os.path.basename(path)} {cached}")
+    return cached
+
+
+def check_chip(info, name, errors):
+    if info.chip_id != ESP32_CHIP_ID:
+        chip = CHIP_IDS.get(info.chip_id, f"chip id {info.chip_id}")
+        errors.append(f"{name} is built for {chip}, not ESP32")
+
+
+def check_bundle(images):
+    """Check [(offset, path)] against their flash slots; returns (errors, warnings)
+    
+    Results are cached per bundle, so this is cheap to call before every flash.
+    """
+    if not all(path and os.path.isfile(path) for _, path in images):
+        try:
+            check_images(images)
+        except BundleError as e:
+            return [str(e)], []
+    try:
+        key = bundle_key(images)
+    except OSError as e:
+        return [str(e)], []
+    with _lock:
+        cached = _results.get(key)
+    if cached is None:
+        cached = _check(images)
+        with _lock:
+            _results[key] = cached
+    return list(cached[0]), list(cached[1])
+
+
+def _check(images):
+    errors = []
+    warnings = []
+    by_offset = dict(images)
+    bootloader = partitions = None
+    
+    path = by_offset.get(BOOTLOADER_OFFSET)
+    if path:
+        name = os.path.basename(path)
+        try:
+            bootloader = load(path, parse_image)
+            check_chip(bootloader, name, errors)
+            if bootloader.is_app:
+                errors.append(f"{name} at 0x{BOOTLOADER_OFFSET:x} looks like an application, not a bootloader")
+        except ImageCheckError as e:
+            errors.append(str(e))
+    
+    path = by_offset.get(PARTITION_TABLE_OFFSET)
+    if path:
+        name = os.path.basename(path)
+        try:
+            partitions = load(path, parse_partition_table)
+        except ImageCheckError as e:
+            errors.append(str(e))
+    
+    flash_size = bootloader.flash_size if bootloader else None
+    if partitions:
+        end = max(partition.end for partition in partitions)
+        if end > MAX_FLASH_SIZE:
+            errors.append(f"The partition table needs {format_size(end)} of flash, more than any ESP32 board has")
+        elif flash_size and end > flash_size:
+            warnings.append(f"The partition table needs {format_size(end)} of flash but the bootloader header "
+                            f"says {format_size(flash_size)}; make sure the board has enough")
+    
+    for offset, path in sorted(images):
+        if offset in (BOOTLOADER_OFFSET, PARTITION_TABLE_OFFSET) or not path:
+            continue
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        partition = None
+        if partitions:
+            partition = next((p for p in partitions if p.offset == offset), None)
+        
+        if offset == OTADATA_OFFSET:
+            with open(path, "rb") as f:
+                what = describe(f.read(PARTITION_TABLE_SIZE))
+            if what in ("an ESP32 image", "a partition table"):
+                errors.append(f"{name} at 0x{offset:x} looks like {what}, not boot_app0 (otadata)")
+            elif partitions and (partition is None or partition.type != PARTITION_TYPE_DATA
+                                 or partition.subtype != PARTITION_SUBTYPE_OTA):
+                warnings.append(f"The partition table has no otadata partition at 0x{offset:x} for {name}")
+            if partition is not None and size > partition.size:
+                errors.append(f"{name} is {size} bytes but partition '{partition.label}' holds {partition.size}")
+            continue
+        
+        if (partition is not None and partition.type == PARTITION_TYPE_DATA
+                and partition.subtype == PARTITION_SUBTYPE_NVS):
+            # A provisioned NVS image: it only has to fit
+            if size > partition.size:
+                errors.append(f"{name} is {size} bytes but partition '{partition.label}' holds {partition.size}")
+            continue
+        
+        try:
+            app = load(path, parse_image)
+        except ImageCheckError as e:
+            errors.append(str(e))
+            continue
+        check_chip(app, name, errors)
+        if not app.is_app:
+            errors.append(f"{name} at 0x{offset:x} looks like a bootloader, not an application")
+        if flash_size and app.flash_size and app.flash_size != flash_size:
+            warnings.append(f"{name} is built for {format_size(app.flash_size)} flash but the bootloader is "
+                            f"built for {format_size(flash_size)}")
+        if partitions:
+            if partition is None or partition.type != PARTITION_TYPE_APP:
+                errors.append(f"No app partition starts at 0x{offset:x} for {name}")
+            elif size > partition.size:
+                errors.append(f"{name} is {size} bytes, too big for partition '{partition.label}' "
+                              f"({partition.size} bytes)")
+            elif size > partition.size * 0.95:
+                warnings.append(f"{name} uses {100 * size // partition.size}% of partition '{partition.label}'")
+    
+    # Overlaps last: for swapped files the messages above say what went wrong
+    try:
+        check_images(images)
+    except BundleError as e:
+        errors.append(str(e))
+    return errors, warnings
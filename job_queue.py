@@ -0,0 +1,295 @@
+"""
+Persistent flash job queue.
+
+A job is one port to flash with a given set of images. Jobs are kept in
+flash_jobs.json, so after a crash or restart the queue carries on with what
+was still waiting (a job that was running is started again). Jobs that fail
+with a transient error (lost sync, a timeout, a busy port) are retried with
+increasing back-off, and ports on the same USB hub share a concurrency limit.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from flash_core import FlashResult, DEFAULT_GANG_WORKERS
+from baud_policy import hub_for_port
+
+DEFAULT_MAX_PER_HUB = 4
+DEFAULT_MAX_ATTEMPTS = 4
+# Seconds to wait before the 2nd, 3rd, 4th ... attempt
+BACKOFF = [5, 15, 60]
+# Finished jobs kept in the file for reference
+KEEP_FINISHED = 200
+
+# Errors (besides serial link errors) that may go away on their own
+TRANSIENT_ERRORS = [
+    "could not open port",
+    "resource busy",
+    "device disconnected",
+    "device not configured",
+    "access is denied",
+    "write timeout",
+]
+
+QUEUED = "queued"
+RUNNING = "running"
+RETRY = "retry"
+DONE = "done"
+FAILED = "failed"
+PENDING_STATES = (QUEUED, RUNNING, RETRY)
+
+
+def is_transient(result):
+    """True if a failed FlashResult is worth retrying later"""
+    if result.link_error or result.connect_error:
+        return True
+    error = (result.error or "").lower()
+    return any(message in error for message in TRANSIENT_ERRORS)
+
+
+class FlashJob:
+    """One port to flash, with its retry state"""
+    
+    def __init__(self, port, images, hub=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.port = port
+        self.images = [(offset, path) for offset, path in images]
+        self.hub = hub
+        self.state = QUEUED
+        self.attempts = 0
+        self.next_at = 0.0
+        self.error = ""
+        self.mac = None
+        self.created = time.time()
+        self.finished = None
+    
+    @property
+    def pending(self):
+        return self.state in PENDING_STATES
+    
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "port": self.port,
+            "images": [[offset, path] for offset, path in self.images],
+            "hub": self.hub,
+            "state": self.state,
+            "attempts": self.attempts,
+            "next_at": self.next_at,
+            "error": self.error,
+            "mac": self.mac,
+            "created": self.created,
+            "finished": self.finished,
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data["port"], data["images"], data.get("hub"), data["id"])
+        job.state = data.get("state", QUEUED)
+        job.attempts = data.get("attempts", 0)
+        job.next_at = data.get("next_at", 0.0)
+        job.error = data.get("error", "")
+        job.mac = data.get("mac")
+        job.created = data.get("created", job.created)
+        job.finished = data.get("finished")
+        return job
+
+
+class JobQueue:
+    """Run queued FlashJobs with flash(job) -> FlashResult on a worker pool
+    
+    on_event(job, kind, value) is called from worker threads with kind one of
+    "start", "retry" (value is the delay in seconds) or "done" (value is the
+    FlashResult; job.state is then DONE or FAILED).
+    
+    check(job, result), if given, runs after each successful flash on a pool of
+    its own (a boot check, say) and may fail the result. The flash slot is free
+    for the next job meanwhile; only the port stays busy until the check is done.
+    """
+    
+    def __init__(self, path, flash, max_workers=DEFAULT_GANG_WORKERS, max_per_hub=DEFAULT_MAX_PER_HUB,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, on_event=None, check=None):
+        self.path = path
+        self.flash = flash
+        self.check = check
+        self.max_workers = max(1, int(max_workers))
+        self.max_per_hub = max(1, int(max_per_hub))
+        self.max_attempts = max(1, int(max_attempts))
+        self.on_event = on_event
+        self.jobs = []
+        self._cond = threading.Condition()
+        self._busy_ports = set()
+        self._flashing = 0
+        self._hub_load = defaultdict(int)
+        self._stopped = False
+        self._thread = None
+        self._pool = None
+        self._check_pool = None
+        self.load()
+    
+    def load(self):
+        """Load the queue; jobs that were running when the process ended run again"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.jobs = [FlashJob.from_dict(data) for data in json.load(f).get("jobs", [])]
+        except Exception as e:
+            print(f"Warning: Could not load flash job queue: {e}")
+            self.jobs = []
+        for job in self.jobs:
+            if job.state == RUNNING:
+                job.state = QUEUED
+                job.next_at = 0.0
+    
+    def save(self):
+        """Write the queue atomically (call with the lock held)"""
+        finished = [job for job in self.jobs if not job.pending]
+        if len(finished) > KEEP_FINISHED:
+            drop = set(id(job) for job in finished[:len(finished) - KEEP_FINISHED])
+            self.jobs = [job for job in self.jobs if id(job) not in drop]
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"jobs": [job.to_dict() for job in self.jobs]}, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Warning: Could not save flash job queue: {e}")
+    
+    def pending(self):
+        with self._cond:
+            return [job for job in self.jobs if job.pending]
+    
+    def snapshot(self):
+        """Every job, waiting or finished"""
+        with self._cond:
+            return list(self.jobs)
+    
+    def add(self, port, images, hub=None):
+        """Queue a flash of port; returns the job, or None if the port already has one waiting"""
+        # The hub lookup lists USB devices, so it is done before taking the lock
+        hub = hub or hub_for_port(port)
+        with self._cond:
+            if any(job.port == port and job.pending for job in self.jobs):
+                return None
+            job = FlashJob(port, images, hub)
+            self.jobs.append(job)
+            self.save()
+            self._cond.notify_all()
+        return job
+    
+    def clear(self):
+        """Drop every job that is waiting (running jobs finish normally)"""
+        with self._cond:
+            self.jobs = [job for job in self.jobs if job.state == RUNNING or not job.pending]
+            self.save()
+    
+    def start(self):
+        """Start the scheduler thread"""
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        if self.check is not None:
+            from boot_check import DEFAULT_WORKERS
+            self._check_pool = ThreadPoolExecutor(max_workers=max(DEFAULT_WORKERS, self.max_workers))
+        self._thread = threading.Thread(target=self._schedule, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        if self._check_pool is not None:
+            self._check_pool.shutdown(wait=False)
+    
+    def wait_idle(self):
+        """Block until no job is waiting or running"""
+        with self._cond:
+            while not self._stopped and any(job.pending for job in self.jobs):
+                self._cond.wait(1.0)
+    
+    def _schedule(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                started = False
+                waiting = sorted((job for job in self.jobs if job.state in (QUEUED, RETRY)),
+                                 key=lambda job: (job.next_at, job.created))
+                for job in waiting:
+                    if self._flashing >= self.max_workers:
+                        break
+                    if job.next_at > now or job.port in self._busy_ports:
+                        continue
+                    if job.hub is not None and self._hub_load[job.hub] >= self.max_per_hub:
+                        continue
+                    job.state = RUNNING
+                    job.attempts += 1
+                    self._busy_ports.add(job.port)
+                    self._flashing += 1
+                    self._hub_load[job.hub] += 1
+                    self._pool.submit(self._run, job)
+                    started = True
+                if started:
+                    self.save()
+                # Sleep until the next retry is due, or until a job is added or finishes
+                due = [job.next_at - now for job in waiting if job.state == RETRY and job.next_at > now]
+                self._cond.wait(min(due) if due else None)
+    
+    def _run(self, job):
+        self._emit(job, "start")
+        try:
+            result = self.flash(job)
+        except Exception as e:
+            result = FlashResult(job.port, -1, 0.0, str(e))
+        with self._cond:
+            self._flashing -= 1
+            self._hub_load[job.hub] -= 1
+            self._cond.notify_all()
+        if result.success and self.check is not None:
+            try:
+                self._check_pool.submit(self._check, job, result)
+            except RuntimeError:
+                # Stopping: the check pool takes no more work, so check here
+                self._check(job, result)
+        else:
+            self._finish(job, result)
+    
+    def _check(self, job, result):
+        try:
+            self.check(job, result)
+        except Exception as e:
+            result.error = f"Check after flashing failed: {e}"
+        self._finish(job, result)
+    
+    def _finish(self, job, result):
+        delay = None
+        with self._cond:
+            self._busy_ports.discard(job.port)
+            job.mac = result.mac or job.mac
+            if result.success:
+                job.state = DONE
+                job.error = ""
+            else:
+                job.error = result.error or f"return code {result.returncode}"
+                if is_transient(result) and job.attempts < self.max_attempts:
+                    delay = BACKOFF[min(job.attempts - 1, len(BACKOFF) - 1)]
+                    job.state = RETRY
+                    job.next_at = time.time() + delay
+                else:
+                    job.state = FAILED
+            if not job.pending:
+                job.finished = time.time()
+            self.save()
+            self._cond.notify_all()
+        if delay is not None:
+            self._emit(job, "retry", delay)
+        else:
+            self._emit(job, "done", result)
+    
+    def _emit(self, job, kind, value=None):
+        if self.on_event:
+            self.on_event(job, kind, value)
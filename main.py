@@ -1,21 +1,58 @@
+import time
+STARTED = time.perf_counter()
+import sys
+
+# Worker processes of the frozen executable (NVS image generation) start through main.py too
+if __name__ == "__main__" and getattr(sys, 'frozen', False):
+    import multiprocessing
+    multiprocessing.freeze_support()
+
+# Any command line arguments select the headless CLI, which must never load tkinter
+if __name__ == "__main__" and len(sys.argv) > 1:
+    from cli import main as cli_main
+    sys.exit(cli_main(sys.argv[1:], started=STARTED))
+
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import subprocess
 import serial.tools.list_ports
 import os
-import sys
 import json
+import queue
+import threading
+from flash_core import (images_from_config, flash_port, make_engine, GangFlasher,
+                        DEFAULT_GANG_WORKERS, DEFAULT_ENGINE)
+from flash_manifest import FlashManifest
+from bundle_cache import BundleCache
+from image_check import check_bundle
+from build_watcher import BuildWatcher
+from boot_check import BootCheck
+from nvs_provision import Provisioner, ProvisionError
+from baud_policy import BaudPolicy
+from port_watcher import PortWatcher, AutoFlasher, esp32_adapter_name
+from job_queue import JobQueue, DEFAULT_MAX_PER_HUB
+from flash_metrics import MetricsRecorder
+from flash_history import FlashHistory, HISTORY_FILE
+from esptool_locator import ESPToolCache, discover_in_background
+from esptool_engine import esptool_available
+from status_log import StatusLog, open_raw_log
+
+# How often queued log lines are pushed into the status widget, and the most per pass
+LOG_POLL_MS = 50
+LOG_BATCH_LIMIT = 2000
 
 class ESP32Flasher:
-    def __init__(self, root):
+    def __init__(self, root, app_dir=None):
         self.root = root
         self.root.title("ESP32 Flasher Tool")
         self.root.geometry("800x750")
         self.root.resizable(True, True)
         self.root.minsize(750, 700)
         
-        # Get current directory (where script is located)
-        if getattr(sys, 'frozen', False):
+        # Get current directory (where script is located); app_dir keeps config and state elsewhere
+        if app_dir:
+            self.current_dir = app_dir
+        elif getattr(sys, 'frozen', False):
             self.current_dir = os.path.dirname(sys.executable)
         else:
             self.current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -33,18 +70,89 @@ class ESP32Flasher:
         self.app_bin_path = ""
         self.selected_port = ""
         self.port_trace_id = None
+        self.incremental = False
+        self.verify_skipped = False
+        self.use_bundle_cache = True
+        self.adaptive_baud = True
+        self.auto_flash = False
+        self.max_per_hub = DEFAULT_MAX_PER_HUB
+        self.engine_preference = DEFAULT_ENGINE
+        self.build_dir = ""
+        self.build_watcher = None
+        self.boot_check_settings = {"enabled": False}
+        self.provisioning_settings = {}
+        self.provisioner = None  # set once every unit's NVS image is ready
+        
+        # Gang flash state (filled by worker threads, drained on the Tk thread)
+        self.gang_window = None
+        self.gang_running = False
+        self.gang_events = queue.Queue()
+        self.gang_ports = []
+        self.gang_rows = {}
         
-        # Find esptool automatically
-        self.esptool_path = self.find_esptool()
+        # Log lines and UI callbacks posted from worker threads
+        self.ui_queue = queue.Queue()
+        self.flashing = False
         
-        # Load saved config
+        # Status log keeps a bounded window; the full output goes to logs/flash.log
+        self.status_log = StatusLog()
+        self.raw_log = open_raw_log(os.path.join(self.current_dir, "logs", "flash.log"))
+        
+        # Load saved config, then fall back to the last discovered esptool
+        self.esptool_path = None
+        self.esptool_cache = ESPToolCache(os.path.join(self.current_dir, "esptool_cache.json"))
         self.load_config()
+        if not self.esptool_path:
+            cached = self.esptool_cache.load()
+            if cached:
+                self.esptool_path = cached[0]
+        
+        # Hashes of what was last written to each board (for incremental flashing)
+        self.manifest = FlashManifest(os.path.join(self.current_dir, "flash_manifest.json"))
+        
+        # Prepared (checked, merged, precompressed) images shared by every flash
+        self.bundle_cache = BundleCache(os.path.join(self.current_dir, "bundle_cache"))
+        
+        # Per-port and per-adapter baud rate history (start fast, fall back on link errors)
+        self.baud_policy = BaudPolicy(os.path.join(self.current_dir, "baud_stats.json"))
+        
+        # Per-phase timings of every flash (metrics/flash_metrics.jsonl and a Prometheus text file)
+        self.metrics = MetricsRecorder(os.path.join(self.current_dir, "metrics"))
+        # Every flash attempt, queryable by board, firmware and time (python main.py history)
+        self.history = FlashHistory(os.path.join(self.current_dir, "metrics", HISTORY_FILE))
+        
+        # Flash jobs survive a crash or restart; transient failures are retried with back-off
+        self.interactive_jobs = set()
+        self.job_queue = JobQueue(os.path.join(self.current_dir, "flash_jobs.json"), self.run_flash,
+                                  max_per_hub=self.max_per_hub, on_event=self.on_job_event,
+                                  check=self.check_job_boot)
         
         self.setup_ui()
+        self.root.after(LOG_POLL_MS, self.drain_ui_queue)
         self.refresh_ports()
         
+        # Keep the port list current and flash newly attached boards when enabled
+        self.auto_flasher = AutoFlasher(self.make_auto_flasher, on_event=self.on_auto_flash_event)
+        self.port_watcher = PortWatcher(lambda added, removed: self.call_on_ui(self.on_ports_changed, added, removed))
+        self.port_watcher.start()
+        
+        # New builds in the watched folder are checked and staged in the background
+        self.start_build_watcher()
+        
+        # Per-board NVS images are generated ahead of the first flash
+        self.start_provisioning()
+        
+        resumed = self.job_queue.pending()
+        if resumed:
+            self.log_status(f"Resuming {len(resumed)} unfinished flash job(s): " + ", ".join(job.port for job in resumed))
+        self.job_queue.start()
+        
         # Update UI with loaded config
         self.update_ui_from_config()
+        
+        # Nothing configured or cached: scan for esptool without holding up the window
+        if not self.esptool_path:
+            self.find_esptool()
     
     def set_window_icon(self):
         """Set the window icon"""
@@ -132,11 +240,47 @@ class ESP32Flasher:
         self.app_bin_label.grid(row=3, column=1, sticky=(tk.W, tk.E), padx=5, pady=6)
         ttk.Button(file_frame, text="Browse", command=self.select_app_bin, width=12).grid(row=3, column=2, padx=(5, 5), pady=6)
         
+        # Build output folder: new builds there replace the four files automatically
+        ttk.Label(file_frame, text="Watch build folder:", font=("Arial", 10)).grid(row=4, column=0, sticky=tk.W, padx=(5, 10), pady=6)
+        self.build_dir_label = ttk.Label(file_frame, text="Off", foreground="gray", font=("Arial", 9))
+        self.build_dir_label.grid(row=4, column=1, sticky=(tk.W, tk.E), padx=5, pady=6)
+        build_buttons = ttk.Frame(file_frame)
+        build_buttons.grid(row=4, column=2, padx=(5, 5), pady=6)
+        ttk.Button(build_buttons, text="Browse", command=self.select_build_dir, width=7).pack(side=tk.LEFT)
+        ttk.Button(build_buttons, text="Off", command=self.stop_build_watch, width=4).pack(side=tk.LEFT, padx=(2, 0))
+        
+        # Units file: each board also gets the next unit's NVS partition (device ID, keys, region)
+        ttk.Label(file_frame, text="NVS units (per board):", font=("Arial", 10)).grid(row=5, column=0, sticky=tk.W, padx=(5, 10), pady=6)
+        self.units_label = ttk.Label(file_frame, text="Off", foreground="gray", font=("Arial", 9))
+        self.units_label.grid(row=5, column=1, sticky=(tk.W, tk.E), padx=5, pady=6)
+        units_buttons = ttk.Frame(file_frame)
+        units_buttons.grid(row=5, column=2, padx=(5, 5), pady=6)
+        ttk.Button(units_buttons, text="Browse", command=self.select_units_file, width=7).pack(side=tk.LEFT)
+        ttk.Button(units_buttons, text="Off", command=self.stop_provisioning, width=4).pack(side=tk.LEFT, padx=(2, 0))
+        
+        # Incremental flashing options
+        options_frame = ttk.Frame(file_frame)
+        options_frame.grid(row=6, column=0, columnspan=3, sticky=tk.W, padx=5, pady=(6, 0))
+        self.incremental_var = tk.BooleanVar(value=self.incremental)
+        ttk.Checkbutton(options_frame, text="Skip regions unchanged since this board's last flash",
+                        variable=self.incremental_var, command=self.on_options_changed).pack(side=tk.LEFT)
+        self.verify_skipped_var = tk.BooleanVar(value=self.verify_skipped)
+        ttk.Checkbutton(options_frame, text="Verify skipped regions on device (MD5)",
+                        variable=self.verify_skipped_var, command=self.on_options_changed).pack(side=tk.LEFT, padx=(15, 0))
+        self.boot_check_var = tk.BooleanVar(value=bool(self.boot_check_settings.get("enabled")))
+        ttk.Checkbutton(options_frame, text="Check boot after flash",
+                        variable=self.boot_check_var, command=self.on_options_changed).pack(side=tk.LEFT, padx=(15, 0))
+        
         # Flash Button
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=4, column=0, columnspan=2, pady=(10, 10))
-        flash_btn = ttk.Button(button_frame, text="Flash ESP32", command=self.flash_esp32, width=20)
-        flash_btn.pack()
+        self.flash_btn = ttk.Button(button_frame, text="Flash ESP32", command=self.flash_esp32, width=20)
+        self.flash_btn.pack(side=tk.LEFT, padx=5)
+        gang_btn = ttk.Button(button_frame, text="Gang Flash...", command=self.open_gang_window, width=20)
+        gang_btn.pack(side=tk.LEFT, padx=5)
+        self.auto_flash_var = tk.BooleanVar(value=self.auto_flash)
+        ttk.Checkbutton(button_frame, text="Auto-flash new boards",
+                        variable=self.auto_flash_var, command=self.on_options_changed).pack(side=tk.LEFT, padx=5)
         
         # Progress/Status Frame
         status_frame = ttk.LabelFrame(main_frame, text="Status Log", padding="10")
@@ -158,16 +302,30 @@ class ESP32Flasher:
         scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
         self.status_text.configure(yscrollcommand=scrollbar.set)
     
-    def save_config(self):
-        """Save current configuration to JSON file"""
-        config = {
+    def get_config(self):
+        """Return the current settings in config.json format"""
+        return {
             "port": self.port_var.get() if hasattr(self, 'port_var') else self.selected_port,
             "esptool_path": self.esptool_path or "",
             "bootloader_path": self.bootloader_path or "",
             "partitions_path": self.partitions_path or "",
             "boot_app0_path": self.boot_app0_file_path or "",
-            "app_bin_path": self.app_bin_path or ""
+            "app_bin_path": self.app_bin_path or "",
+            "incremental": self.incremental,
+            "verify_skipped": self.verify_skipped,
+            "use_bundle_cache": self.use_bundle_cache,
+            "adaptive_baud": self.adaptive_baud,
+            "auto_flash": self.auto_flash,
+            "max_per_hub": self.max_per_hub,
+            "engine": self.engine_preference,
+            "build_dir": self.build_dir,
+            "boot_check": self.boot_check_settings,
+            "provisioning": self.provisioning_settings
         }
+    
+    def save_config(self):
+        """Save current configuration to JSON file"""
+        config = self.get_config()
         
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -189,7 +347,7 @@ class ESP32Flasher:
             
             # Load values
             self.selected_port = config.get("port", "")
-            if config.get("esptool_path") and os.path.exists(config.get("esptool_path")):
+            if config.get("esptool_path") == "esptool.py" or (config.get("esptool_path") and os.path.exists(config.get("esptool_path"))):
                 self.esptool_path = config.get("esptool_path")
             if config.get("bootloader_path") and os.path.exists(config.get("bootloader_path")):
                 self.bootloader_path = config.get("bootloader_path")
@@ -199,6 +357,16 @@ class ESP32Flasher:
                 self.boot_app0_file_path = config.get("boot_app0_path")
             if config.get("app_bin_path") and os.path.exists(config.get("app_bin_path")):
                 self.app_bin_path = config.get("app_bin_path")
+            self.incremental = bool(config.get("incremental", False))
+            self.verify_skipped = bool(config.get("verify_skipped", False))
+            self.use_bundle_cache = bool(config.get("use_bundle_cache", True))
+            self.adaptive_baud = bool(config.get("adaptive_baud", True))
+            self.auto_flash = bool(config.get("auto_flash", False))
+            self.max_per_hub = int(config.get("max_per_hub", DEFAULT_MAX_PER_HUB))
+            self.engine_preference = config.get("engine", DEFAULT_ENGINE)
+            self.build_dir = config.get("build_dir", "")
+            self.boot_check_settings = dict(config.get("boot_check") or {"enabled": False})
+            self.provisioning_settings = dict(config.get("provisioning") or {})
                 
         except Exception as e:
             # Can't use log_status here as UI might not be ready yet
@@ -215,80 +383,63 @@ class ESP32Flasher:
         
         # Update esptool label
         if hasattr(self, 'esptool_label'):
-            if self.esptool_path:
-                if self.esptool_path == "esptool.py":
-                    self.esptool_label.config(text="esptool.py (from PATH)", foreground="green")
-                else:
-                    self.esptool_label.config(text=os.path.basename(self.esptool_path), foreground="green")
-            else:
-                self.esptool_label.config(text="Not found", foreground="red")
+            self.update_esptool_label()
         
         # Update file labels
-        if hasattr(self, 'bootloader_label') and self.bootloader_path:
+        if hasattr(self, 'bootloader_label'):
+            self.update_file_labels()
+        
+        if any([self.bootloader_path, self.partitions_path, self.boot_app0_file_path, self.app_bin_path]):
+            self.log_status("Configuration loaded from config.json")
+        
+    def update_file_labels(self):
+        if self.bootloader_path:
             self.bootloader_label.config(text=os.path.basename(self.bootloader_path), foreground="green")
         
-        if hasattr(self, 'partitions_label') and self.partitions_path:
+        if self.partitions_path:
             self.partitions_label.config(text=os.path.basename(self.partitions_path), foreground="green")
         
-        if hasattr(self, 'boot_app0_label') and self.boot_app0_file_path:
+        if self.boot_app0_file_path:
             self.boot_app0_label.config(text=os.path.basename(self.boot_app0_file_path), foreground="green")
         
-        if hasattr(self, 'app_bin_label') and self.app_bin_path:
+        if self.app_bin_path:
             self.app_bin_label.config(text=os.path.basename(self.app_bin_path), foreground="green")
         
-        if any([self.bootloader_path, self.partitions_path, self.boot_app0_file_path, self.app_bin_path]):
-            self.log_status("Configuration loaded from config.json")
-        
-    def find_esptool(self):
-        """Try to find esptool.exe automatically"""
-        possible_paths = []
-        
-        # Get username from environment
-        username = os.getenv('USERNAME') or os.getenv('USER')
-        
-        # Common Arduino paths
-        if username:
-            arduino_paths = [
-                os.path.join(os.path.expanduser("~"), "Documents", "Arduino", "hardware", "heltec", "esp32", "tools", "esptool", "esptool.exe"),
-                os.path.join(os.path.expanduser("~"), "Documents", "Arduino", "hardware", "espressif", "esp32", "tools", "esptool", "esptool.exe"),
-                os.path.join("C:", "Users", username, "Documents", "Arduino", "hardware", "heltec", "esp32", "tools", "esptool", "esptool.exe"),
-                os.path.join("C:", "Users", username, "Documents", "Arduino", "hardware", "espressif", "esp32", "tools", "esptool", "esptool.exe"),
-            ]
-            possible_paths.extend(arduino_paths)
-        
-        # Search in common Arduino installation locations
-        for drive in ["C:", "D:"]:
-            if os.path.exists(drive):
-                # Search for Arduino folders
-                arduino_base = os.path.join(drive, "Users")
-                if os.path.exists(arduino_base):
-                    for user_folder in os.listdir(arduino_base):
-                        user_path = os.path.join(arduino_base, user_folder)
-                        if os.path.isdir(user_path):
-                            arduino_docs = os.path.join(user_path, "Documents", "Arduino", "hardware")
-                            if os.path.exists(arduino_docs):
-                                # Search for heltec or espressif
-                                for vendor in ["heltec", "espressif"]:
-                                    vendor_path = os.path.join(arduino_docs, vendor, "esp32", "tools", "esptool", "esptool.exe")
-                                    if os.path.exists(vendor_path):
-                                        possible_paths.append(vendor_path)
-        
-        # Check if esptool is in PATH (installed via pip)
-        try:
-            result = subprocess.run(["esptool.py", "--version"], 
-                                  capture_output=True, 
-                                  timeout=2)
-            if result.returncode == 0:
-                return "esptool.py"  # Use esptool.py from PATH
-        except:
-            pass
+        if self.build_dir:
+            self.build_dir_label.config(text=self.build_dir, foreground="green")
+        else:
+            self.build_dir_label.config(text="Off", foreground="gray")
         
-        # Check all possible paths
-        for path in possible_paths:
-            if os.path.exists(path):
-                return path
+        if self.provisioning_settings.get("units"):
+            self.units_label.config(text=os.path.basename(self.provisioning_settings["units"]), foreground="green")
+        else:
+            self.units_label.config(text="Off", foreground="gray")
         
-        return None
+    def update_esptool_label(self):
+        if self.esptool_path:
+            if self.esptool_path == "esptool.py":
+                self.esptool_label.config(text="esptool.py (from PATH)", foreground="green")
+            else:
+                self.esptool_label.config(text=os.path.basename(self.esptool_path), foreground="green")
+        else:
+            self.esptool_label.config(text="Not found", foreground="red")
+    
+    def find_esptool(self):
+        """Search for esptool on a background thread; the label updates when it is found"""
+        self.esptool_label.config(text="Searching...", foreground="orange")
+        discover_in_background(self.esptool_cache.path,
+                               lambda path, version: self.call_on_ui(self.on_esptool_found, path, version))
+    
+    def on_esptool_found(self, path, version):
+        """Tk thread: use the discovered esptool unless one was selected meanwhile"""
+        if self.esptool_path:
+            return
+        self.esptool_path = path
+        self.update_esptool_label()
+        if path:
+            self.log_status(f"Found esptool{' v' + version if version else ''}: {path}")
+        else:
+            self.log_status("esptool not found. Install it with: pip install esptool, or click Browse")
     
     def select_esptool(self):
         """Let user select esptool.exe manually"""
@@ -330,14 +481,119 @@ class ESP32Flasher:
         """Called when port selection changes"""
         self.selected_port = self.port_var.get()
         self.save_config()
+    
+    def on_options_changed(self):
+        """Called when a flash option checkbox changes"""
+        self.incremental = self.incremental_var.get()
+        self.verify_skipped = self.verify_skipped_var.get()
+        if self.auto_flash_var.get() and not self.auto_flash:
+            self.log_status("Auto-flash: ESP32 boards plugged in from now on are flashed with the current files")
+        self.auto_flash = self.auto_flash_var.get()
+        self.boot_check_settings["enabled"] = self.boot_check_var.get()
+        self.save_config()
+    
+    def on_ports_changed(self, added, removed):
+        """Tk thread: boards were plugged in or unplugged"""
+        ports = [device for device in self.port_combo['values'] if device not in removed]
+        for device in removed:
+            self.log_status(f"Port removed: {device}")
+        for info in added:
+            name = esp32_adapter_name(info)
+            self.log_status(f"Port connected: {info.device}" + (f" ({name})" if name else ""))
+            if info.device not in ports:
+                ports.append(info.device)
+        self.port_combo['values'] = ports
+        if ports and not self.port_var.get():
+            self.port_combo.current(0)
+        if self.gang_window is not None and not self.gang_running:
+            self.refresh_gang_ports()
+        
+        if self.auto_flash and any(esp32_adapter_name(info) for info in added):
+            if not self.validate_files():
+                self.auto_flash_var.set(False)
+                self.on_options_changed()
+                self.log_status("Auto-flash turned off: select the files first")
+                return
+            self.auto_flasher.on_ports_changed(added, removed)
+    
+    def make_auto_flasher(self):
+        """GangFlasher with the current files and options, for one auto-flashed board"""
+        return GangFlasher(self.esptool_path, images_from_config(self.get_config()), 1,
+                           on_event=self.on_auto_flash_event,
+                           manifest=self.manifest if self.incremental else None,
+                           verify_skipped=self.verify_skipped,
+                           bundle_cache=self.bundle_cache if self.use_bundle_cache else None,
+                           engine=make_engine(self.esptool_path, self.engine_preference),
+                           baud_policy=self.baud_policy if self.adaptive_baud else None,
+                           metrics=self.metrics, boot_check=BootCheck.from_config(self.get_config()),
+                           provisioner=self.provisioner, history=self.history)
+    
+    def on_auto_flash_event(self, port, kind, value):
+        """Worker thread: report an auto-flashed board; full esptool output goes to the raw log"""
+        if kind == "start":
+            self.log_status(f"[{port}] Auto-flash started")
+        elif kind == "line" and self.raw_log:
+            self.raw_log.info(f"[{port}] {value}")
+        elif kind == "skipped":
+            self.log_status(f"[{port}] Skipped: {value}")
+        elif kind == "boot_check":
+            self.log_status(f"[{port}] Flashed, checking that it boots...")
+        elif kind == "done":
+            if value.success:
+                self.log_status(f"[{port}] Auto-flash PASS in {value.duration:.1f} s" + (f" (MAC {value.mac})" if value.mac else ""))
+            else:
+                self.log_status(f"[{port}] Auto-flash FAIL: {value.error or 'return code %d' % value.returncode}")
         
     def log_status(self, message):
-        """Add message to status text"""
+        """Queue a message for the status text (safe to call from any thread)"""
+        if self.raw_log:
+            self.raw_log.info(message)
+        self.ui_queue.put((None, message))
+    
+    def call_on_ui(self, callback, *args):
+        """Run callback on the Tk thread after the log lines queued before it"""
+        self.ui_queue.put((callback, args))
+    
+    def drain_ui_queue(self):
+        """Timer: move queued log lines into the status text in one batch"""
+        self.flush_ui_queue()
+        self.root.after(LOG_POLL_MS, self.drain_ui_queue)
+    
+    def flush_ui_queue(self, limit=LOG_BATCH_LIMIT):
+        """Insert up to limit queued lines and run queued callbacks in order"""
+        lines = []
+        for _ in range(limit):
+            try:
+                callback, payload = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            if callback is None:
+                lines.append(payload)
+                continue
+            # Keep ordering: lines queued before a callback are shown before it runs
+            self.append_status_lines(lines)
+            lines = []
+            callback(*payload)
+        self.append_status_lines(lines)
+    
+    def append_status_lines(self, lines):
+        """Feed a batch of lines to the log model and redraw only what changed"""
+        if not lines:
+            return
+        for line in lines:
+            self.status_log.feed(line)
+        dropped, updates, appended = self.status_log.take_changes()
+        
         self.status_text.config(state=tk.NORMAL)
-        self.status_text.insert(tk.END, message + "\n")
+        if dropped:
+            self.status_text.delete("1.0", f"{dropped + 1}.0")
+        for row, text in updates:
+            self.status_text.delete(f"{row + 1}.0", f"{row + 1}.end")
+            self.status_text.insert(f"{row + 1}.0", text)
+        if appended:
+            self.status_text.insert(tk.END, "\n".join(appended) + "\n")
         self.status_text.see(tk.END)
         self.status_text.config(state=tk.DISABLED)
-        self.root.update()
         
     def select_bootloader(self):
         """Select bootloader.bin file"""
@@ -366,6 +622,7 @@ class ESP32Flasher:
             self.partitions_label.config(text=os.path.basename(filename), foreground="green")
             self.log_status(f"Selected partitions: {filename}")
             self.save_config()
+            self.start_provisioning()
             
     def select_boot_app0(self):
         """Select boot_app0.bin file"""
@@ -395,12 +652,119 @@ class ESP32Flasher:
             self.log_status(f"Selected application binary: {filename}")
             self.save_config()
             
+    def select_build_dir(self):
+        """Watch a build output folder and use every new build from it"""
+        initialdir = self.build_dir or (os.path.dirname(self.app_bin_path) if self.app_bin_path else self.current_dir)
+        directory = filedialog.askdirectory(title="Select build output folder", initialdir=initialdir)
+        if directory:
+            self.build_dir = directory
+            self.update_file_labels()
+            self.save_config()
+            self.start_build_watcher()
+    
+    def stop_build_watch(self):
+        if self.build_watcher is not None:
+            self.build_watcher.stop()
+            self.build_watcher = None
+            self.log_status("Stopped watching the build folder")
+        self.build_dir = ""
+        self.update_file_labels()
+        self.save_config()
+    
+    def start_build_watcher(self):
+        """(Re)start watching self.build_dir, if set"""
+        if self.build_watcher is not None:
+            self.build_watcher.stop()
+            self.build_watcher = None
+        if not self.build_dir:
+            return
+        if not os.path.isdir(self.build_dir):
+            self.log_status(f"Warning: Build folder not found: {self.build_dir}")
+            return
+        self.build_watcher = BuildWatcher(self.build_dir,
+                                          lambda kind, value: self.call_on_ui(self.on_build_event, kind, value),
+                                          os.path.join(self.current_dir, "staged_builds"),
+                                          bundle_cache=self.bundle_cache if self.use_bundle_cache else None,
+                                          boot_app0_path=self.boot_app0_file_path)
+        self.build_watcher.start()
+        self.log_status(f"Watching build folder {self.build_dir} ({self.build_watcher.mode})")
+    
+    def on_build_event(self, kind, value):
+        """Tk thread: a new build was staged (or rejected) by the build watcher"""
+        if kind == "warning":
+            self.log_status(f"Warning: {value}")
+        elif kind == "invalid":
+            self.log_status("New build in the build folder was rejected:")
+            for error in value:
+                self.log_status(f"  {error}")
+        elif kind == "staged":
+            self.bootloader_path = value["bootloader_path"]
+            self.partitions_path = value["partitions_path"]
+            self.boot_app0_file_path = value["boot_app0_path"]
+            self.app_bin_path = value["app_bin_path"]
+            self.update_file_labels()
+            self.save_config()
+            self.log_status(f"New build staged from {self.build_dir}, used from the next flash")
+            self.start_provisioning()
+    
+    def select_units_file(self):
+        """Give every flashed board the next unit from a CSV or JSON units file"""
+        units = self.provisioning_settings.get("units")
+        filename = filedialog.askopenfilename(
+            title="Select units file",
+            initialdir=os.path.dirname(units) if units else self.current_dir,
+            filetypes=[("Units", "*.csv *.json"), ("All files", "*.*")]
+        )
+        if filename:
+            self.provisioning_settings["units"] = filename
+            self.update_file_labels()
+            self.save_config()
+            self.start_provisioning()
+    
+    def stop_provisioning(self):
+        self.provisioning_settings.pop("units", None)
+        self.provisioner = None
+        self.update_file_labels()
+        self.save_config()
+        self.log_status("NVS provisioning off")
+    
+    def start_provisioning(self):
+        """Load the units and generate their NVS images in the background, if a units file is set"""
+        self.provisioner = None
+        if not self.provisioning_settings.get("units"):
+            return
+        config = self.get_config()
+        self.log_status("Preparing NVS images of the units...")
+        threading.Thread(target=self.prepare_provisioner, args=(config,), daemon=True).start()
+    
+    def prepare_provisioner(self, config):
+        """Worker thread: build the Provisioner and hand it to the Tk thread when ready"""
+        started = time.monotonic()
+        try:
+            provisioner = Provisioner.from_config(config, os.path.join(self.current_dir, "provisioning"))
+            generated, cached = provisioner.prepare()
+        except ProvisionError as e:
+            self.log_status(f"Error: NVS provisioning: {e}")
+            return
+        self.log_status(f"NVS provisioning ready: {len(provisioner.units)} unit(s), {provisioner.remaining} not yet "
+                        f"flashed; {generated} image(s) generated, {cached} cached in {time.monotonic() - started:.1f} s")
+        self.call_on_ui(self.set_provisioner, provisioner, config)
+    
+    def set_provisioner(self, provisioner, config):
+        """Tk thread: use the prepared Provisioner unless the settings changed while it was generating"""
+        if config.get("provisioning") == self.provisioning_settings and config["partitions_path"] == self.partitions_path:
+            self.provisioner = provisioner
+    
     def validate_inputs(self):
         """Validate all inputs before flashing"""
         if not self.port_var.get():
             messagebox.showerror("Error", "Please select a COM port")
             return False
-            
+        
+        return self.validate_files()
+        
+    def validate_files(self):
+        """Validate binary files and esptool (everything except the port)"""
         if not self.bootloader_path:
             messagebox.showerror("Error", "Please select bootloader.bin file")
             return False
@@ -417,12 +781,29 @@ class ESP32Flasher:
             messagebox.showerror("Error", "Please select LoRaController.ino.bin file")
             return False
             
+        # Catch wrong, swapped or corrupt files before connecting to a board
+        errors, warnings = check_bundle(images_from_config(self.get_config()))
+        for warning in warnings:
+            self.log_status(f"Warning: {warning}")
+        if errors:
+            for error in errors:
+                self.log_status(f"Error: {error}")
+            messagebox.showerror("Error", "The selected files cannot be flashed:\n\n" + "\n".join(errors))
+            return False
+            
+        if self.provisioning_settings.get("units") and self.provisioner is None:
+            messagebox.showerror("Error", "The NVS images of the units are not ready (see the status log)")
+            return False
+            
         if not self.esptool_path:
             messagebox.showerror("Error", "Please select esptool.exe path")
             return False
         
         # Check if esptool.py (from pip) or esptool.exe exists
-        if self.esptool_path == "esptool.py":
+        if self.esptool_path == "esptool.py" and self.engine_preference != "subprocess" and esptool_available():
+            # esptool will be loaded in-process, no need to start esptool.py just to check it
+            pass
+        elif self.esptool_path == "esptool.py":
             # Check if esptool.py is available in PATH
             try:
                 result = subprocess.run(["esptool.py", "--version"], 
@@ -442,30 +823,15 @@ class ESP32Flasher:
         
     def flash_esp32(self):
         """Execute the flash command"""
+        if self.flashing:
+            return
         if not self.validate_inputs():
             return
             
         port = self.port_var.get()
+        images = images_from_config(self.get_config())
         
-        # Build the esptool command
-        cmd = [
-            self.esptool_path,
-            "--chip", "esp32",
-            "--port", port,
-            "--baud", "921600",
-            "--before", "default_reset",
-            "--after", "hard_reset",
-            "write_flash",
-            "-z",
-            "--flash_mode", "keep",
-            "--flash_freq", "keep",
-            "--flash_size", "keep",
-            "0x1000", self.bootloader_path,
-            "0x8000", self.partitions_path,
-            "0xe000", self.boot_app0_file_path,
-            "0x10000", self.app_bin_path
-        ]
-        
+        self.status_log.begin_run()
         self.log_status("=" * 60)
         self.log_status("Starting flash process...")
         self.log_status(f"Port: {port}")
@@ -473,36 +839,247 @@ class ESP32Flasher:
         self.log_status(f"Partitions: {os.path.basename(self.partitions_path)}")
         self.log_status(f"Boot App0: {os.path.basename(self.boot_app0_file_path)}")
         self.log_status(f"Application: {os.path.basename(self.app_bin_path)}")
+        if self.incremental:
+            self.log_status("Incremental: only regions changed since this board's last flash are written")
         self.log_status("=" * 60)
         
+        # esptool runs on a queue worker thread; its output reaches the widget via the UI queue
+        job = self.job_queue.add(port, images)
+        if job is None:
+            self.log_status(f"A flash of {port} is already queued")
+            return
+        self.interactive_jobs.add(job.id)
+        self.flashing = True
+        self.flash_btn.config(state=tk.DISABLED)
+    
+    def job_line_logger(self, job):
+        """Log callback for a job's output: plain for the interactive flash, port-prefixed otherwise"""
+        if job.id in self.interactive_jobs:
+            return self.log_status
+        return lambda line: self.log_status(f"[{job.port}] {line}")
+    
+    def run_flash(self, job):
+        """Queue worker thread: flash one job and return its FlashResult"""
+        on_line = self.job_line_logger(job)
+        engine = make_engine(self.esptool_path, self.engine_preference)
+        result = flash_port(self.esptool_path, job.port, job.images, on_line=on_line,
+                            manifest=self.manifest if self.incremental else None,
+                            verify_skipped=self.verify_skipped,
+                            bundle_cache=self.bundle_cache if self.use_bundle_cache else None,
+                            engine=engine, baud_policy=self.baud_policy if self.adaptive_baud else None,
+                            metrics=self.metrics, provisioner=self.provisioner, history=self.history,
+                            attempt=job.attempts)
+        return result
+    
+    def check_job_boot(self, job, result):
+        """Boot-check pool thread: check a flashed board while the queue flashes the next one"""
+        boot_check = BootCheck.from_config({"boot_check": self.boot_check_settings})
+        if boot_check is None:
+            return
+        on_line = self.job_line_logger(job)
+        on_line("Checking that the board boots...")
+        boot_check.check_result(result, on_line)
+        on_line(f"Boot check: {'PASS' if result.boot.passed else 'FAIL'} ({result.boot.reason})")
+    
+    def on_job_event(self, job, kind, value):
+        """Queue worker thread: report retries and hand interactive results to the Tk thread"""
+        if kind == "start" and job.attempts > 1:
+            self.log_status(f"[{job.port}] Attempt {job.attempts} of {self.job_queue.max_attempts}")
+        elif kind == "retry":
+            self.log_status(f"[{job.port}] Transient failure ({job.error}), retrying in {value} s")
+        elif kind == "done":
+            if job.id in self.interactive_jobs:
+                self.interactive_jobs.discard(job.id)
+                self.call_on_ui(self.finish_flash, value)
+            elif value.success:
+                self.log_status(f"[{job.port}] Flash completed in {value.duration:.1f} s")
+            else:
+                self.log_status(f"[{job.port}] Flash failed: {job.error}")
+    
+    def finish_flash(self, result):
+        """Show the flash result (runs on the Tk thread)"""
+        self.flashing = False
+        self.flash_btn.config(state=tk.NORMAL)
+        returncode = result.returncode
+        
+        if result.error:
+            self.log_status(f"Error: {result.error}")
+            self.flush_ui_queue()
+            messagebox.showerror("Error", f"An error occurred:\n{result.error}")
+        elif returncode == 0:
+            self.log_status("=" * 60)
+            self.log_status("Flash completed successfully!" + (f" ({result.baud} baud)" if result.baud else ""))
+            self.flush_ui_queue()
+            messagebox.showinfo("Success", "ESP32 flashed successfully!")
+        else:
+            self.log_status("=" * 60)
+            self.log_status(f"Flash failed with return code: {returncode}")
+            self.flush_ui_queue()
+            messagebox.showerror("Error", "Flash process failed. Check the output above.")
+    
+    def open_gang_window(self):
+        """Open the gang flash window for flashing several ports at once"""
+        if self.gang_window is not None and self.gang_window.winfo_exists():
+            self.gang_window.lift()
+            return
+        
+        window = tk.Toplevel(self.root)
+        window.title("Gang Flash")
+        window.geometry("640x540")
+        window.minsize(560, 400)
+        window.columnconfigure(0, weight=1)
+        window.rowconfigure(1, weight=1)
+        window.protocol("WM_DELETE_WINDOW", self.close_gang_window)
+        self.gang_window = window
+        
+        # Port selection
+        select_frame = ttk.LabelFrame(window, text="Ports", padding="10")
+        select_frame.grid(row=0, column=0, sticky=(tk.W, tk.E), padx=10, pady=(10, 5))
+        select_frame.columnconfigure(0, weight=1)
+        
+        self.gang_port_list = tk.Listbox(select_frame, selectmode=tk.MULTIPLE, height=6,
+                                         exportselection=False, font=("Consolas", 9))
+        self.gang_port_list.grid(row=0, column=0, rowspan=4, sticky=(tk.W, tk.E), padx=(0, 10))
+        
+        ttk.Button(select_frame, text="Refresh", command=self.refresh_gang_ports, width=14).grid(row=0, column=1, pady=2)
+        ttk.Button(select_frame, text="Select All", command=lambda: self.gang_port_list.select_set(0, tk.END),
+                   width=14).grid(row=1, column=1, pady=2)
+        
+        workers_frame = ttk.Frame(select_frame)
+        workers_frame.grid(row=2, column=1, pady=2)
+        ttk.Label(workers_frame, text="Parallel:", font=("Arial", 9)).pack(side=tk.LEFT)
+        self.gang_workers_var = tk.StringVar(value=str(DEFAULT_GANG_WORKERS))
+        tk.Spinbox(workers_frame, from_=1, to=16, width=4, textvariable=self.gang_workers_var).pack(side=tk.LEFT, padx=(5, 0))
+        
+        self.gang_start_btn = ttk.Button(select_frame, text="Flash Selected", command=self.start_gang_flash, width=14)
+        self.gang_start_btn.grid(row=3, column=1, pady=2)
+        
+        # One progress row per port
+        self.gang_rows_frame = ttk.LabelFrame(window, text="Progress", padding="10")
+        self.gang_rows_frame.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=10, pady=5)
+        self.gang_rows_frame.columnconfigure(1, weight=1)
+        
+        self.gang_summary_label = ttk.Label(window, text="", font=("Arial", 10, "bold"))
+        self.gang_summary_label.grid(row=2, column=0, sticky=tk.W, padx=15, pady=(0, 10))
+        
+        self.refresh_gang_ports()
+    
+    def close_gang_window(self):
+        """Close the gang window unless a tray is still being flashed"""
+        if self.gang_running:
+            messagebox.showwarning("Gang Flash", "Please wait until all ports have finished.", parent=self.gang_window)
+            return
+        self.gang_window.destroy()
+        self.gang_window = None
+    
+    def refresh_gang_ports(self):
+        """Refresh the port list in the gang window"""
+        ports = list(serial.tools.list_ports.comports())
+        self.gang_ports = [port.device for port in ports]
+        self.gang_port_list.delete(0, tk.END)
+        for port in ports:
+            self.gang_port_list.insert(tk.END, f"{port.device}  {port.description}")
+    
+    def start_gang_flash(self):
+        """Flash the selected ports in parallel"""
+        ports = [self.gang_ports[i] for i in self.gang_port_list.curselection()]
+        if not ports:
+            messagebox.showerror("Error", "Please select at least one COM port", parent=self.gang_window)
+            return
+        if not self.validate_files():
+            return
+        
         try:
-            # Execute the command
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1
-            )
+            workers = max(1, int(self.gang_workers_var.get()))
+        except ValueError:
+            workers = DEFAULT_GANG_WORKERS
+        
+        # Build a fresh progress row for each port
+        for child in self.gang_rows_frame.winfo_children():
+            child.destroy()
+        self.gang_rows = {}
+        for row, port in enumerate(ports):
+            ttk.Label(self.gang_rows_frame, text=port, width=14, font=("Consolas", 9)).grid(row=row, column=0, sticky=tk.W, pady=2)
+            bar = ttk.Progressbar(self.gang_rows_frame, maximum=100, length=250)
+            bar.grid(row=row, column=1, sticky=(tk.W, tk.E), padx=5, pady=2)
+            status = ttk.Label(self.gang_rows_frame, text="Waiting", foreground="gray", width=28, font=("Arial", 9))
+            status.grid(row=row, column=2, sticky=tk.W, pady=2)
+            self.gang_rows[port] = (bar, status)
+        
+        self.gang_summary_label.config(text="")
+        self.gang_start_btn.config(state=tk.DISABLED)
+        self.gang_running = True
+        
+        self.log_status("=" * 60)
+        self.log_status(f"Gang flash: {len(ports)} port(s), {workers} in parallel")
+        
+        flasher = GangFlasher(self.esptool_path, images_from_config(self.get_config()), workers,
+                              on_event=lambda port, kind, value: self.gang_events.put((port, kind, value)),
+                              manifest=self.manifest if self.incremental else None,
+                              verify_skipped=self.verify_skipped,
+                              bundle_cache=self.bundle_cache if self.use_bundle_cache else None,
+                              baud_policy=self.baud_policy if self.adaptive_baud else None,
+                              metrics=self.metrics, boot_check=BootCheck.from_config(self.get_config()),
+                              provisioner=self.provisioner, history=self.history)
+        threading.Thread(target=self.run_gang_flash, args=(flasher, ports), daemon=True).start()
+        self.root.after(100, self.poll_gang_events)
+    
+    def run_gang_flash(self, flasher, ports):
+        """Worker thread: flash the whole tray and report the summary"""
+        flasher.engine = make_engine(self.esptool_path, self.engine_preference)
+        summary = flasher.run(ports)
+        self.gang_events.put((None, "summary", summary))
+    
+    def poll_gang_events(self):
+        """Apply queued gang events to the window (runs on the Tk thread)"""
+        finished = False
+        while True:
+            try:
+                port, kind, value = self.gang_events.get_nowait()
+            except queue.Empty:
+                break
             
-            # Read output in real-time
-            for line in process.stdout:
-                self.log_status(line.strip())
-                
-            process.wait()
+            if kind == "summary":
+                self.show_gang_summary(value)
+                finished = True
+                continue
             
-            if process.returncode == 0:
-                self.log_status("=" * 60)
-                self.log_status("Flash completed successfully!")
-                messagebox.showinfo("Success", "ESP32 flashed successfully!")
-            else:
-                self.log_status("=" * 60)
-                self.log_status(f"Flash failed with return code: {process.returncode}")
-                messagebox.showerror("Error", "Flash process failed. Check the output above.")
-                
-        except Exception as e:
-            self.log_status(f"Error: {str(e)}")
-            messagebox.showerror("Error", f"An error occurred:\n{str(e)}")
+            row = self.gang_rows.get(port)
+            if row is None:
+                # No row for this port (the rows were rebuilt while the event was queued)
+                continue
+            bar, status = row
+            if kind == "start":
+                status.config(text="Connecting...", foreground="black")
+            elif kind == "progress":
+                bar["value"] = value
+                status.config(text=f"Writing {value}%", foreground="black")
+            elif kind == "boot_check":
+                bar["value"] = 100
+                status.config(text="Checking boot...", foreground="black")
+            elif kind == "done":
+                if value.success:
+                    bar["value"] = 100
+                    skipped = f", {len(value.skipped)} skipped" if value.skipped else ""
+                    status.config(text=f"PASS ({value.duration:.1f} s{skipped})", foreground="green")
+                    self.log_status(f"[{port}] Flash completed in {value.duration:.1f} s")
+                else:
+                    reason = value.error or f"return code {value.returncode}"
+                    status.config(text=f"FAIL ({reason})", foreground="red")
+                    self.log_status(f"[{port}] Flash failed: {reason}")
+        
+        if not finished:
+            self.root.after(100, self.poll_gang_events)
+    
+    def show_gang_summary(self, summary):
+        """Show totals for the finished tray"""
+        self.gang_running = False
+        self.gang_start_btn.config(state=tk.NORMAL)
+        text = (f"{len(summary.results)} board(s): {summary.passed} passed, {summary.failed} failed "
+                f"in {summary.elapsed:.1f} s ({summary.boards_per_minute:.1f} boards/min)")
+        self.gang_summary_label.config(text=text, foreground="green" if not summary.failed else "red")
+        self.log_status(f"Gang flash finished: {text}")
+        self.log_status("=" * 60)
 
 if __name__ == "__main__":
     root = tk.Tk()
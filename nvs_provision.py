@@ -0,0 +1,449 @@
+"""
+Per-board NVS partition images for factory provisioning.
+
+Every unit (one LoRa node) gets its own NVS partition holding its device ID,
+keys and region settings. The images are generated in-process in the format
+nvs_partition_gen.py writes (NVS version 2: 4 KB pages of 32-byte entries,
+CRC32 on page headers, entries and data), so no ESP-IDF tools are needed.
+The units come from a CSV or JSON file:
+
+    id,mac,dev_eui,app_key:hex2bin,region:u8
+    node-0001,,70B3D57ED0000001,8A1F...,2
+    node-0002,24:0a:c4:12:34:56,70B3D57ED0000002,93C0...,2
+
+The first column (or one named "id") identifies the unit, an optional "mac"
+column ties a unit to one board, and every other column is an NVS key,
+typed with ":u8" ... ":i64", ":string" (the default), ":hex2bin" or
+":base64". A JSON file holds a list of objects with the same keys.
+
+All images are generated ahead of flashing on a pool of worker processes and
+cached by content, so each flash only adds one more region to the board's
+write. Which unit went to which board is kept in assigned.json; when the MAC
+is known before the write (incremental flashing) a reflashed board keeps its
+unit instead of using up a new one.
+"""
+import os
+import csv
+import json
+import time
+import zlib
+import base64
+import struct
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flash_manifest import normalize_mac
+from image_check import (load, parse_partition_table, ImageCheckError, PARTITION_TYPE_DATA,
+                         PARTITION_SUBTYPE_NVS)
+
+PAGE_SIZE = 0x1000
+ENTRY_SIZE = 32
+ENTRIES_PER_PAGE = 126
+BITMAP_OFFSET = 32
+FIRST_ENTRY_OFFSET = 64
+
+PAGE_ACTIVE = 0xFFFFFFFE
+PAGE_FULL = 0xFFFFFFFC
+PAGE_VERSION = 0xFE       # NVS format version 2 (multi-page blobs)
+CHUNK_ANY = 0xFF
+
+# Type name -> (NVS type byte, struct format)
+INTEGER_TYPES = {
+    "u8": (0x01, "<B"), "i8": (0x11, "<b"),
+    "u16": (0x02, "<H"), "i16": (0x12, "<h"),
+    "u32": (0x04, "<I"), "i32": (0x14, "<i"),
+    "u64": (0x08, "<Q"), "i64": (0x18, "<q"),
+}
+TYPE_STRING = 0x21
+TYPE_BLOB_DATA = 0x42
+TYPE_BLOB_INDEX = 0x48
+BINARY_TYPES = ("hex2bin", "base64")
+
+MAX_KEY_LENGTH = 15
+MAX_STRING_SIZE = 4000    # including the terminating NUL
+
+DEFAULT_NAMESPACE = "device"
+DEFAULT_LABEL = "nvs"
+ASSIGNED_FILE = "assigned.json"
+# Fewer images than this are generated in this process; a pool would only add start-up time
+POOL_THRESHOLD = 64
+# Bumped whenever the generated bytes would change, so old cache entries are not reused
+FORMAT_REVISION = 1
+
+
+class ProvisionError(Exception):
+    """The units file, the partition table or a unit's data cannot be used"""
+
+
+def crc32(data):
+    return zlib.crc32(data, 0xFFFFFFFF) & 0xFFFFFFFF
+
+
+class NvsImage:
+    """Builds the pages of one NVS partition"""
+    
+    def __init__(self, size):
+        if size % PAGE_SIZE or size < 3 * PAGE_SIZE:
+            raise ProvisionError(f"NVS partition size 0x{size:x} must be a multiple of 0x1000 and at least 0x3000")
+        # The last page stays erased: NVS needs one free page for garbage collection
+        self.max_pages = size // PAGE_SIZE - 1
+        self.pages = []
+        self.page = None
+        self.entry = 0
+        self._new_page()
+    
+    def _new_page(self):
+        if self.page is not None:
+            struct.pack_into("<I", self.page, 0, PAGE_FULL)
+        if len(self.pages) == self.max_pages:
+            raise ProvisionError(f"the data does not fit in {self.max_pages + 1} NVS pages")
+        page = bytearray(b"\xff" * PAGE_SIZE)
+        struct.pack_into("<II", page, 0, PAGE_ACTIVE, len(self.pages))
+        page[8] = PAGE_VERSION
+        struct.pack_into("<I", page, 28, crc32(bytes(page[4:28])))
+        self.pages.append(page)
+        self.page = page
+        self.entry = 0
+    
+    def _write(self, data, count):
+        """Put data into the next count entries and mark them written in the state bitmap"""
+        start = FIRST_ENTRY_OFFSET + self.entry * ENTRY_SIZE
+        self.page[start:start + len(data)] = data
+        for index in range(self.entry, self.entry + count):
+            self.page[BITMAP_OFFSET + index // 4] &= ~(1 << (index % 4 * 2)) & 0xFF
+        self.entry += count
+    
+    def _header(self, ns, type_, span, chunk, key, data):
+        entry = bytearray(b"\xff" * ENTRY_SIZE)
+        entry[0:4] = bytes([ns, type_, span, chunk])
+        entry[8:24] = key.encode("ascii").ljust(16, b"\x00")
+        entry[24:24 + len(data)] = data
+        struct.pack_into("<I", entry, 4, crc32(bytes(entry[0:4] + entry[8:32])))
+        self._write(entry, 1)
+    
+    def add_integer(self, ns, key, type_name, value):
+        if self.entry >= ENTRIES_PER_PAGE:
+            self._new_page()
+        type_, fmt = INTEGER_TYPES[type_name]
+        self._header(ns, type_, 1, CHUNK_ANY, key, struct.pack(fmt, value))
+    
+    def add_string(self, ns, key, value):
+        data = value.encode("utf-8") + b"\x00"
+        if len(data) > MAX_STRING_SIZE:
+            raise ProvisionError(f"string '{key}' is {len(data)} bytes, NVS strings hold at most {MAX_STRING_SIZE}")
+        count = (len(data) + ENTRY_SIZE - 1) // ENTRY_SIZE
+        # nvs_partition_gen.py never fills a page's last entry with a string
+        if self.entry and self.entry + count + 1 >= ENTRIES_PER_PAGE:
+            self._new_page()
+        self._header(ns, TYPE_STRING, count + 1, CHUNK_ANY, key, struct.pack("<HHI", len(data), 0xFFFF, crc32(data)))
+        self._write(data, count)
+    
+    def add_blob(self, ns, key, data):
+        """Store data as chunks spread over as many pages as needed, then the blob index"""
+        offset = 0
+        chunks = 0
+        while True:
+            # Like nvs_partition_gen.py, a page with one free entry still gets an empty chunk
+            if self.entry >= ENTRIES_PER_PAGE:
+                self._new_page()
+            room = (ENTRIES_PER_PAGE - self.entry - 1) * ENTRY_SIZE
+            chunk = data[offset:offset + room]
+            count = (len(chunk) + ENTRY_SIZE - 1) // ENTRY_SIZE
+            self._header(ns, TYPE_BLOB_DATA, count + 1, chunks, key,
+                         struct.pack("<HHI", len(chunk), 0xFFFF, crc32(chunk)))
+            self._write(chunk, count)
+            chunks += 1
+            offset += len(chunk)
+            if offset >= len(data):
+                break
+        if self.entry >= ENTRIES_PER_PAGE:
+            self._new_page()
+        self._header(ns, TYPE_BLOB_INDEX, 1, CHUNK_ANY, key, struct.pack("<IBB", len(data), chunks, 0))
+    
+    def finish(self):
+        """Return the partition contents; the last written page stays active, the rest is erased"""
+        data = b"".join(bytes(page) for page in self.pages)
+        return data + b"\xff" * ((self.max_pages + 1) * PAGE_SIZE - len(data))
+
+
+def build_nvs_image(entries, size, namespace=DEFAULT_NAMESPACE):
+    """Return the bytes of an NVS partition of size holding [(key, type, value)] in namespace"""
+    image = NvsImage(size)
+    # Namespace 1; namespace entries themselves live in namespace 0
+    image.add_integer(0, namespace, "u8", 1)
+    for key, type_name, value in entries:
+        if type_name in INTEGER_TYPES:
+            image.add_integer(1, key, type_name, value)
+        elif type_name == "string":
+            image.add_string(1, key, value)
+        else:
+            image.add_blob(1, key, decode_binary(type_name, value))
+    return image.finish()
+
+
+def decode_binary(type_name, value):
+    if type_name == "hex2bin":
+        return bytes.fromhex(value)
+    return base64.b64decode(value, validate=True)
+
+
+def parse_value(key, type_name, value):
+    """Return value (a string from CSV, or any JSON value) converted for type_name"""
+    if type_name in INTEGER_TYPES:
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, str)):
+            raise ProvisionError(f"{key} must be an integer")
+        try:
+            number = int(value, 0) if isinstance(value, str) else value
+        except ValueError:
+            raise ProvisionError(f"{key} must be an integer, not '{value}'")
+        fmt = INTEGER_TYPES[type_name][1]
+        bits = struct.calcsize(fmt) * 8
+        low, high = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1) if fmt[1].islower() else (0, (1 << bits) - 1)
+        if not low <= number <= high:
+            raise ProvisionError(f"{key} = {number} is out of range for {type_name}")
+        return number
+    if not isinstance(value, str):
+        raise ProvisionError(f"{key} must be a string")
+    if type_name in BINARY_TYPES:
+        try:
+            if not decode_binary(type_name, value):
+                raise ValueError("empty")
+        except ValueError:
+            raise ProvisionError(f"{key} is not valid {'hex' if type_name == 'hex2bin' else 'base64'} data")
+    elif type_name != "string":
+        raise ProvisionError(f"{key} has unknown type '{type_name}'")
+    return value
+
+
+def guess_type(value):
+    """NVS type for an untyped JSON value"""
+    if isinstance(value, bool):
+        return "u8"
+    if isinstance(value, int):
+        if value < 0:
+            return "i32" if value >= -(1 << 31) else "i64"
+        return "u32" if value < (1 << 32) else "u64"
+    return "string"
+
+
+class Unit:
+    """One device to provision: its id, optional MAC and NVS entries"""
+    
+    def __init__(self, unit_id, mac, entries):
+        self.id = unit_id
+        self.mac = mac
+        self.entries = entries    # [(key, type, value)]
+        self.path = None          # cached NVS image, set by the Provisioner
+    
+    def cache_key(self, size, namespace):
+        text = json.dumps([FORMAT_REVISION, size, namespace, self.entries], separators=(",", ":"))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_unit(fields, where):
+    """Build a Unit from [(column, value)]; the first column is the id unless one is named "id" """
+    names = [name for name, _ in fields]
+    id_column = "id" if "id" in names else names[0]
+    values = dict(fields)
+    unit_id = str(values.get(id_column) or "").strip()
+    if not unit_id:
+        raise ProvisionError(f"{where}: the unit has no id")
+    mac = values.get("mac")
+    entries = []
+    for column, value in fields:
+        if column in (id_column, "mac") or value is None or value == "":
+            continue
+        key, _, type_name = column.partition(":")
+        key = key.strip()
+        type_name = type_name.strip().lower() or guess_type(value)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise ProvisionError(f"{where}: key '{key}' must be 1 to {MAX_KEY_LENGTH} characters")
+        try:
+            entries.append((key, type_name, parse_value(key, type_name, value)))
+        except ProvisionError as e:
+            raise ProvisionError(f"{where}: {e}")
+    return Unit(unit_id, normalize_mac(mac) if mac else None, entries)
+
+
+def load_units(path):
+    """Read units from a CSV or JSON file; raises ProvisionError"""
+    name = os.path.basename(path)
+    try:
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            if path.lower().endswith(".json"):
+                data = json.load(f)
+                records = data.get("units") if isinstance(data, dict) else data
+                if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+                    raise ProvisionError(f"{name} must hold a list of unit objects")
+                units = [make_unit(list(record.items()), f"{name} unit {index + 1}")
+                         for index, record in enumerate(records)]
+            else:
+                reader = csv.reader(f)
+                header = [column.strip() for column in next(reader, [])]
+                if not header:
+                    raise ProvisionError(f"{name} is empty")
+                units = [make_unit(list(zip(header, row)), f"{name} line {reader.line_num}")
+                         for row in reader if any(cell.strip() for cell in row)]
+    except OSError as e:
+        raise ProvisionError(f"Could not read units file {path}: {e}")
+    except ValueError as e:
+        raise ProvisionError(f"{name} is not valid: {e}")
+    
+    seen = set()
+    for unit in units:
+        if unit.id in seen:
+            raise ProvisionError(f"{name} has unit '{unit.id}' more than once")
+        seen.add(unit.id)
+    return units
+
+
+def find_nvs_partition(partitions_path, label=None):
+    """Return the Partition the unit data goes to (by label, else the first NVS data partition)"""
+    if not partitions_path or not os.path.isfile(partitions_path):
+        raise ProvisionError(f"Partition table not found: {partitions_path or '(not selected)'}")
+    try:
+        partitions = load(partitions_path, parse_partition_table)
+    except (ImageCheckError, OSError) as e:
+        raise ProvisionError(str(e))
+    candidates = [p for p in partitions if p.type == PARTITION_TYPE_DATA and p.subtype == PARTITION_SUBTYPE_NVS]
+    for partition in candidates:
+        if partition.label == (label or DEFAULT_LABEL):
+            return partition
+    if candidates and not label:
+        return candidates[0]
+    raise ProvisionError(f"{os.path.basename(partitions_path)} has no NVS partition"
+                         + (f" named '{label}'" if label else ""))
+
+
+def write_image(job):
+    """Generate one unit's image into the cache (runs in a pool worker); returns its path"""
+    unit_id, path, entries, size, namespace = job
+    try:
+        data = build_nvs_image(entries, size, namespace)
+    except ProvisionError as e:
+        raise ProvisionError(f"Unit {unit_id}: {e}")
+    for target, content in ((path + ".z", zlib.compress(data, 9)), (path, data)):
+        tmp_path = target + f".tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, target)
+    return path
+
+
+class Provisioner:
+    """Hands out one unit (and its prepared NVS image) per flashed board"""
+    
+    def __init__(self, units_path, partitions_path, directory, namespace=DEFAULT_NAMESPACE, label=None,
+                 workers=None):
+        if not namespace or len(namespace) > MAX_KEY_LENGTH:
+            raise ProvisionError(f"Namespace '{namespace}' must be 1 to {MAX_KEY_LENGTH} characters")
+        self.units_path = units_path
+        self.namespace = namespace
+        self.workers = workers
+        partition = find_nvs_partition(partitions_path, label)
+        self.label = partition.label
+        self.offset = partition.offset
+        self.size = partition.size
+        self.units = load_units(units_path)
+        self.image_dir = os.path.join(directory, "images")
+        self.assigned_path = os.path.join(directory, ASSIGNED_FILE)
+        for unit in self.units:
+            unit.path = os.path.join(self.image_dir, unit.cache_key(self.size, namespace) + ".bin")
+        self.assigned = {}        # unit id -> {"mac", "port", "time"}
+        self._claimed = {}        # unit id -> port being flashed
+        self._lock = threading.Lock()
+        self.load()
+    
+    @classmethod
+    def from_config(cls, config, directory):
+        """Return a Provisioner for a config.json style dict, or None if no units file is set"""
+        settings = config.get("provisioning") or {}
+        if not settings.get("units"):
+            return None
+        return cls(settings["units"], config.get("partitions_path"), directory,
+                   namespace=settings.get("namespace", DEFAULT_NAMESPACE), label=settings.get("partition"),
+                   workers=settings.get("workers"))
+    
+    def load(self):
+        """Load the assignments; a missing or damaged file starts empty"""
+        if not os.path.exists(self.assigned_path):
+            return
+        try:
+            with open(self.assigned_path, 'r', encoding='utf-8') as f:
+                self.assigned = json.load(f).get("units", {})
+        except Exception as e:
+            print(f"Warning: Could not load unit assignments: {e}")
+            self.assigned = {}
+    
+    def save(self):
+        """Write the assignments atomically so a crash never leaves half a file"""
+        tmp_path = self.assigned_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"units": self.assigned}, f, indent=4)
+        os.replace(tmp_path, self.assigned_path)
+    
+    @property
+    def remaining(self):
+        """Units not yet written to a board"""
+        with self._lock:
+            return sum(1 for unit in self.units if unit.id not in self.assigned)
+    
+    def prepare(self):
+        """Generate every image that is not cached yet; returns (generated, cached)"""
+        os.makedirs(self.image_dir, exist_ok=True)
+        pending = {}
+        for unit in self.units:
+            if not os.path.exists(unit.path):
+                pending[unit.path] = (unit.id, unit.path, unit.entries, self.size, self.namespace)
+        jobs = list(pending.values())
+        if len(jobs) >= POOL_THRESHOLD and (self.workers or os.cpu_count() or 1) > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    list(pool.map(write_image, jobs, chunksize=max(1, len(jobs) // (8 * (os.cpu_count() or 1)))))
+                jobs = []
+            except ProvisionError:
+                raise
+            except Exception as e:
+                print(f"Warning: Worker processes unavailable, generating NVS images here: {e}")
+                jobs = [job for job in jobs if not os.path.exists(job[1])]
+        for job in jobs:
+            write_image(job)
+        return len(pending), len(self.units) - len(pending)
+    
+    def claim(self, port, mac=None):
+        """Reserve the unit for the board on port; raises ProvisionError when none is left
+        
+        A board whose MAC already has a unit gets that unit again; a unit listed
+        with this MAC comes next; otherwise the next free unit without a MAC.
+        """
+        mac = normalize_mac(mac) if mac else None
+        with self._lock:
+            unit = None
+            if mac:
+                unit = next((u for u in self.units if self.assigned.get(u.id, {}).get("mac") == mac), None)
+                if unit is None:
+                    unit = next((u for u in self.units if u.mac == mac and u.id not in self.assigned), None)
+            if unit is None:
+                unit = next((u for u in self.units if u.mac is None and u.id not in self.assigned
+                             and u.id not in self._claimed), None)
+            if unit is None:
+                raise ProvisionError(f"No unprovisioned units left in {os.path.basename(self.units_path)}")
+            if self._claimed.get(unit.id, port) != port:
+                raise ProvisionError(f"Unit {unit.id} is being flashed on {self._claimed[unit.id]}")
+            self._claimed[unit.id] = port
+        if not os.path.exists(unit.path):
+            write_image((unit.id, unit.path, unit.entries, self.size, self.namespace))
+        return unit
+    
+    def finish(self, unit, result):
+        """Record a unit as used after a successful write, or give it back"""
+        with self._lock:
+            self._claimed.pop(unit.id, None)
+            if not result.success:
+                return
+            self.assigned[unit.id] = {"mac": result.mac, "port": result.port,
+                                      "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self.save()
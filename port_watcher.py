@@ -0,0 +1,207 @@
+"""
+Hot-plug detection for serial ports.
+
+PortWatcher reports ports that appear or disappear. On Linux it waits for
+udev tty events when pyudev is installed; everywhere else it polls
+serial.tools.list_ports.comports() about once a second, which costs a few
+milliseconds per poll. AutoFlasher flashes boards as they appear.
+"""
+import threading
+import serial.tools.list_ports
+from concurrent.futures import ThreadPoolExecutor
+
+from flash_core import SubprocessEngine, DEFAULT_GANG_WORKERS
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+POLL_INTERVAL = 1.0
+# udev reports the tty before the device node is ready to open
+UDEV_SETTLE = 0.3
+
+# USB-UART bridges found on ESP32 boards: (VID, PID) -> name
+ESP32_USB_IDS = {
+    (0x10C4, 0xEA60): "CP210x",  # WiFi LoRa 32 (V2)
+    (0x1A86, 0x7523): "CH340",
+    (0x1A86, 0x55D4): "CH9102",
+    (0x0403, 0x6001): "FT232R",
+    (0x0403, 0x6010): "FT2232",
+    (0x303A, 0x1001): "ESP32 USB-JTAG",
+}
+
+# Serial numbers shared by every adapter of a kind (CP2102 default), useless for telling boards apart
+GENERIC_SERIALS = {"", "0", "0001", "00000000", "0123456789ABCDEF"}
+
+
+def esp32_adapter_name(info):
+    """Return the bridge name if a port looks like an ESP32 board, else None"""
+    if info.vid is None:
+        return None
+    return ESP32_USB_IDS.get((info.vid, info.pid))
+
+
+def unique_serial(info):
+    """Return the port's USB serial number if it identifies one board, else None"""
+    serial_number = (info.serial_number or "").strip()
+    if serial_number.upper() in GENERIC_SERIALS:
+        return None
+    return f"{info.vid:04X}:{info.pid:04X}:{serial_number}"
+
+
+def snapshot():
+    """Return {device: ListPortInfo} for the ports present now"""
+    return dict((info.device, info) for info in serial.tools.list_ports.comports())
+
+
+class PortWatcher:
+    """Background thread calling on_change(added, removed) when the port list changes
+    
+    added is a list of ListPortInfo, removed a list of device names. Ports
+    present when the watcher starts are not reported.
+    """
+    
+    def __init__(self, on_change, interval=POLL_INTERVAL, use_udev=True):
+        self.on_change = on_change
+        self.interval = interval
+        self.use_udev = use_udev and pyudev is not None
+        self.ports = {}
+        self._stop = threading.Event()
+        self._thread = None
+    
+    @property
+    def mode(self):
+        return "udev" if self.use_udev else "polling"
+    
+    def start(self):
+        self.ports = snapshot()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _run(self):
+        wait = self._poll_wait
+        if self.use_udev:
+            try:
+                monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                monitor.filter_by("tty")
+                monitor.start()
+                wait = lambda: self._udev_wait(monitor)
+            except Exception as e:
+                print(f"Warning: udev monitoring unavailable, polling ports instead: {e}")
+                self.use_udev = False
+        while not self._stop.is_set():
+            wait()
+            if self._stop.is_set():
+                break
+            try:
+                self._check()
+            except Exception as e:
+                print(f"Warning: Could not list serial ports: {e}")
+    
+    def _poll_wait(self):
+        self._stop.wait(self.interval)
+    
+    def _udev_wait(self, monitor):
+        # A slow fallback poll still catches anything udev did not report
+        if monitor.poll(timeout=self.interval * 10) is not None:
+            self._stop.wait(UDEV_SETTLE)
+            while monitor.poll(timeout=0) is not None:
+                pass
+    
+    def _check(self):
+        current = snapshot()
+        added = [info for device, info in current.items() if device not in self.ports]
+        removed = [device for device in self.ports if device not in current]
+        self.ports = current
+        if added or removed:
+            self.on_change(added, removed)
+
+
+class FlashedBoards:
+    """Boards flashed during this session, by USB serial number and chip MAC"""
+    
+    def __init__(self):
+        self.serials = set()
+        self.macs = set()
+        self._lock = threading.Lock()
+    
+    def contains(self, serial_id=None, mac=None):
+        with self._lock:
+            return (serial_id is not None and serial_id in self.serials) or (mac is not None and mac in self.macs)
+    
+    def add(self, serial_id=None, mac=None):
+        with self._lock:
+            if serial_id:
+                self.serials.add(serial_id)
+            if mac:
+                self.macs.add(mac)
+
+
+class AutoFlasher:
+    """Flash ESP32 boards as they are plugged in, each board at most once per session
+    
+    make_flasher() is called for every new board and returns a GangFlasher set
+    up with the current profile; its on_event receives the board's events.
+    on_event(port, "skipped", reason) reports boards that were already flashed.
+    """
+    
+    def __init__(self, make_flasher, max_workers=DEFAULT_GANG_WORKERS, on_event=None):
+        self.make_flasher = make_flasher
+        self.on_event = on_event
+        self.flashed = FlashedBoards()
+        self._pending = set()  # USB serial numbers of boards queued or being flashed
+        self._lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    
+    def on_ports_changed(self, added, removed):
+        for info in added:
+            if esp32_adapter_name(info):
+                self.submit(info)
+    
+    def submit(self, info):
+        """Queue a flash of the board on this port"""
+        return self.pool.submit(self._flash, info.device, unique_serial(info), self.make_flasher())
+    
+    def _flash(self, port, serial_id, flasher):
+        if self.flashed.contains(serial_id=serial_id):
+            self._emit(port, "skipped", "already flashed this session: same USB serial number")
+            return None
+        if serial_id is not None:
+            with self._lock:
+                if serial_id in self._pending:
+                    self._emit(port, "skipped", "already being flashed")
+                    return None
+                self._pending.add(serial_id)
+        try:
+            return self._flash_board(port, serial_id, flasher)
+        finally:
+            with self._lock:
+                self._pending.discard(serial_id)
+    
+    def _flash_board(self, port, serial_id, flasher):
+        mac = None
+        if serial_id is None:
+            # The USB serial number cannot tell boards apart, ask the chip
+            engine = flasher.engine or SubprocessEngine(flasher.esptool_path)
+            try:
+                mac = engine.read_mac(port)
+            except Exception:
+                mac = None
+            if self.flashed.contains(mac=mac):
+                self._emit(port, "skipped", f"already flashed this session: MAC {mac}")
+                return None
+        result = flasher.flash_port(port)
+        if result.success:
+            self.flashed.add(serial_id, result.mac or mac)
+        return result
+    
+    def _emit(self, port, kind, value):
+        if self.on_event:
+            self.on_event(port, kind, value)
+    
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
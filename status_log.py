@@ -0,0 +1,144 @@
+"""
+Bounded model behind the Status Log widget.
+
+esptool prints a "Writing at 0x...... (NN %)" line for every block it sends,
+so a day of flashing would otherwise leave tens of thousands of lines in the
+Text widget. StatusLog keeps at most `capacity` lines, folds the progress
+lines of each region into a single bar that is updated in place (one bar per
+port and region for "[port] ..." lines of background jobs), and reports
+only what changed since the last redraw. The unabridged output goes to a
+rotating file on disk instead.
+"""
+import os
+import re
+import logging
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from flash_core import FLASH_REGIONS, WRITING_RE
+
+DEFAULT_CAPACITY = 2000
+RAW_LOG_MAX_BYTES = 2 * 1024 * 1024
+RAW_LOG_BACKUPS = 5
+BAR_WIDTH = 30
+
+# "[COM5] Writing at ..." from a background or resumed job
+PORT_PREFIX_RE = re.compile(r"^\[([^\]]+)\] ")
+
+
+def open_raw_log(path, max_bytes=RAW_LOG_MAX_BYTES, backup_count=RAW_LOG_BACKUPS):
+    """Return a logger that appends raw output lines to a rotating file, or None"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    except OSError as e:
+        print(f"Warning: Could not open raw log {path}: {e}")
+        return None
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger = logging.getLogger("esp32flasher.raw." + os.path.abspath(path))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers[:] = [handler]
+    return logger
+
+
+class StatusLog:
+    """Fixed-capacity list of log lines with one progress bar per flash region"""
+    
+    def __init__(self, capacity=DEFAULT_CAPACITY, regions=None):
+        self.capacity = max(1, int(capacity))
+        self.entries = deque()  # [seq, text]
+        self.next_seq = 0
+        self.progress = {}  # (port or None, region offset) -> entry of its progress bar
+        self.percent = {}  # (port or None, region offset) -> percentage shown by that bar
+        self.dirty = set()
+        # Lines currently shown by the widget, as a half-open range of seqs
+        self.shown_first = 0
+        self.shown_end = 0
+        self.set_regions(regions or [(offset, name) for offset, _, name in FLASH_REGIONS])
+    
+    def set_regions(self, regions):
+        """Set the [(offset, name)] regions that progress lines are grouped by"""
+        self.regions = sorted(regions)
+    
+    def begin_run(self):
+        """Start new progress bars for the next interactive flash; background jobs keep theirs"""
+        self.progress = dict((key, entry) for key, entry in self.progress.items() if key[0] is not None)
+    
+    def region_for(self, address):
+        """Return (offset, name) of the region containing address"""
+        found = None
+        for offset, name in self.regions:
+            if offset <= address:
+                found = (offset, name)
+        if found is None:
+            return address, f"0x{address:x}"
+        return found
+    
+    def feed(self, line):
+        """Add one output line, folding progress lines into their region's bar"""
+        match = WRITING_RE.search(line)
+        if not match:
+            self._append(line)
+            return
+        prefix = PORT_PREFIX_RE.match(line)
+        port = prefix.group(1) if prefix else None
+        offset, name = self.region_for(int(match.group(1), 16))
+        percent = min(100, int(match.group(2)))
+        filled = BAR_WIDTH * percent // 100
+        text = f"{name:<12} 0x{offset:05x} [{'#' * filled}{'.' * (BAR_WIDTH - filled)}] {percent:3d} %"
+        if port is not None:
+            text = f"[{port}] {text}"
+        
+        key = (port, offset)
+        entry = self.progress.get(key)
+        # A bar going backwards is the port's next flash (or a retry), which gets a bar of its own
+        if entry is not None and self.entries and entry[0] >= self.entries[0][0] and percent >= self.percent[key]:
+            entry[1] = text
+            self.dirty.add(entry[0])
+        else:
+            self.progress[key] = self._append(text)
+        self.percent[key] = percent
+    
+    def _append(self, text):
+        entry = [self.next_seq, text]
+        self.next_seq += 1
+        self.entries.append(entry)
+        while len(self.entries) > self.capacity:
+            self.entries.popleft()
+        return entry
+    
+    @property
+    def first_seq(self):
+        return self.entries[0][0] if self.entries else self.next_seq
+    
+    def take_changes(self):
+        """Return (dropped, updates, appended) needed to bring the widget up to date
+        
+        dropped is the number of lines to delete from the top, updates is a list
+        of (row, text) to rewrite (0-based, counted after the deletion) and
+        appended the new lines to add at the end.
+        """
+        first = self.first_seq
+        dropped = max(0, min(first, self.shown_end) - self.shown_first)
+        start = max(first, self.shown_end)
+        
+        updates = []
+        for seq in sorted(self.dirty):
+            if first <= seq < start:
+                updates.append((seq - first, self.entries[seq - first][1]))
+        appended = []
+        for seq, text in reversed(self.entries):
+            if seq < start:
+                break
+            appended.append(text)
+        appended.reverse()
+        
+        self.dirty.clear()
+        self.shown_first = first
+        self.shown_end = self.next_seq
+        return dropped, updates, appended
+    
+    def text(self):
+        """Return the whole log as a string"""
+        return "\n".join(text for _, text in self.entries)
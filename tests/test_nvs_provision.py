@@ -0,0 +1,120 @@
+"""
+nvs_provision must write the same bytes as ESP-IDF's nvs_partition_gen.py.
+
+data/nvs_reference.bin was generated from data/nvs_reference.csv with
+esp-idf-nvs-partition-gen 0.3.0:
+
+    python -m esp_idf_nvs_partition_gen generate nvs_reference.csv nvs_reference.bin 0x6000
+
+The CSV covers every integer type, strings, hex2bin and base64 data, a blob
+larger than a page (stored as chunks on two pages), enough strings to fill
+four pages and a string that would end on a page's last entry, which the
+generator moves to the next page instead.
+"""
+import os
+import csv
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nvs_provision import (build_nvs_image, parse_value, crc32, PAGE_SIZE, ENTRY_SIZE, ENTRIES_PER_PAGE,
+                           BITMAP_OFFSET, FIRST_ENTRY_OFFSET, PAGE_ACTIVE, PAGE_FULL, TYPE_STRING,
+                           TYPE_BLOB_DATA, TYPE_BLOB_INDEX)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+REFERENCE_SIZE = 0x6000
+
+# Entry states in the page bitmap (two bits per entry)
+ENTRY_EMPTY = 3
+ENTRY_WRITTEN = 2
+
+
+def load_reference():
+    """Return (namespace, [(key, type, value)], reference image bytes)"""
+    namespace, entries = None, []
+    with open(os.path.join(DATA_DIR, "nvs_reference.csv"), newline="") as f:
+        for row in csv.DictReader(f):
+            if row["type"] == "namespace":
+                namespace = row["key"]
+            else:
+                entries.append((row["key"], row["encoding"], parse_value(row["key"], row["encoding"], row["value"])))
+    with open(os.path.join(DATA_DIR, "nvs_reference.bin"), "rb") as f:
+        return namespace, entries, f.read()
+
+
+def read_pages(image):
+    """Yield (page number, state, page bytes, [(entry index, entry, data)]) for every used page"""
+    for number in range(len(image) // PAGE_SIZE):
+        page = image[number * PAGE_SIZE:(number + 1) * PAGE_SIZE]
+        state = struct.unpack_from("<I", page, 0)[0]
+        if state == 0xFFFFFFFF:
+            continue
+        entries = []
+        index = 0
+        while index < ENTRIES_PER_PAGE:
+            if page[BITMAP_OFFSET + index // 4] >> (index % 4 * 2) & 3 == ENTRY_EMPTY:
+                break
+            start = FIRST_ENTRY_OFFSET + index * ENTRY_SIZE
+            entry = page[start:start + ENTRY_SIZE]
+            span = entry[2]
+            entries.append((index, entry, page[start + ENTRY_SIZE:start + span * ENTRY_SIZE]))
+            index += span
+        yield number, state, page, entries
+
+
+class NvsReferenceTest(unittest.TestCase):
+    """NvsImage output against the checked-in nvs_partition_gen.py image"""
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.namespace, cls.entries, cls.reference = load_reference()
+    
+    def test_matches_reference_image(self):
+        image = build_nvs_image(self.entries, REFERENCE_SIZE, self.namespace)
+        self.assertEqual(len(image), len(self.reference))
+        for number in range(len(image) // PAGE_SIZE):
+            page = slice(number * PAGE_SIZE, (number + 1) * PAGE_SIZE)
+            self.assertEqual(image[page], self.reference[page], f"page {number} differs")
+    
+    def test_page_headers(self):
+        pages = list(read_pages(self.reference))
+        self.assertEqual([state for _, state, _, _ in pages], [PAGE_FULL] * (len(pages) - 1) + [PAGE_ACTIVE])
+        self.assertGreaterEqual(len(pages), 3, "the reference no longer rolls over onto a new page")
+        for number, _, page, _ in pages:
+            self.assertEqual(struct.unpack_from("<I", page, 4)[0], number)
+            self.assertEqual(struct.unpack_from("<I", page, 28)[0], crc32(page[4:28]), f"page {number} header CRC")
+    
+    def test_entry_crcs_and_bitmap(self):
+        for number, _, page, entries in read_pages(self.reference):
+            used = 0
+            for index, entry, data in entries:
+                self.assertEqual(struct.unpack_from("<I", entry, 4)[0], crc32(entry[0:4] + entry[8:32]),
+                                 f"page {number} entry {index} CRC")
+                if entry[1] in (TYPE_STRING, TYPE_BLOB_DATA):
+                    size, _, data_crc = struct.unpack_from("<HHI", entry, 24)
+                    self.assertEqual(data_crc, crc32(data[:size]), f"page {number} entry {index} data CRC")
+                used = index + entry[2]
+            states = [page[BITMAP_OFFSET + index // 4] >> (index % 4 * 2) & 3 for index in range(ENTRIES_PER_PAGE)]
+            self.assertEqual(states, [ENTRY_WRITTEN] * used + [ENTRY_EMPTY] * (ENTRIES_PER_PAGE - used))
+    
+    def test_multi_chunk_blob(self):
+        chunks = {}
+        indexes = {}
+        for number, _, _, entries in read_pages(self.reference):
+            for _, entry, _ in entries:
+                key = entry[8:24].rstrip(b"\x00").decode("ascii")
+                if entry[1] == TYPE_BLOB_DATA:
+                    chunks.setdefault(key, []).append((number, entry[3]))
+                elif entry[1] == TYPE_BLOB_INDEX:
+                    indexes[key] = struct.unpack_from("<IB", entry, 24)
+        spread = [key for key, found in chunks.items() if len(set(number for number, _ in found)) > 1]
+        self.assertTrue(spread, "the reference has no blob split over pages")
+        for key in spread:
+            self.assertEqual(indexes[key][1], len(chunks[key]))
+            self.assertEqual([chunk for _, chunk in chunks[key]], list(range(len(chunks[key]))))
+
+
+if __name__ == "__main__":
+    unittest.main()